@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import subprocess
+from functools import lru_cache
+
+LOGGER = logging.getLogger('experiment')
+
+DEFAULT_CACHE_DIR = 'cache/beast'
+DEFAULT_MAX_SIZE = 20 * 2 ** 30  # 20 GB
+METADATA_FNAME = 'metadata.json'
+STORED_FNAMES_KEY = 'stored_fnames'
+HASH_BLOCK_SIZE = 2 ** 20
+
+_ACTIVE_CACHE = None
+
+
+@lru_cache(maxsize=None)
+def get_beast_version(beast_command='beast'):
+    """Get the version string of the installed BEAST ('unknown' if BEAST can't
+    be called)."""
+    try:
+        ret = subprocess.run([beast_command, '-version'], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, timeout=60)
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+
+    for line in ret.stdout.decode(errors='replace').splitlines():
+        if 'BEAST v' in line:
+            return line.strip()
+    return 'unknown'
+
+
+def hash_file(path, hasher=None):
+    """Update (or create) a sha256 hasher with the content of a file, reading it
+    block-wise."""
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher
+
+
+class BeastCache(object):
+
+    """A content-addressed cache for the outputs of BEAST (and treeannotator)
+    runs. Every entry is a directory named by the sha256 hash of the inputs
+    (the XML content, the seed, the BEAST version and further settings) and
+    contains the output files and a metadata file. When the cache exceeds
+    ´max_size´, the least recently used entries are evicted.
+
+    Attributes:
+        cache_dir (str): The directory of the cache.
+        max_size (int): Maximal total size of the cache in bytes.
+        hits (int): Number of cache hits (since the last `reset_stats`).
+        misses (int): Number of cache misses (since the last `reset_stats`).
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, input_paths, **settings):
+        """Compute the cache key of a run from the content of its input files
+        and its settings (e.g. seed, BEAST version, HPD level).
+
+        Returns:
+            str: The hex digest of the key.
+        """
+        hasher = hashlib.sha256()
+        for path in input_paths:
+            hash_file(path, hasher)
+        hasher.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return hasher.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key, output_dir, fnames):
+        """Copy the cached output files of ´key´ to ´output_dir´. Only the
+        files of ´fnames´ that were actually stored are required (e.g. BEAST
+        does not write the `.ops` file when a chain is stopped early).
+
+        Returns:
+            dict or None: The metadata of the entry (the names of the copied
+                files under ´STORED_FNAMES_KEY´), or None on a cache miss.
+        """
+        entry_dir = self._entry_dir(key)
+        metadata_path = os.path.join(entry_dir, METADATA_FNAME)
+        if not os.path.exists(metadata_path):
+            self.misses += 1
+            return None
+
+        with open(metadata_path, 'r') as metadata_file:
+            metadata = json.load(metadata_file)
+        stored_fnames = metadata.get(STORED_FNAMES_KEY, fnames)
+        fnames = [f for f in fnames if f in stored_fnames]
+        if not fnames or \
+                not all(os.path.exists(os.path.join(entry_dir, f)) for f in fnames):
+            self.misses += 1
+            return None
+
+        os.makedirs(output_dir, exist_ok=True)
+        for fname in fnames:
+            shutil.copy(os.path.join(entry_dir, fname), os.path.join(output_dir, fname))
+
+        # Mark the entry as recently used (for the eviction)
+        os.utime(entry_dir)
+        self.hits += 1
+
+        metadata[STORED_FNAMES_KEY] = fnames
+        return metadata
+
+    def store(self, key, output_dir, fnames, metadata=None):
+        """Store the output files ´fnames´ from ´output_dir´ in the cache (the
+        entry is written to a temporary directory and renamed atomically).
+        Missing files are skipped, the names of the stored files are recorded
+        in the metadata."""
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        stored_fnames = []
+        for fname in fnames:
+            path = os.path.join(output_dir, fname)
+            if os.path.exists(path):
+                shutil.copy(path, os.path.join(tmp_dir, fname))
+                stored_fnames.append(fname)
+        metadata = dict(metadata or {})
+        metadata[STORED_FNAMES_KEY] = stored_fnames
+        with open(os.path.join(tmp_dir, METADATA_FNAME), 'w') as metadata_file:
+            json.dump(metadata, metadata_file, default=str)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Stored concurrently by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def iter_entries(self):
+        """Iterate over the cache entries.
+
+        Yields:
+            str: The entry directory.
+            int: The size of the entry in bytes.
+            float: The time of the last access (mtime of the entry directory).
+        """
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            if key.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, f))
+                       for f in os.listdir(entry_dir))
+            yield entry_dir, size, os.path.getmtime(entry_dir)
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.iter_entries())
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is smaller
+        than ´max_size´."""
+        entries = sorted(self.iter_entries(), key=lambda entry: entry[2])
+        total_size = sum(size for _, size, _ in entries)
+        for entry_dir, size, _ in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+            LOGGER.debug('\tEvicted cache entry %s' % entry_dir)
+
+    def report(self):
+        """Summary of the cache usage (since the last `reset_stats`)."""
+        n_lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_lookups if n_lookups > 0 else float('nan'),
+            'size': self.size,
+        }
+
+
+def set_cache(cache):
+    """Set the cache used by `run_beast` and `run_treeannotator` (None to
+    disable caching)."""
+    global _ACTIVE_CACHE
+    _ACTIVE_CACHE = cache
+
+
+def get_cache():
+    """The cache used by `run_beast` and `run_treeannotator` (or None)."""
+    return _ACTIVE_CACHE
@@ -4,10 +4,15 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import os
 import subprocess
 import logging
-import time
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
+
+from src.beast_cache import get_cache, get_beast_version, STORED_FNAMES_KEY
+from src.beast_runner import BeastJob, BeastJobRunner, BeastJobResult
 from src.beast_xml_templates import *
-from src.tree import Tree
+from src.tree import Tree, parse_root_location
+from src.tree_archive import TreeArchive
 from src.util import str_concat_array, extract_newick_from_nexus, SubprocessException, mkpath
 
 BEAST_LOGGER_PATH = 'logs/beast.log'
@@ -22,6 +27,31 @@ BEAST_LOGGER.info('=' * 100)
 BEAST_LOGGER.info('New Run')
 BEAST_LOGGER.info('=' * 100)
 
+# The BEAST backend: the Java BEAST install, the local stand-in (see
+# `src.beast_standin`) or the native fixed-tree MCMC (see `src.beast_mcmc`),
+# selected per call or via the environment variable BEAST_BACKEND
+BEAST_BACKEND = 'beast'
+STANDIN_BACKEND = 'standin'
+MCMC_BACKEND = 'mcmc'
+NATIVE_BACKENDS = [STANDIN_BACKEND, MCMC_BACKEND]
+BEAST_SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'beast_scripts'))
+STANDIN_SCRIPT_PATH = os.path.join(BEAST_SCRIPTS_DIR, 'beast_standin.sh')
+MCMC_SCRIPT_PATH = os.path.join(BEAST_SCRIPTS_DIR, 'beast_mcmc.sh')
+DEFAULT_BEAST_BACKEND = os.environ.get('BEAST_BACKEND', BEAST_BACKEND)
+
+
+def get_beast_command(backend=None):
+    """The executable of a BEAST backend ('beast', 'standin' or 'mcmc')."""
+    backend = backend or DEFAULT_BEAST_BACKEND
+    if backend == BEAST_BACKEND:
+        return 'beast'
+    elif backend == STANDIN_BACKEND:
+        return STANDIN_SCRIPT_PATH
+    elif backend == MCMC_BACKEND:
+        return MCMC_SCRIPT_PATH
+    else:
+        raise ValueError('Unknown BEAST backend `%s`' % backend)
+
 def write_nexus(simulation, path, fossils=None):
     data_str = ''
 
@@ -102,31 +132,165 @@ def load_tree_from_nexus(tree_path, location_key='location',
     return tree
 
 
-def run_beast(working_dir):
-    script_path = 'src/beast_scripts/beast.sh'
+# Trees up to this size run fastest in many single-threaded chains; larger trees
+# get multi-threaded BEAGLE instances (about one thread per TAXA_PER_THREAD taxa)
+SMALL_TREE_MAX_TAXA = 500
+TAXA_PER_THREAD = 250
+MAX_THREADS_PER_JOB = 16
+
+
+def count_taxa(xml_path):
+    """Count the taxa defined in a BEAST XML file."""
+    n_taxa = 0
+    with open(xml_path, 'r') as xml_file:
+        for line in xml_file:
+            n_taxa += line.count('<taxon id=')
+    return n_taxa
+
+
+def choose_beast_resources(n_taxa, free_cores):
+    """Choose the number of threads and BEAGLE instances for a BEAST analysis
+    of ´n_taxa´ taxa, given the number of cores available for it.
+
+    Returns:
+        int: The number of threads.
+        int: The number of BEAGLE instances.
+    """
+    if n_taxa <= SMALL_TREE_MAX_TAXA or free_cores <= 1:
+        return 1, 1
+    threads = min(free_cores, MAX_THREADS_PER_JOB, max(1, n_taxa // TAXA_PER_THREAD))
+    return threads, threads
+
+
+def schedule_beast_jobs(jobs, max_cores=None):
+    """Set the threads and BEAGLE instances of each job from its number of taxa
+    and the available cores: small analyses get one core each, the remaining
+    cores are shared among the large analyses.
+
+    Returns:
+        list[BeastJob]: The jobs, ordered by decreasing number of threads (so
+            that the runner packs the large jobs first).
+    """
+    max_cores = max_cores or os.cpu_count() or 1
+    jobs = list(jobs)
+    n_taxa = [count_taxa(job.xml_path) for job in jobs]
+
+    n_small = sum(n <= SMALL_TREE_MAX_TAXA for n in n_taxa)
+    n_large = len(jobs) - n_small
+    if n_large > 0:
+        large_job_cores = max(1, (max_cores - n_small) // n_large)
+
+    for job, n in zip(jobs, n_taxa):
+        free_cores = 1 if n <= SMALL_TREE_MAX_TAXA else large_job_cores
+        job.threads, job.beagle_instances = choose_beast_resources(n, free_cores)
+
+    return sorted(jobs, key=lambda job: -job.threads)
+
+
+def run_scheduled_beast_jobs(jobs, max_cores=None, **runner_kwargs):
+    """Schedule the jobs (see `schedule_beast_jobs`) and run them concurrently.
+
+    Returns:
+        list[BeastJobResult]: The results (in the order of ´jobs´), incl. CPU
+            time and peak memory of each job.
+    """
+    jobs = list(jobs)
+    scheduled_jobs = schedule_beast_jobs(jobs, max_cores=max_cores)
+    runner = BeastJobRunner(max_cores=max_cores, **runner_kwargs)
+    results = runner.run(scheduled_jobs)
+    results_by_job = {id(result.job): result for result in results}
+    return [results_by_job[id(job)] for job in jobs]
+
+
+def run_beast(working_dir, ess_threshold=None, burnin=0, seed=None, cache=None,
+              max_cores=None, backend=None):
+    """Run the BEAST analysis `nowhere.xml` in ´working_dir´. BEAST runs in a
+    scratch directory, its output is streamed to the BEAST log and the output
+    files are moved to ´working_dir´ afterwards (see `src.beast_runner`).
+
+    Kwargs:
+        ess_threshold (float): If given, stop the chain as soon as the ESS of
+            the monitored parameters (after ´burnin´) reaches this threshold.
+        burnin (int): Number of MCMC states ignored for the ESS.
+        seed (int): Random seed for BEAST.
+        cache (BeastCache): Cache of BEAST outputs. Default: the active cache
+            (see `src.beast_cache.set_cache`), if any.
+        max_cores (int): Cores available for this run (threads and BEAGLE
+            instances are chosen by `schedule_beast_jobs`). Default: all cores.
+        backend (str): 'beast', 'standin' (see `src.beast_standin`) or 'mcmc'
+            (see `src.beast_mcmc`).
+            Default: the environment variable BEAST_BACKEND or 'beast'.
+
+    Returns:
+        BeastJobResult: The result of the run (incl. the stopping state).
+    """
     working_dir = os.path.abspath(working_dir)
-    bash_command = 'bash {script} {cwd}'.format(
-        script=script_path, cwd=working_dir)
-
-    t0 = time.time()
-    ret = subprocess.run(bash_command, shell=True, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    EXPERIMENT_LOGGER.info('\tBEAST Runtime: %.2f' % (time.time() - t0))
-    BEAST_LOGGER.info(ret.stdout.decode())
-    BEAST_LOGGER.info(ret.stderr.decode())
-    if ret.returncode != 0:
-        raise SubprocessException
+    xml_path = os.path.join(working_dir, 'nowhere.xml')
+    job = BeastJob(xml_path, working_dir, seed=seed, ess_threshold=ess_threshold,
+                   burnin=burnin)
+    job, = schedule_beast_jobs([job], max_cores=max_cores)
+    beast_command = get_beast_command(backend)
+
+    cache = cache or get_cache()
+    if cache is not None:
+        key = cache.make_key([xml_path], seed=seed,
+                             beast_version=get_beast_version(beast_command),
+                             ess_threshold=ess_threshold,
+                             burnin=burnin if ess_threshold else None)
+        metadata = cache.lookup(key, working_dir, job.output_fnames)
+        if metadata is not None:
+            EXPERIMENT_LOGGER.info('\tBEAST results loaded from cache (%s)' % key)
+            return BeastJobResult(job, 0, 0., {f: os.path.join(working_dir, f)
+                                               for f in metadata[STORED_FNAMES_KEY]},
+                                  stop_state=metadata.get('stop_state'),
+                                  stopped_early=metadata.get('stopped_early', False),
+                                  ess=metadata.get('ess'),
+                                  cpu_time=metadata.get('cpu_time', np.nan),
+                                  peak_rss=metadata.get('peak_rss', np.nan))
+
+    runner = BeastJobRunner(max_cores=max_cores, beast_command=beast_command)
+    result, = runner.run([job], raise_on_error=True)
+
+    if cache is not None:
+        cache.store(key, working_dir, job.output_fnames, metadata={
+            'stop_state': result.stop_state, 'stopped_early': result.stopped_early,
+            'ess': result.ess, 'runtime': result.runtime,
+            'cpu_time': result.cpu_time, 'peak_rss': result.peak_rss})
+    return result
 
 
 def run_treeannotator(hpd, burnin, working_dir,
-                      trees_fname='nowhere.trees', mcc_fname='nowhere.tree'):
+                      trees_fname='nowhere.trees', mcc_fname='nowhere.tree',
+                      cache=None, backend=None):
     """Run treeannotator from the BEAST toolbox via bash script. Return the
-    summary tree."""
+    summary tree. Results are taken from the cache (default: the active
+    cache, see `src.beast_cache.set_cache`) if the same posterior was already
+    summarized with the same settings. With the native backends ('standin' and
+    'mcmc'), the MCC tree is computed by `src.summarize.summarize_posterior`
+    instead."""
+    backend = backend or DEFAULT_BEAST_BACKEND
 
     script_path = 'src/beast_scripts/treeannotator.sh'
     working_dir = os.path.abspath(working_dir)
     tree_path = os.path.join(working_dir, 'nowhere.tree')
 
+    cache = cache or get_cache()
+    if cache is not None:
+        key = cache.make_key([os.path.join(working_dir, trees_fname)],
+                             tool='treeannotator', hpd=hpd, burnin=burnin,
+                             beast_version=get_beast_version(get_beast_command(backend)))
+        if cache.lookup(key, working_dir, [mcc_fname]) is not None:
+            return load_tree_from_nexus(tree_path=tree_path)
+
+    if backend in NATIVE_BACKENDS:
+        # Imported here, since src.summarize depends on this module
+        from src.summarize import summarize_posterior
+        summarize_posterior(os.path.join(working_dir, trees_fname), [hpd], burnin=burnin,
+                            mcc_path=os.path.join(working_dir, mcc_fname))
+        if cache is not None:
+            cache.store(key, working_dir, [mcc_fname])
+        return load_tree_from_nexus(tree_path=tree_path)
+
     bash_command = 'sh {script} {hpd} {burnin} {cwd} {trees_file} {mcc_file}'.format(
         script=script_path, hpd=hpd, burnin=burnin, cwd=working_dir,
         trees_file=trees_fname, mcc_file=mcc_fname
@@ -139,6 +303,8 @@ def run_treeannotator(hpd, burnin, working_dir,
     if ret.returncode != 0:
         raise SubprocessException
 
+    if cache is not None:
+        cache.store(key, working_dir, [mcc_fname])
     return load_tree_from_nexus(tree_path=tree_path)
 
 
@@ -178,30 +344,332 @@ def read_nexus_name_mapping(nexus_str):
     #
     # return name_map
 
-def load_trees(tree_path, read_name_mapping=False, max_trees=None):
-    with open(tree_path, 'r') as tree_file:
-        nexus_str = tree_file.read().lower().strip()
-
-    if read_name_mapping:
-        name_map = read_nexus_name_mapping(nexus_str)
+def parse_state(tree_name, default=None):
+    """Parse the MCMC state from the name of a tree in a BEAST `.trees` file
+    (e.g. 'state_1000' -> 1000)."""
+    _, _, state_str = tree_name.rpartition('_')
+    try:
+        return int(state_str)
+    except ValueError:
+        return default
+
+
+def to_parsable_newick(newick_str):
+    """Rewrite a BEAST Newick string (with node and branch attributes) into the
+    format understood by `Tree.from_newick`."""
+    if newick_str.startswith(r'[&r] '):
+        newick_str = newick_str[len(r'[&r] '):]
+
+    newick_str = newick_str.replace(']:[', ',')
+    newick_str = newick_str.replace(']', ']:')
+    newick_str = newick_str.replace(':;', ';')
+    return newick_str
+
+
+def iter_tree_file(tree_path, burnin=0, thinning=1, max_trees=None,
+                    read_name_mapping=False):
+    """Walk through a BEAST `.trees` file line by line (see `iter_tree_lines`)
+    and additionally yield the byte offset of each tree line."""
+    name_map = None
+    in_translate_block = False
+    i_tree = 0
+    i_sample = 0
+    n_yielded = 0
+    offset = 0
+
+    with open(tree_path, 'rb') as tree_file:
+        for raw_line in tree_file:
+            line_offset = offset
+            offset += len(raw_line)
+            line = raw_line.decode().strip().lower()
+
+            if in_translate_block:
+                if line == ';' or line.startswith('tree '):
+                    in_translate_block = False
+                else:
+                    entry = line.strip(',;')
+                    if entry:
+                        key, value = entry.split()
+                        name_map[key] = value
+                    if line.endswith(';'):
+                        in_translate_block = False
+                    continue
+
+            if line == 'translate':
+                if read_name_mapping:
+                    name_map = {}
+                    in_translate_block = True
+                continue
+
+            if not line.startswith('tree '):
+                continue
+
+            head, _, newick_str = line.partition(' = ')
+            state = parse_state(head.split()[1], default=i_tree)
+            i_tree += 1
+            if state < burnin:
+                continue
+            i_sample += 1
+            if (i_sample - 1) % thinning != 0:
+                continue
+
+            yield line_offset, state, newick_str, name_map
+
+            n_yielded += 1
+            if max_trees is not None and n_yielded >= max_trees:
+                return
+
+
+def iter_tree_lines(tree_path, burnin=0, thinning=1, max_trees=None,
+                    read_name_mapping=False):
+    """Walk through a BEAST `.trees` file line by line and yield the raw Newick
+    strings of the posterior trees. Trees in the burn-in (by their state number)
+    and trees removed by thinning are skipped without being processed.
+
+    Args:
+        tree_path (str): Path to the BEAST `.trees` file.
+        burnin (int): Number of MCMC states to be discarded as burn-in.
+        thinning (int): Only every ´thinning´th tree (after burn-in) is used.
+        max_trees (int): Maximum number of trees to be yielded.
+        read_name_mapping (bool): Whether to read the translate table.
+
+    Yields:
+        int: The MCMC state of the tree.
+        str: The (lower case) Newick string, as written by BEAST.
+        dict or None: The translate table of the file.
+    """
+    for _, state, newick_str, name_map in iter_tree_file(
+            tree_path, burnin=burnin, thinning=thinning, max_trees=max_trees,
+            read_name_mapping=read_name_mapping):
+        yield state, newick_str, name_map
+
+
+def index_tree_lines(tree_path, burnin=0, thinning=1, max_trees=None,
+                     read_name_mapping=False):
+    """Find the byte offsets of the selected posterior trees in a BEAST `.trees`
+    file without parsing them (see `iter_tree_lines` for the args).
+
+    Returns:
+        np.array: Byte offset of each selected tree line.
+            shape: (n_trees,)
+        np.array: MCMC state of each selected tree.
+            shape: (n_trees,)
+        dict or None: The translate table of the file.
+    """
+    offsets = []
+    states = []
+    name_map = None
+    for offset, state, _, name_map in iter_tree_file(
+            tree_path, burnin=burnin, thinning=thinning, max_trees=max_trees,
+            read_name_mapping=read_name_mapping):
+        offsets.append(offset)
+        states.append(state)
+
+    return (np.array(offsets, dtype=np.int64), np.array(states, dtype=np.int64),
+            name_map)
+
+
+def iter_posterior_newicks(tree_path, burnin=0, thinning=1, max_trees=None,
+                           read_name_mapping=False):
+    """Like `iter_tree_lines`, but the Newick strings are rewritten to be ready
+    for `Tree.from_newick`."""
+    for state, newick_str, name_map in iter_tree_lines(
+            tree_path, burnin=burnin, thinning=thinning, max_trees=max_trees,
+            read_name_mapping=read_name_mapping):
+        yield state, to_parsable_newick(newick_str), name_map
+
+
+def iter_root_locations(tree_path, burnin=0, thinning=1, max_trees=None,
+                        location_key='location'):
+    """Iterate over the root locations of the posterior trees in a BEAST
+    `.trees` file, without parsing the trees (see `iter_tree_lines` for the
+    args).
+
+    Yields:
+        int: The MCMC state of the sample.
+        np.array: The root location of the sample.
+            shape: (2,)
+    """
+    for state, newick_str, _ in iter_tree_lines(tree_path, burnin=burnin,
+                                                thinning=thinning,
+                                                max_trees=max_trees):
+        yield state, parse_root_location(newick_str, location_key=location_key)
+
+
+def scan_root_locations(tree_path, burnin=0, thinning=1, max_trees=None,
+                        location_key='location', return_states=False):
+    """Read only the root locations of the posterior trees in a BEAST `.trees`
+    file, without parsing the trees (see `iter_tree_lines` for the args).
+
+    Returns:
+        np.array: The root locations of all posterior samples.
+            shape: (n_samples, 2)
+        np.array: The MCMC states of the samples (only if ´return_states´).
+            shape: (n_samples,)
+    """
+    states = []
+    root_locations = []
+    for state, location in iter_root_locations(tree_path, burnin=burnin,
+                                               thinning=thinning,
+                                               max_trees=max_trees,
+                                               location_key=location_key):
+        states.append(state)
+        root_locations.append(location)
+
+    root_locations = np.array(root_locations, dtype=float).reshape((-1, 2))
+    if return_states:
+        return root_locations, np.array(states, dtype=np.int64)
+    return root_locations
+
+
+def iter_trees(tree_path, burnin=0, thinning=1, max_trees=None,
+               read_name_mapping=False, return_states=False):
+    """Iterate over the posterior trees in a BEAST `.trees` file. Only one tree
+    is held in memory at a time (see `iter_posterior_newicks` for the args).
+
+    Yields:
+        Tree or (int, Tree): The parsed trees (and their MCMC states).
+    """
+    for state, newick_str, name_map in iter_posterior_newicks(
+            tree_path, burnin=burnin, thinning=thinning, max_trees=max_trees,
+            read_name_mapping=read_name_mapping):
+        tree = Tree.from_newick(newick_str, translate=name_map)
+        if return_states:
+            yield state, tree
+        else:
+            yield tree
+
+
+def iter_tree_chunk(tree_path, offsets, name_map=None):
+    """Parse the tree lines at the given byte offsets (see `index_tree_lines`)
+    of a BEAST `.trees` file.
+
+    Yields:
+        Tree: The parsed trees.
+    """
+    with open(tree_path, 'rb') as tree_file:
+        for offset in offsets:
+            tree_file.seek(offset)
+            line = tree_file.readline().decode().strip().lower()
+            _, _, newick_str = line.partition(' = ')
+            newick_str = to_parsable_newick(newick_str)
+            yield Tree.from_newick(newick_str, translate=name_map)
+
+
+def _parse_tree_chunk(tree_path, offsets, name_map, attribute_keys):
+    """Parse the tree lines at the given byte offsets into a TreeArchive (run
+    in a worker process; only the compact archive arrays are sent back)."""
+    trees = iter_tree_chunk(tree_path, offsets, name_map)
+    return TreeArchive.from_trees(trees, attribute_keys=attribute_keys)
+
+
+def load_trees_parallel(tree_path, workers, read_name_mapping=False, max_trees=None,
+                        burnin=0, thinning=1, attribute_keys=None):
+    """Parse the posterior trees of a BEAST `.trees` file in a process pool.
+
+    The file is first indexed (byte offsets of the selected tree lines, see
+    `index_tree_lines`), then split into ´workers´ contiguous byte ranges on
+    tree-line boundaries, which are parsed in parallel. Each worker returns a
+    TreeArchive, so that no Tree objects need to be pickled.
+
+    Args:
+        workers (int): Number of worker processes.
+        attribute_keys (list[str]): Numeric node attributes to be kept in the
+            archive (locations are always kept). Default: all attributes (see
+            `TreeArchive.from_trees`).
+        (for the other args see `iter_tree_lines`)
+
+    Returns:
+        TreeArchive: The trees in their original order (with MCMC states).
+    """
+    offsets, states, name_map = index_tree_lines(
+        tree_path, burnin=burnin, thinning=thinning, max_trees=max_trees,
+        read_name_mapping=read_name_mapping)
+
+    chunks = [c for c in np.array_split(offsets, workers) if len(c) > 0]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if attribute_keys is not None:
+            attribute_keys = list(attribute_keys)
+        futures = [executor.submit(_parse_tree_chunk, tree_path, chunk, name_map,
+                                   attribute_keys)
+                   for chunk in chunks]
+        archives = [future.result() for future in futures]
+
+    if archives:
+        archive = TreeArchive.concatenate(archives)
     else:
-        name_map = None
-
-    trees = []
-    for line in nexus_str.split('\n'):
-        if line.strip().startswith('tree '):
-            newick_str = line.split(' = ')[-1]
-            if newick_str.startswith(r'[&r] '):
-                newick_str = newick_str[len(r'[&r] '):]
-
-            newick_str = newick_str.replace(']:[',',')
-            newick_str = newick_str.replace(']',']:')
-            newick_str = newick_str.replace(':;', ';')
-
-            tree = Tree.from_newick(newick_str, translate=name_map)
-            trees.append(tree)
-
-            if max_trees is not None and len(trees) >= max_trees:
-                return trees
+        archive = TreeArchive.from_trees([], attribute_keys=attribute_keys)
+    archive.states = states
+    return archive
+
+
+def load_trees(tree_path, read_name_mapping=False, max_trees=None, burnin=0,
+               thinning=1, workers=None, return_archive=False, attribute_keys=None):
+    """Load the posterior trees from a BEAST `.trees` file.
+
+    Args:
+        tree_path (str): Path to the BEAST `.trees` file.
+        read_name_mapping (bool): Whether to translate the taxon ids to names.
+        max_trees (int): Maximum number of trees to be loaded.
+        burnin (int): Number of MCMC states to be discarded as burn-in.
+        thinning (int): Only every ´thinning´th tree (after burn-in) is used.
+        workers (int): If > 1, parse the trees in a pool of ´workers´ processes
+            (see `load_trees_parallel`). The trees are passed through a
+            TreeArchive in this mode.
+        return_archive (bool): Return a TreeArchive instead of a list of trees.
+        attribute_keys (list[str]): Node attributes stored in the archive
+            (with ´workers´ > 1 or ´return_archive´). Default: all attributes,
+            so that the result does not depend on the mode.
+
+    Returns:
+        list[Tree] or TreeArchive: The posterior trees.
+    """
+    if workers is not None and workers > 1:
+        archive = load_trees_parallel(tree_path, workers,
+                                      read_name_mapping=read_name_mapping,
+                                      max_trees=max_trees, burnin=burnin,
+                                      thinning=thinning,
+                                      attribute_keys=attribute_keys)
+        return archive if return_archive else list(archive)
+
+    trees = iter_trees(tree_path, burnin=burnin, thinning=thinning,
+                       max_trees=max_trees, read_name_mapping=read_name_mapping,
+                       return_states=return_archive)
+    if not return_archive:
+        return list(trees)
+
+    states = []
+
+    def iter_archived_trees():
+        for state, tree in trees:
+            states.append(state)
+            yield tree
+
+    archive = TreeArchive.from_trees(iter_archived_trees(),
+                                     attribute_keys=attribute_keys)
+    archive.states = np.array(states, dtype=np.int64)
+    return archive
+
+
+def beast_trees_to_archive(tree_path, archive_path, attribute_keys=None, burnin=0,
+                           read_name_mapping=True, max_trees=None, workers=None):
+    """Convert a BEAST `.trees` file (posterior samples) into a binary tree
+    archive (see `src.tree_archive.TreeArchive`).
+
+    Args:
+        tree_path (str): Path to the BEAST `.trees` file.
+        archive_path (str): Output path (`.npz` file or directory).
+        attribute_keys (list[str]): Numeric node attributes to be stored
+            (lower case, e.g. 'location.rate'). Default: all attributes.
+        burnin (int): Number of MCMC states to be discarded as burn-in.
+        workers (int): Number of worker processes for parsing (see `load_trees`).
+
+    Returns:
+        TreeArchive: The written archive.
+    """
+    archive = load_trees(tree_path, read_name_mapping=read_name_mapping,
+                         max_trees=max_trees, burnin=burnin, workers=workers,
+                         return_archive=True, attribute_keys=attribute_keys)
+    archive.save(archive_path)
+    return archive
 
-    return trees
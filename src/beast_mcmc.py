@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.stats import wishart, poisson, norm, expon, multivariate_normal
+
+from src.beast_runner import ChainMonitor, DEFAULT_ESS_KEYS, LOG_FNAME, TREES_FNAME
+from src.beast_standin import BeastAnalysis, LOG_COLUMNS, main
+from src.brownian import BrownianPruning, MIN_VARIANCE
+
+MCMC_VERSION = 'BEAST v1.10.4 (local fixed-tree MCMC, src.beast_mcmc)'
+
+# Priors as in the XML templates
+WISHART_DF = 2
+WISHART_SCALE = np.eye(2)
+RRW_STDEV_PRIOR_MEAN = 1. / 3.
+
+# Tuning of the Metropolis-Hastings updates (random walks on the log scale)
+RATE_PROPOSAL_SCALE = 0.5
+STDEV_PROPOSAL_SCALE = 0.3
+DRIFT_FLIPS_PER_SWEEP = 10
+NONCENTRED_PROPOSAL_SCALE = 1.
+NONCENTRED_STEPS_PER_SWEEP = 4
+
+DRIFT_COLUMNS = ['driftModels.1.rates', 'driftModels.2.rates']
+DRIFT_CHANGES_COLUMNS = ['trendChanges.1', 'trendChanges.2']
+
+# Model parameters reported in addition to `DEFAULT_ESS_KEYS` (if logged)
+MODEL_ESS_KEYS = ['location.stdev'] + DRIFT_COLUMNS
+
+
+class DiffusionMCMC(BeastAnalysis):
+
+    """In-process MCMC for the phylogeographic models of the XML templates
+    ('brownian', 'rrw', 'cdrw' and 'rdrw') on the fixed starting tree (as in
+    all our analyses, which use neither tree nor height operators).
+
+    Every sweep updates all parameters given the node locations (vectorized
+    over the branches) and then Gibbs-samples all internal node locations
+    jointly given the parameters, by Gaussian pruning (see `src.brownian`):
+        - the diffusion precision matrix: Gibbs (Wishart prior),
+        - the per-branch rate multipliers of the relaxed random walk:
+          independent Metropolis-Hastings steps for all branches at once,
+        - the standard deviation of the rate multipliers: Metropolis-Hastings,
+          given the rates and jointly with the rates (non-centred),
+        - the drift ('cdrw'): Gibbs (normal prior),
+        - the drift shifts ('rdrw'): bit-flip Metropolis-Hastings steps on the
+          change indicators (Poisson prior on their number) and Gibbs updates
+          of the drift of each regime.
+    Deviating from BEAST, the rate multipliers are continuous (not discretized
+    into categories) and the 'rdrw' change indicators are shared by both
+    dimensions. One sweep is logged per `logEvery` MCMC states, so the output
+    files have the size of the BEAST output.
+
+    Attributes:
+        sweeps_per_sample (int): Number of sweeps between two logged states.
+        runtime (float): Wall time of the last run in seconds.
+        ess (dict): ESS of the monitored parameters in the last run.
+    """
+
+    def __init__(self, xml_path, sweeps_per_sample=1):
+        super(DiffusionMCMC, self).__init__(xml_path)
+        self.sweeps_per_sample = sweeps_per_sample
+        self.runtime = np.nan
+        self.ess = {}
+
+        skeleton = BrownianPruning(self.tree)
+        self.n_nodes = skeleton.n_nodes
+        self.parents = skeleton.parents
+        self.times = skeleton.lengths
+        self.node_idx = np.arange(self.n_nodes)
+
+        self.relaxed = self.rrw_stdev is not None
+        self.has_drift = self.movement_model in ('cdrw', 'rdrw')
+
+    def init_state(self, random_state):
+        """Initial parameters: homogeneous diffusion at the ML rate, no
+        drift, and node locations sampled given these parameters."""
+        pruning = BrownianPruning(self.tree)
+        self.cov = np.eye(2) * pruning.diffusion_rate_ml()
+        self.rates = np.ones(self.n_nodes)
+        self.stdev = self.rrw_stdev
+        self.drift_values = np.zeros((self.n_nodes, 2))
+        self.changes = np.zeros(self.n_nodes, dtype=bool)
+        self.update_locations(random_state)
+
+    def get_regimes(self):
+        """The drift regime of each branch: the closest node at or above the
+        branch with a drift change (or the root), by pointer jumping."""
+        anchors = np.where(self.changes, self.node_idx, self.parents)
+        anchors[0] = 0
+        while True:
+            next_anchors = anchors[anchors]
+            if np.array_equal(next_anchors, anchors):
+                return anchors
+            anchors = next_anchors
+
+    def get_branch_drift(self, regimes=None):
+        if not self.has_drift:
+            return None
+        if regimes is None:
+            regimes = self.get_regimes()
+        return self.drift_values[regimes]
+
+    def update_locations(self, random_state, pruning=None):
+        """Gibbs step of all node locations (jointly) given the parameters
+        (´pruning´: the `BrownianPruning` for the current parameters, if
+        already computed)."""
+        if pruning is None:
+            pruning = BrownianPruning(self.tree, rates=self.rates,
+                                      drift=self.get_branch_drift())
+        self.pruning = pruning
+        self.likelihood = self.pruning.log_likelihood(self.cov)
+        self.locations = self.pruning.sample_locations(
+            self.cov, random_state, root_prior_mean=self.root_prior_mean,
+            root_prior_sample_size=self.root_prior_sample_size)
+        self.steps = self.locations[1:] - self.locations[self.parents[1:]]
+
+    def branch_log_likelihoods(self, rates, branch_drift=None):
+        """Log density of the displacement along each branch, given the node
+        locations (vectorized over the branches).
+
+        Returns:
+            np.array: The log densities.
+                shape: (n_nodes - 1,)
+        """
+        times = np.maximum(self.times[1:], MIN_VARIANCE)
+        variances = rates * times
+        residuals = self.steps
+        if branch_drift is not None:
+            residuals = residuals - branch_drift * times[:, None]
+        precision = np.linalg.inv(self.cov)
+        mahalanobis_sq = np.einsum('ij,jk,ik->i', residuals, precision, residuals)
+        _, log_det = np.linalg.slogdet(self.cov)
+        return (-np.log(2. * np.pi) - np.log(variances) - log_det / 2.
+                - mahalanobis_sq / (2. * variances))
+
+    def update_precision(self, random_state):
+        """Gibbs step of the diffusion precision matrix (Wishart prior)."""
+        times = np.maximum(self.times[1:], MIN_VARIANCE)
+        residuals = self.steps
+        branch_drift = self.get_branch_drift()
+        if branch_drift is not None:
+            residuals = residuals - branch_drift[1:] * times[:, None]
+        z = residuals / np.sqrt(self.rates[1:] * times)[:, None]
+        scale = np.linalg.inv(np.linalg.inv(WISHART_SCALE) + z.T.dot(z))
+        precision = wishart.rvs(WISHART_DF + len(z), scale, random_state=random_state)
+        self.cov = np.linalg.inv(precision)
+
+    def rate_log_prior(self, rates, stdev):
+        """Log density of log-normal rate multipliers with mean 1."""
+        sigma2 = np.log(1. + stdev ** 2)
+        log_rates = np.log(rates)
+        return (-log_rates - np.log(2. * np.pi * sigma2) / 2.
+                - (log_rates + sigma2 / 2.) ** 2 / (2. * sigma2))
+
+    def update_rates(self, random_state):
+        """Independent Metropolis-Hastings steps of all rate multipliers (log
+        scale random walk), followed by two steps of their standard deviation:
+        one given the rates and one joint (non-centred) step of the standard
+        deviation and the rates (see `update_stdev_noncentred`)."""
+        branch_drift = self.get_branch_drift()
+        if branch_drift is not None:
+            branch_drift = branch_drift[1:]
+        rates = self.rates[1:]
+        proposal = rates * np.exp(RATE_PROPOSAL_SCALE * random_state.normal(size=len(rates)))
+
+        # The log(proposal / rates) term is the Jacobian of the log scale
+        log_ratio = (self.branch_log_likelihoods(proposal, branch_drift)
+                     - self.branch_log_likelihoods(rates, branch_drift)
+                     + self.rate_log_prior(proposal, self.stdev)
+                     - self.rate_log_prior(rates, self.stdev)
+                     + np.log(proposal / rates))
+        accept = np.log(random_state.uniform(size=len(rates))) < log_ratio
+        self.rates[1:] = np.where(accept, proposal, rates)
+
+        stdev = self.stdev * np.exp(STDEV_PROPOSAL_SCALE * random_state.normal())
+        log_ratio = (np.sum(self.rate_log_prior(self.rates[1:], stdev))
+                     - np.sum(self.rate_log_prior(self.rates[1:], self.stdev))
+                     + expon.logpdf(stdev, scale=RRW_STDEV_PRIOR_MEAN)
+                     - expon.logpdf(self.stdev, scale=RRW_STDEV_PRIOR_MEAN)
+                     + np.log(stdev / self.stdev))
+        if np.log(random_state.uniform()) < log_ratio:
+            self.stdev = stdev
+
+        self.update_stdev_noncentred(random_state)
+
+    def update_stdev_noncentred(self, random_state):
+        """Metropolis-Hastings steps of the standard deviation, which move all
+        rate multipliers along with it: the standardized log-rates
+        (log(r) + s^2 / 2) / s, with s^2 = log(1 + stdev^2), are kept fixed.
+        The steps are accepted on the likelihood with the internal node
+        locations integrated out, which are then resampled given the new
+        rates. Given the rates (and locations), the standard deviation is
+        pinned down by their prior, so the centred step alone barely moves it.
+        """
+        drift = self.get_branch_drift()
+        pruning = BrownianPruning(self.tree, rates=self.rates, drift=drift)
+        log_likelihood = self.marginal_log_likelihood(pruning)
+        accepted = False
+
+        for _ in range(NONCENTRED_STEPS_PER_SWEEP):
+            rates = self.rates[1:]
+            stdev = self.stdev * np.exp(NONCENTRED_PROPOSAL_SCALE * random_state.normal())
+            s_old = np.sqrt(np.log(1. + self.stdev ** 2))
+            s_new = np.sqrt(np.log(1. + stdev ** 2))
+            proposal = np.exp(-s_new ** 2 / 2. + (np.log(rates) + s_old ** 2 / 2.) * s_new / s_old)
+
+            new_rates = np.append(self.rates[:1], proposal)
+            new_pruning = BrownianPruning(self.tree, rates=new_rates, drift=drift)
+            new_log_likelihood = self.marginal_log_likelihood(new_pruning)
+
+            # Jacobians of the log scale step of the standard deviation and of
+            # the mapping of the rates (d proposal / d rates = proposal / rates * s_new / s_old)
+            log_ratio = (new_log_likelihood - log_likelihood
+                         + np.sum(self.rate_log_prior(proposal, stdev))
+                         - np.sum(self.rate_log_prior(rates, self.stdev))
+                         + expon.logpdf(stdev, scale=RRW_STDEV_PRIOR_MEAN)
+                         - expon.logpdf(self.stdev, scale=RRW_STDEV_PRIOR_MEAN)
+                         + np.log(stdev / self.stdev)
+                         + np.sum(np.log(proposal / rates)) + len(rates) * np.log(s_new / s_old))
+            if np.log(random_state.uniform()) < log_ratio:
+                self.stdev = stdev
+                self.rates = new_rates
+                pruning, log_likelihood = new_pruning, new_log_likelihood
+                accepted = True
+
+        if accepted:
+            self.update_locations(random_state, pruning=pruning)
+
+    def marginal_log_likelihood(self, pruning):
+        """Log likelihood of the leaf locations with the internal node
+        locations integrated out, including the conjugate root prior."""
+        log_likelihood = pruning.log_likelihood(self.cov)
+        if self.root_prior_sample_size > 0:
+            root_var = pruning.partial_vars[0] + 1. / self.root_prior_sample_size
+            log_likelihood += multivariate_normal.logpdf(
+                pruning.partial_means[0], self.root_prior_mean, self.cov * root_var)
+        return log_likelihood
+
+    def update_drift(self, random_state):
+        """Gibbs step of the drift of every regime (normal prior), given the
+        node locations (sufficient statistics collected with bincount)."""
+        regimes = self.get_regimes()[1:]
+        times = np.maximum(self.times[1:], MIN_VARIANCE)
+        weights = times / self.rates[1:]
+        displacements = self.steps / self.rates[1:, None]
+
+        precision = np.linalg.inv(self.cov)
+        prior_precision = np.eye(2) / self.drift_prior_std ** 2
+        regime_weights = np.bincount(regimes, weights=weights, minlength=self.n_nodes)
+        regime_sums = np.stack([
+            np.bincount(regimes, weights=displacements[:, k], minlength=self.n_nodes)
+            for k in range(2)], axis=-1)
+
+        active = np.nonzero(self.changes)[0].tolist()
+        for k in [0] + active:
+            posterior_precision = precision * regime_weights[k] + prior_precision
+            posterior_cov = np.linalg.inv(posterior_precision)
+            mean = posterior_cov.dot(precision.dot(regime_sums[k]))
+            self.drift_values[k] = random_state.multivariate_normal(mean, posterior_cov)
+
+    def update_drift_changes(self, random_state):
+        """Bit-flip Metropolis-Hastings steps of the drift change indicators.
+        The drift of a new regime is proposed from its prior, so the acceptance
+        ratio reduces to likelihood and Poisson prior ratios."""
+        for _ in range(DRIFT_FLIPS_PER_SWEEP):
+            i = random_state.randint(1, self.n_nodes)
+            n_changes = np.sum(self.changes)
+            old_drift = self.drift_values[i].copy()
+            log_likelihood = np.sum(self.branch_log_likelihoods(
+                self.rates[1:], self.get_branch_drift()[1:]))
+
+            self.changes[i] = not self.changes[i]
+            if self.changes[i]:
+                self.drift_values[i] = self.drift_prior_std * random_state.normal(size=2)
+            new_log_likelihood = np.sum(self.branch_log_likelihoods(
+                self.rates[1:], self.get_branch_drift()[1:]))
+
+            log_ratio = (new_log_likelihood - log_likelihood
+                         + poisson.logpmf(np.sum(self.changes), self.drift_changes_prior_mean)
+                         - poisson.logpmf(n_changes, self.drift_changes_prior_mean))
+            if np.log(random_state.uniform()) >= log_ratio:
+                self.changes[i] = not self.changes[i]
+                self.drift_values[i] = old_drift
+
+    def sweep(self, random_state):
+        """One update of all parameters, followed by the node locations."""
+        self.update_precision(random_state)
+        if self.relaxed:
+            self.update_rates(random_state)
+        if self.movement_model == 'rdrw':
+            self.update_drift_changes(random_state)
+        if self.has_drift:
+            self.update_drift(random_state)
+        self.update_locations(random_state)
+
+    def log_prior(self):
+        prior = wishart.logpdf(np.linalg.inv(self.cov), WISHART_DF, WISHART_SCALE)
+        if self.relaxed:
+            prior += expon.logpdf(self.stdev, scale=RRW_STDEV_PRIOR_MEAN)
+            prior += np.sum(self.rate_log_prior(self.rates[1:], self.stdev))
+        if self.has_drift:
+            regimes = [0] + np.nonzero(self.changes)[0].tolist()
+            prior += np.sum(norm.logpdf(self.drift_values[regimes], scale=self.drift_prior_std))
+        if self.movement_model == 'rdrw':
+            prior += poisson.logpmf(np.sum(self.changes), self.drift_changes_prior_mean)
+        return prior
+
+    def get_log_values(self, state, root_height, total_time):
+        prior = self.log_prior()
+        precision = np.linalg.inv(self.cov)
+        distances = np.hypot(self.steps[:, 0], self.steps[:, 1])
+        values = {
+            'state': state, 'posterior': self.likelihood + prior, 'prior': prior,
+            'likelihood': self.likelihood, 'treeModel.rootHeight': root_height,
+            'clock.rate': 1.0, 'meanRate': 1.0,
+            'location.correlation': self.cov[0, 1] / np.sqrt(self.cov[0, 0] * self.cov[1, 1]),
+            'location.stdev': self.stdev,
+            'location.diffusionRate': np.sum(distances) / total_time,
+            'location.traitLikelihood': self.likelihood,
+        }
+        for i in range(2):
+            for j in range(2):
+                values['location.precision%i%i' % (i + 1, j + 1)] = precision[i, j]
+                values['location.varCovar%i%i' % (i + 1, j + 1)] = self.cov[i, j]
+        for k in range(2):
+            values[DRIFT_COLUMNS[k]] = self.drift_values[0, k]
+            values[DRIFT_CHANGES_COLUMNS[k]] = np.sum(self.changes)
+        return values
+
+    def get_log_columns(self):
+        columns = list(LOG_COLUMNS)
+        if not self.relaxed:
+            columns.remove('location.stdev')
+        if self.has_drift:
+            columns[-2:-2] = DRIFT_COLUMNS
+        if self.movement_model == 'rdrw':
+            columns[-2:-2] = DRIFT_CHANGES_COLUMNS
+        return columns
+
+    def run(self, output_dir='.', seed=None, n_samples=None, log_fname=LOG_FNAME,
+            trees_fname=TREES_FNAME, ops_fname='nowhere.ops', out=sys.stdout):
+        """Run the chain and write the samples to the `.log` and `.trees`
+        files (see `BeastStandin.run` for the arguments).
+
+        Returns:
+            int: The last state of the chain.
+        """
+        start = time.time()
+        if seed is None:
+            seed = int(self.xml_hash[:8], 16)
+        random_state = np.random.RandomState(seed)
+
+        chain_length = self.chain_length
+        if n_samples is not None:
+            chain_length = (n_samples - 1) * self.tree_log_every
+        log_every = min(self.log_every, self.tree_log_every)
+
+        self.init_state(random_state)
+        root_height = self.tree.height()
+        total_time = np.sum(self.times[1:])
+        column_names = self.get_log_columns()
+
+        log_path = os.path.join(output_dir, log_fname)
+        trees_path = os.path.join(output_dir, trees_fname)
+        with open(log_path, 'w') as log_file, open(trees_path, 'w') as trees_file:
+            self.write_log_header(log_file, column_names, seed, MCMC_VERSION)
+            self.write_trees_header(trees_file)
+            print('# %s\n# Random number seed: %i' % (MCMC_VERSION, seed), file=out)
+
+            for state in range(0, chain_length + 1, log_every):
+                if state > 0:
+                    for _ in range(self.sweeps_per_sample):
+                        self.sweep(random_state)
+
+                values = self.get_log_values(state, root_height, total_time)
+                log_file.write('\t'.join(str(values[c]) for c in column_names) + '\n')
+
+                if state % self.tree_log_every == 0:
+                    trees_file.write('tree STATE_%i [&lnP=%r,posterior=%r] = [&R] '
+                                     % (state, float(values['posterior']),
+                                        float(values['posterior'])))
+                    self.write_sample_newick(trees_file, self.pruning, self.locations,
+                                             self.rates if self.relaxed else None)
+                    trees_file.write(';\n')
+                    log_file.flush()
+                    trees_file.flush()
+
+                if state % (10 * self.tree_log_every) == 0:
+                    print('%i\t%.4f' % (state, values['posterior']), file=out)
+
+            trees_file.write('End;\n')
+
+        with open(os.path.join(output_dir, ops_fname), 'w') as ops_file:
+            ops_file.write('Operator analysis\n(Gibbs sweeps, %i per logged state)\n'
+                           % self.sweeps_per_sample)
+
+        self.runtime = time.time() - start
+        self.ess = chain_ess(log_path, trees_path, burnin=chain_length // 10)
+        for key, ess in self.ess.items():
+            print('ESS(%s) = %.1f (%.1f / s)' % (key, ess, ess / self.runtime), file=out)
+
+        return state
+
+
+def chain_ess(log_path, trees_path, burnin=0, ess_keys=None):
+    """The ESS of the monitored parameters of a (BEAST or native) MCMC run,
+    read from its `.log` and `.trees` files. Default: `DEFAULT_ESS_KEYS` and
+    the `MODEL_ESS_KEYS` in the `.log` file."""
+    monitor = ChainMonitor(log_path, trees_path, burnin=burnin,
+                           ess_keys=ess_keys or DEFAULT_ESS_KEYS)
+    monitor.update()
+    if ess_keys is None:
+        monitor.ess_keys += [key for key in MODEL_ESS_KEYS
+                             if key in (monitor.log_header or [])]
+    return monitor.get_ess()
+
+
+def ess_per_second(log_path, trees_path, runtime, burnin=0, ess_keys=None):
+    """The effective samples per second of the monitored parameters of a
+    (BEAST or native) MCMC run.
+
+    Args:
+        log_path (str): Path of the `.log` file.
+        trees_path (str): Path of the `.trees` file.
+        runtime (float): Wall time of the run in seconds.
+        burnin (int): Number of MCMC states to be discarded.
+        ess_keys (list[str]): The parameters (default: see `chain_ess`).
+
+    Returns:
+        dict: ESS / runtime for every monitored parameter.
+    """
+    ess = chain_ess(log_path, trees_path, burnin=burnin, ess_keys=ess_keys)
+    return {key: e / runtime for key, e in ess.items()}
+
+
+def compare_ess_per_second(beast_dir, beast_runtime, mcmc_dir, mcmc_runtime, burnin=0,
+                           ess_keys=None):
+    """Compare the sampling efficiency of a BEAST run and a native run of the
+    same analysis (e.g. with runtimes from `BeastJobResult.runtime`).
+
+    Returns:
+        dict: For every monitored parameter (default: see `chain_ess`, logged
+            by both runs), the ESS per second of BEAST and of the native MCMC
+            and their ratio (speed-up).
+    """
+    beast = ess_per_second(os.path.join(beast_dir, LOG_FNAME),
+                           os.path.join(beast_dir, TREES_FNAME),
+                           beast_runtime, burnin=burnin, ess_keys=ess_keys)
+    native = ess_per_second(os.path.join(mcmc_dir, LOG_FNAME),
+                            os.path.join(mcmc_dir, TREES_FNAME),
+                            mcmc_runtime, burnin=burnin, ess_keys=ess_keys)
+    return {key: {'beast': beast[key], 'native': native[key],
+                  'speedup': native[key] / beast[key]}
+            for key in native if key in beast}
+
+
+if __name__ == '__main__':
+    main(analysis_class=DiffusionMCMC, version=MCMC_VERSION)
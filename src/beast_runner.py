@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+import os
+import time
+import shutil
+import asyncio
+import logging
+import resource
+import tempfile
+from collections import deque
+
+import numpy as np
+
+from src.diagnostics import effective_sample_size
+from src.tree import parse_root_location
+from src.util import SubprocessException
+
+BEAST_LOGGER = logging.getLogger('beast')
+EXPERIMENT_LOGGER = logging.getLogger('experiment')
+
+BEAST_COMMAND = 'beast'
+XML_FNAME = 'nowhere.xml'
+LOG_FNAME = 'nowhere.log'
+TREES_FNAME = 'nowhere.trees'
+OUTPUT_FNAMES = [TREES_FNAME, LOG_FNAME, 'nowhere.ops']
+
+# Parameters monitored for early stopping (columns of the .log file, and the
+# root location from the .trees file)
+ROOT_X = 'root_x'
+ROOT_Y = 'root_y'
+DEFAULT_ESS_KEYS = ['likelihood', 'location.diffusionRate', ROOT_X, ROOT_Y]
+DEFAULT_POLL_INTERVAL = 10.  # seconds
+RESOURCE_POLL_INTERVAL = 1.  # seconds
+OUTPUT_TAIL_LINES = 100  # Lines of BEAST output kept for error reporting
+
+PROC_DIR = '/proc'
+
+
+class BeastJob(object):
+
+    """A single BEAST analysis, to be run in its own scratch directory.
+
+    Attributes:
+        xml_path (str): Path to the BEAST XML file of the analysis.
+        output_dir (str): Directory into which the outputs are collected.
+        name (str): Name of the job (used for logging and the scratch dir).
+        seed (int or None): Random seed passed to BEAST.
+        threads (int): Number of cores reserved for (and used by) the job.
+        beagle_instances (int or None): Number of BEAGLE instances (partitions
+            of the likelihood computation). Default: BEAST's choice.
+        output_fnames (list[str]): Names of the output files to be collected.
+        ess_threshold (float or None): If given, the chain is stopped as soon as
+            the ESS of all ´ess_keys´ (after burn-in) reaches this threshold.
+        burnin (int): Number of MCMC states ignored for the ESS.
+        ess_keys (list[str]): The monitored parameters.
+    """
+
+    def __init__(self, xml_path, output_dir, name=None, seed=None, threads=1,
+                 beagle_instances=None, output_fnames=OUTPUT_FNAMES,
+                 ess_threshold=None, burnin=0, ess_keys=DEFAULT_ESS_KEYS):
+        self.xml_path = os.path.abspath(xml_path)
+        self.output_dir = os.path.abspath(output_dir)
+        self.name = name or os.path.basename(os.path.normpath(output_dir))
+        self.seed = seed
+        self.threads = threads
+        self.beagle_instances = beagle_instances
+        self.output_fnames = list(output_fnames)
+        self.ess_threshold = ess_threshold
+        self.burnin = burnin
+        self.ess_keys = list(ess_keys)
+
+    def get_command(self, beast_command=BEAST_COMMAND):
+        command = [beast_command, '-overwrite']
+        if self.seed is not None:
+            command += ['-seed', str(self.seed)]
+        if self.threads > 1:
+            command += ['-threads', str(self.threads)]
+        if self.beagle_instances is not None:
+            command += ['-beagle_instances', str(self.beagle_instances)]
+        return command + [XML_FNAME]
+
+    def __repr__(self):
+        return 'BeastJob(%s)' % self.name
+
+
+class BeastJobResult(object):
+
+    """The outcome of a BeastJob.
+
+    Attributes:
+        job (BeastJob): The job.
+        returncode (int): Exit code of the BEAST process.
+        runtime (float): Wall time of the BEAST process in seconds.
+        output_paths (dict): Paths of the collected output files (by name).
+        stdout (str): The last lines of the standard output of BEAST.
+        stderr (str): The last lines of the standard error of BEAST.
+        stop_state (int or None): The last MCMC state written to the log.
+        stopped_early (bool): Whether the chain was stopped by the ESS criterion.
+        ess (dict): The ESS of the monitored parameters at the end of the run.
+        cpu_time (float): CPU time (user + system) of BEAST (incl. its child
+            processes) in seconds.
+        peak_rss (int): Peak resident memory of BEAST in bytes.
+    """
+
+    def __init__(self, job, returncode, runtime, output_paths, stdout='', stderr='',
+                 stop_state=None, stopped_early=False, ess=None, cpu_time=np.nan,
+                 peak_rss=np.nan):
+        self.job = job
+        self.returncode = returncode
+        self.runtime = runtime
+        self.output_paths = output_paths
+        self.stdout = stdout
+        self.stderr = stderr
+        self.stop_state = stop_state
+        self.stopped_early = stopped_early
+        self.ess = ess or {}
+        self.cpu_time = cpu_time
+        self.peak_rss = peak_rss
+
+    @property
+    def success(self):
+        return self.returncode == 0 or self.stopped_early
+
+
+class ChainMonitor(object):
+
+    """Follow the `.log` and `.trees` files of a running BEAST chain (reading
+    only what was appended since the last update) and compute the ESS of the
+    monitored parameters.
+
+    Attributes:
+        log_path (str): Path of the BEAST `.log` file.
+        trees_path (str): Path of the BEAST `.trees` file.
+        burnin (int): Number of MCMC states ignored for the ESS.
+        ess_keys (list[str]): The monitored parameters ('root_x' and 'root_y'
+            are read from the `.trees` file, all others from the `.log` file).
+        log_columns (dict): The values of each `.log` column read so far.
+        root_states (list[int]): The MCMC states of the trees read so far.
+        root_locations (list[np.array]): The root locations of these trees.
+    """
+
+    def __init__(self, log_path, trees_path, burnin=0, ess_keys=DEFAULT_ESS_KEYS):
+        self.log_path = log_path
+        self.trees_path = trees_path
+        self.burnin = burnin
+        self.ess_keys = list(ess_keys)
+
+        self.log_header = None
+        self.log_columns = {}
+        self.root_states = []
+        self.root_locations = []
+
+        self._positions = {log_path: 0, trees_path: 0}
+        self._buffers = {log_path: b'', trees_path: b''}
+
+    def _read_new_lines(self, path):
+        """Read the complete lines appended to ´path´ since the last call."""
+        if not os.path.exists(path):
+            return []
+        with open(path, 'rb') as f:
+            f.seek(self._positions[path])
+            data = self._buffers[path] + f.read()
+            self._positions[path] = f.tell()
+
+        data, _, self._buffers[path] = data.rpartition(b'\n')
+        if not data:
+            return []
+        return data.decode().splitlines()
+
+    def update(self):
+        """Read the new samples from the `.log` and `.trees` files."""
+        for line in self._read_new_lines(self.log_path):
+            if not line.strip() or line.startswith('#'):
+                continue
+            values = line.strip().split('\t')
+            if self.log_header is None:
+                self.log_header = values
+                self.log_columns = {key: [] for key in values}
+            else:
+                for key, value in zip(self.log_header, values):
+                    self.log_columns[key].append(float(value))
+
+        for line in self._read_new_lines(self.trees_path):
+            line = line.strip().lower()
+            if not line.startswith('tree '):
+                continue
+            head, _, newick_str = line.partition(' = ')
+            _, _, state_str = head.split()[1].rpartition('_')
+            self.root_states.append(int(state_str))
+            self.root_locations.append(parse_root_location(newick_str))
+
+    @property
+    def last_state(self):
+        states = self.log_columns.get('state', [])
+        if len(states) == 0:
+            return None
+        return int(states[-1])
+
+    def get_samples(self, key):
+        """The samples of a monitored parameter after burn-in."""
+        if key in (ROOT_X, ROOT_Y):
+            states = np.array(self.root_states)
+            locations = np.array(self.root_locations).reshape((-1, 2))
+            values = locations[:, 0 if key == ROOT_X else 1]
+        else:
+            states = np.array(self.log_columns.get('state', []))
+            values = np.array(self.log_columns.get(key, []))
+        return values[states[:len(values)] >= self.burnin]
+
+    def get_ess(self):
+        """Compute the ESS of all monitored parameters (NaN if not available)."""
+        return {key: effective_sample_size(self.get_samples(key))
+                for key in self.ess_keys}
+
+    def converged(self, ess_threshold):
+        """Check whether the ESS of all monitored parameters reached the
+        threshold."""
+        ess = self.get_ess()
+        return all(e >= ess_threshold for e in ess.values())
+
+
+def read_proc_stats():
+    """Read the parent pid, CPU time and resident memory of all processes from
+    `/proc` (Linux only). The CPU time includes the terminated children that
+    the process waited for.
+
+    Returns:
+        dict: Mapping from pid to (ppid, cpu_time [s], rss [bytes]).
+    """
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    stats = {}
+    for entry in os.listdir(PROC_DIR):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join(PROC_DIR, entry, 'stat'), 'r') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            # The process terminated in the meantime
+            continue
+
+        # The command name (2nd field) may contain spaces, so split after it
+        fields = stat.rpartition(')')[2].split()
+        ppid = int(fields[1])
+        cpu_time = sum(int(f) for f in fields[11:15]) / clock_ticks
+        rss = int(fields[21]) * page_size
+        stats[int(entry)] = (ppid, cpu_time, rss)
+    return stats
+
+
+class ResourceMonitor(object):
+
+    """Sample the CPU time and resident memory of a process and all its
+    descendants (e.g. the JVM started by the `beast` script) from `/proc`.
+    The CPU time of a terminated descendant is counted in the CPU time of its
+    parent (which waited for it). The CPU time of the last interval before the
+    process terminated is not observed (see `children_cpu_time` for the exact
+    total).
+
+    Attributes:
+        pid (int): The pid of the monitored process.
+        cpu_times (dict): Last observed CPU time of every running process.
+        peak_rss (int): The maximal total resident memory observed (bytes).
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.cpu_times = {}
+        self.peak_rss = 0
+
+    @property
+    def available(self):
+        return os.path.isdir(PROC_DIR) and hasattr(os, 'sysconf')
+
+    def sample(self):
+        stats = read_proc_stats()
+        if self.pid not in stats:
+            # Terminated: keep the last sample
+            return
+        children = {}
+        for pid, (ppid, _, _) in stats.items():
+            children.setdefault(ppid, []).append(pid)
+
+        cpu_times = {}
+        total_rss = 0
+        stack = [self.pid]
+        while stack:
+            pid = stack.pop()
+            if pid not in stats:
+                continue
+            _, cpu_time, rss = stats[pid]
+            cpu_times[pid] = cpu_time
+            total_rss += rss
+            stack += children.get(pid, [])
+
+        self.cpu_times = cpu_times
+        self.peak_rss = max(self.peak_rss, total_rss)
+
+    @property
+    def cpu_time(self):
+        return sum(self.cpu_times.values())
+
+
+def children_cpu_time():
+    """CPU time (user + system) of all terminated children of this process that
+    were waited for (and, recursively, of their waited-for children)."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def finalize_trees_file(trees_path):
+    """Make a `.trees` file of a stopped chain valid: remove a partially written
+    last line and close the trees block."""
+    if not os.path.exists(trees_path):
+        return
+    with open(trees_path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b';\n')
+        f.seek(end + 2 if end >= 0 else len(data))
+        f.truncate()
+        f.write(b'End;\n')
+
+
+class BeastJobRunner(object):
+
+    """Run several BEAST analyses concurrently (as asyncio subprocesses), each
+    in an isolated scratch directory, such that the total number of cores
+    reserved by running jobs never exceeds ´max_cores´.
+
+    Attributes:
+        max_cores (int): The maximum number of cores used at once.
+        scratch_root (str or None): Directory in which the scratch directories
+            are created (default: the system temp directory).
+        beast_command (str): The BEAST executable.
+        keep_scratch (bool): Keep the scratch directories (for debugging).
+        poll_interval (float): Seconds between two convergence checks.
+    """
+
+    def __init__(self, max_cores=None, scratch_root=None, beast_command=BEAST_COMMAND,
+                 keep_scratch=False, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.max_cores = max_cores or os.cpu_count() or 1
+        self.scratch_root = scratch_root
+        self.beast_command = beast_command
+        self.keep_scratch = keep_scratch
+        self.poll_interval = poll_interval
+
+    def run(self, jobs, raise_on_error=False):
+        """Run all ´jobs´ and wait for them to finish.
+
+        Returns:
+            list[BeastJobResult]: The results (in the order of ´jobs´).
+        """
+        results = asyncio.run(self._run_all(list(jobs)))
+
+        failed = [r for r in results if not r.success]
+        if failed and raise_on_error:
+            raise SubprocessException('BEAST failed in jobs: %s' % failed)
+        return results
+
+    async def _run_all(self, jobs):
+        free_cores = asyncio.Condition()
+        self._n_free_cores = self.max_cores
+        # Whether each running job overlapped with another one (see `_run_in_scratch_dir`)
+        self._overlapped = {}
+        return await asyncio.gather(*[self._run_job(job, free_cores) for job in jobs])
+
+    async def _run_job(self, job, free_cores):
+        n_cores = min(job.threads, self.max_cores)
+
+        # Reserve the cores for this job
+        async with free_cores:
+            await free_cores.wait_for(lambda: self._n_free_cores >= n_cores)
+            self._n_free_cores -= n_cores
+
+        try:
+            return await self._run_in_scratch_dir(job)
+        finally:
+            async with free_cores:
+                self._n_free_cores += n_cores
+                free_cores.notify_all()
+
+    async def _run_in_scratch_dir(self, job):
+        if self.scratch_root is not None:
+            os.makedirs(self.scratch_root, exist_ok=True)
+        scratch_dir = tempfile.mkdtemp(prefix='beast_%s_' % job.name,
+                                       dir=self.scratch_root)
+        try:
+            shutil.copy(job.xml_path, os.path.join(scratch_dir, XML_FNAME))
+
+            EXPERIMENT_LOGGER.info('\tBEAST job %s started' % job.name)
+            # The CPU time of the children reaped during the job is exactly the
+            # CPU time of BEAST, unless other jobs terminated in the meantime
+            children_cpu_before = children_cpu_time()
+            for key in self._overlapped:
+                self._overlapped[key] = True
+            self._overlapped[id(job)] = bool(self._overlapped)
+
+            t0 = time.time()
+            process = await asyncio.create_subprocess_exec(
+                *job.get_command(self.beast_command), cwd=scratch_dir,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+            monitor = ChainMonitor(os.path.join(scratch_dir, LOG_FNAME),
+                                   os.path.join(scratch_dir, TREES_FNAME),
+                                   burnin=job.burnin, ess_keys=job.ess_keys)
+            resources = ResourceMonitor(process.pid)
+            stdout, stderr, stopped_early, _ = await asyncio.gather(
+                stream_lines(process.stdout, job.name),
+                stream_lines(process.stderr, job.name),
+                self._monitor_chain(job, process, monitor),
+                monitor_resources(process, resources))
+            await process.wait()
+            runtime = time.time() - t0
+            beast_cpu_time = children_cpu_time() - children_cpu_before
+            ran_alone = not self._overlapped.pop(id(job))
+
+            monitor.update()
+            if stopped_early:
+                finalize_trees_file(os.path.join(scratch_dir, TREES_FNAME))
+            ess = monitor.get_ess()
+            cpu_time, peak_rss = np.nan, np.nan
+            if resources.available:
+                cpu_time, peak_rss = resources.cpu_time, resources.peak_rss
+            if ran_alone:
+                cpu_time = beast_cpu_time
+            EXPERIMENT_LOGGER.info('\tBEAST job %s runtime: %.2f, CPU time: %.2f, '
+                                   'peak RSS: %.1f MB (stopped at state %s)'
+                                   % (job.name, runtime, cpu_time, peak_rss / 2 ** 20,
+                                      monitor.last_state))
+
+            output_paths = collect_outputs(scratch_dir, job.output_dir,
+                                           job.output_fnames)
+            return BeastJobResult(job, process.returncode, runtime, output_paths,
+                                  stdout=stdout, stderr=stderr,
+                                  stop_state=monitor.last_state,
+                                  stopped_early=stopped_early, ess=ess,
+                                  cpu_time=cpu_time, peak_rss=peak_rss)
+        finally:
+            self._overlapped.pop(id(job), None)
+            if not self.keep_scratch:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    async def _monitor_chain(self, job, process, monitor):
+        """Periodically check the ESS of the running chain and terminate BEAST
+        once all monitored parameters reached the threshold.
+
+        Returns:
+            bool: Whether the chain was stopped early.
+        """
+        if job.ess_threshold is None:
+            return False
+
+        while process.returncode is None:
+            try:
+                await asyncio.wait_for(process.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                return False
+
+            monitor.update()
+            ess = monitor.get_ess()
+            EXPERIMENT_LOGGER.debug('\tBEAST job %s at state %s, ESS: %s'
+                                    % (job.name, monitor.last_state, ess))
+            if monitor.converged(job.ess_threshold):
+                EXPERIMENT_LOGGER.info('\tBEAST job %s converged at state %s'
+                                       % (job.name, monitor.last_state))
+                process.terminate()
+                return True
+
+        return False
+
+
+async def monitor_resources(process, resources,
+                            poll_interval=RESOURCE_POLL_INTERVAL):
+    """Sample the resource usage of a running process until it terminates."""
+    if not resources.available:
+        return
+    while process.returncode is None:
+        resources.sample()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def stream_lines(stream, name, tail_lines=OUTPUT_TAIL_LINES):
+    """Forward the lines of a subprocess output stream to the BEAST logger as
+    they arrive. Only the last ´tail_lines´ lines are kept in memory.
+
+    Returns:
+        str: The last ´tail_lines´ lines of the output.
+    """
+    lines = deque(maxlen=tail_lines)
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        line = line.decode()
+        lines.append(line)
+        BEAST_LOGGER.info('[%s] %s' % (name, line.rstrip()))
+    return ''.join(lines)
+
+
+def collect_outputs(scratch_dir, output_dir, output_fnames):
+    """Move the output files of a run from its scratch directory to the output
+    directory.
+
+    Returns:
+        dict: The paths of the collected files (missing files are skipped).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_paths = {}
+    for fname in output_fnames:
+        path = os.path.join(scratch_dir, fname)
+        if os.path.exists(path):
+            output_paths[fname] = shutil.move(path, os.path.join(output_dir, fname))
+    return output_paths
+
+
+def run_beast_jobs(jobs, max_cores=None, scratch_root=None, raise_on_error=True):
+    """Run several BEAST jobs concurrently (see `BeastJobRunner`)."""
+    runner = BeastJobRunner(max_cores=max_cores, scratch_root=scratch_root)
+    return runner.run(jobs, raise_on_error=raise_on_error)
@@ -0,0 +1,6 @@
+#!/usr/bin/env bash
+# Drop-in replacement for the `beast` executable, running the local stand-in
+# (src/beast_standin.py) from any working directory.
+
+ROOT_DIR=$(cd "$(dirname "$0")/../.." && pwd)
+PYTHONPATH="$ROOT_DIR:$PYTHONPATH" exec "${PYTHON:-python3}" -m src.beast_standin "$@"
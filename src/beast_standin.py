@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+import os
+import re
+import sys
+import time
+import hashlib
+import argparse
+import datetime
+
+import numpy as np
+
+from src.brownian import BrownianPruning
+from src.tree import Tree
+
+STANDIN_VERSION = 'BEAST v1.10.4 (local stand-in, src.beast_standin)'
+
+TAXON_PATTERN = re.compile(
+    r'<taxon id="(?P<id>[^"]+)">\s*<date value="(?P<age>[^"]+)"[^>]*/>\s*'
+    r'<attr name="location">\s*(?P<x>\S+)\s+(?P<y>\S+)\s*</attr>')
+NEWICK_PATTERN = re.compile(r'<newick id="startingTree"[^>]*>\s*(.*?)\s*</newick>', re.DOTALL)
+CHAIN_LENGTH_PATTERN = re.compile(r'<mcmc [^>]*chainLength="(\d+)"')
+LOG_EVERY_PATTERN = re.compile(r'<log id="fileLog" logEvery="(\d+)"')
+TREE_LOG_EVERY_PATTERN = re.compile(r'<logTree id="treeFileLog" logEvery="(\d+)"')
+ROOT_PRIOR_PATTERN = re.compile(
+    r'<conjugateRootPrior>\s*<meanParameter>\s*<parameter value="([^"]+)"/>.*?'
+    r'<priorSampleSize>\s*<parameter value="([^"]+)"/>', re.DOTALL)
+RRW_STDEV_PATTERN = re.compile(r'<parameter id="location.stdev" value="([^"]+)"')
+DRIFT_PRIOR_PATTERN = re.compile(
+    r'<normalPrior mean="[^"]+" stdev="([^"]+)"[^>]*>\s*<parameter idref="driftModels.1.rates"/>')
+DRIFT_CHANGES_PRIOR_PATTERN = re.compile(
+    r'<poissonPrior mean="([^"]+)"[^>]*>\s*<sum idref="trendChanges.1"/>')
+
+LOG_COLUMNS = ['state', 'posterior', 'prior', 'likelihood', 'treeModel.rootHeight',
+               'clock.rate', 'meanRate', 'location.precision11', 'location.precision12',
+               'location.precision21', 'location.precision22', 'location.correlation',
+               'location.varCovar11', 'location.varCovar12', 'location.varCovar21',
+               'location.varCovar22', 'location.stdev', 'location.diffusionRate',
+               'location.traitLikelihood']
+
+
+class BeastAnalysis(object):
+
+    """The model and MCMC settings of a BEAST XML file of this project (as
+    written by `Tree.write_beast_xml`), with writers for the BEAST 1.10
+    output formats. Base class of the local replacements for BEAST.
+
+    Attributes:
+        tree (Tree): The starting tree with the leaf locations.
+        movement_model (str): 'brownian', 'rrw', 'cdrw' or 'rdrw'.
+        chain_length (int): Length of the MCMC chain.
+        log_every (int): Logging interval of the `.log` file.
+        tree_log_every (int): Logging interval of the `.trees` file.
+        root_prior_mean (np.array): Mean of the conjugate root prior.
+            shape: (2,)
+        root_prior_sample_size (float): Sample size of the conjugate root prior.
+        rrw_stdev (float or None): Standard deviation of the log-normal branch
+            rates (None for homogeneous Brownian motion).
+        drift_prior_std (float or None): Standard deviation of the normal
+            prior on the drift rates (None without drift).
+        drift_changes_prior_mean (float or None): Mean of the Poisson prior on
+            the number of drift changes (only for 'rdrw').
+    """
+
+    def __init__(self, xml_path):
+        with open(xml_path, 'r') as xml_file:
+            xml_str = xml_file.read()
+        self.xml_hash = hashlib.sha256(xml_str.encode()).hexdigest()
+
+        locations = {}
+        for m in TAXON_PATTERN.finditer(xml_str):
+            locations[m.group('id')] = np.array([float(m.group('x')), float(m.group('y'))])
+
+        newick = NEWICK_PATTERN.search(xml_str).group(1)
+        self.tree = Tree.from_newick(newick.strip().rstrip(';'), with_attributes=False)
+        for leaf in self.tree.iter_leafs():
+            leaf.location = locations[leaf.name]
+
+        self.chain_length = int(CHAIN_LENGTH_PATTERN.search(xml_str).group(1))
+        self.log_every = int(LOG_EVERY_PATTERN.search(xml_str).group(1))
+        self.tree_log_every = int(TREE_LOG_EVERY_PATTERN.search(xml_str).group(1))
+
+        root_prior = ROOT_PRIOR_PATTERN.search(xml_str)
+        self.root_prior_mean = np.array([float(v) for v in root_prior.group(1).split()])
+        self.root_prior_sample_size = float(root_prior.group(2))
+
+        rrw_stdev = RRW_STDEV_PATTERN.search(xml_str)
+        self.rrw_stdev = float(rrw_stdev.group(1)) if rrw_stdev else None
+
+        drift_prior = DRIFT_PRIOR_PATTERN.search(xml_str)
+        self.drift_prior_std = float(drift_prior.group(1)) if drift_prior else None
+        drift_changes_prior = DRIFT_CHANGES_PRIOR_PATTERN.search(xml_str)
+        self.drift_changes_prior_mean = None
+        if drift_changes_prior:
+            self.drift_changes_prior_mean = float(drift_changes_prior.group(1))
+
+        if self.drift_changes_prior_mean is not None:
+            self.movement_model = 'rdrw'
+        elif self.drift_prior_std is not None:
+            self.movement_model = 'cdrw'
+        elif self.rrw_stdev is not None:
+            self.movement_model = 'rrw'
+        else:
+            self.movement_model = 'brownian'
+
+        self.taxa = sorted(locations.keys())
+        self.translate = {name: str(i + 1) for i, name in enumerate(self.taxa)}
+
+    def write_log_header(self, out, column_names, seed, version):
+        """Write the comment lines and the column names of a BEAST `.log`
+        file."""
+        out.write('# %s\n' % version)
+        out.write('# Generated %s\n' % datetime.datetime.now().ctime())
+        out.write('# -seed %i\n' % seed)
+        out.write('\t'.join(column_names) + '\n')
+
+    def write_trees_header(self, out):
+        """Write the taxa block and the translate table of a BEAST `.trees`
+        file."""
+        out.write('#NEXUS\n\n')
+        out.write('Begin taxa;\n\tDimensions ntax=%i;\n\tTaxlabels\n' % len(self.taxa))
+        for name in self.taxa:
+            out.write('\t\t%s\n' % name)
+        out.write('\t\t;\nEnd;\n\n')
+        out.write('Begin trees;\n\tTranslate\n')
+        out.write(',\n'.join('\t\t%s %s' % (self.translate[name], name)
+                             for name in self.taxa))
+        out.write('\n\t\t;\n')
+
+    def write_sample_newick(self, out, pruning, locations, rates=None):
+        """Write one posterior sample as a Newick string in BEAST's dialect
+        (location attributes on the nodes, rate attributes on the branches)."""
+        # Stack of (node index, is_closing) pairs, as in `write_newick`
+        stack = [(0, False)]
+        while stack:
+            i, is_closing = stack.pop()
+
+            if i is None:
+                out.write(',')
+                continue
+            if not is_closing and pruning.children[i]:
+                out.write('(')
+                stack.append((i, True))
+                for j in range(len(pruning.children[i]) - 1, -1, -1):
+                    stack.append((pruning.children[i][j], False))
+                    if j > 0:
+                        stack.append((None, False))
+                continue
+
+            if is_closing:
+                out.write(')')
+            else:
+                out.write(self.translate[pruning.nodes[i].name])
+            out.write('[&location={%r,%r}]' % (float(locations[i, 0]), float(locations[i, 1])))
+            if i > 0:
+                length = pruning.nodes[i].length
+                if rates is None:
+                    out.write(':[&rate=1.0]%r' % float(length))
+                else:
+                    out.write(':[&rate=1.0,location.rate=%r]%r'
+                              % (float(rates[i]), float(length)))
+
+
+class BeastStandin(BeastAnalysis):
+
+    """A deterministic local stand-in for BEAST, to run and benchmark the
+    python side of the pipeline (`run_beast` -> `evaluate`) without a Java BEAST
+    install. It writes `.trees`, `.log` and `.ops` files in the dialect of BEAST
+    1.10, with as many samples as the real analysis. The samples are exact
+    draws from the posterior of (relaxed) Brownian motion on the fixed starting
+    tree (see `src.brownian`): the root posterior is realistic, but topology and
+    node heights are not sampled, drift is ignored and there is no burn-in
+    phase.
+    """
+
+    def sample_rates(self, n_nodes, random_state):
+        """Sample the per-branch rate multipliers (log-normal with mean 1)."""
+        if self.rrw_stdev is None:
+            return np.ones(n_nodes)
+        sigma2 = np.log(1. + self.rrw_stdev ** 2)
+        return random_state.lognormal(-sigma2 / 2., np.sqrt(sigma2), size=n_nodes)
+
+    def run(self, output_dir='.', seed=None, n_samples=None, log_fname='nowhere.log',
+            trees_fname='nowhere.trees', ops_fname='nowhere.ops', out=sys.stdout):
+        """Write the posterior samples to the `.log` and `.trees` files.
+
+        Kwargs:
+            output_dir (str): Directory of the output files.
+            seed (int): Random seed (default: derived from the XML content, so
+                that repeated runs of the same analysis give the same output).
+            n_samples (int): Number of trees to be written (default: as many
+                as BEAST would write, chainLength / logEvery + 1).
+            out (file): Stream for the progress messages.
+
+        Returns:
+            int: The last state of the chain.
+        """
+        if seed is None:
+            seed = int(self.xml_hash[:8], 16)
+        random_state = np.random.RandomState(seed)
+
+        chain_length = self.chain_length
+        if n_samples is not None:
+            chain_length = (n_samples - 1) * self.tree_log_every
+        log_every = min(self.log_every, self.tree_log_every)
+
+        pruning = BrownianPruning(self.tree)
+        rates = None
+        root_height = self.tree.height()
+        total_time = np.sum(pruning.lengths[1:])
+        column_names = LOG_COLUMNS
+        if self.rrw_stdev is None:
+            column_names = [c for c in LOG_COLUMNS if c != 'location.stdev']
+
+        log_path = os.path.join(output_dir, log_fname)
+        trees_path = os.path.join(output_dir, trees_fname)
+        with open(log_path, 'w') as log_file, open(trees_path, 'w') as trees_file:
+            self.write_log_header(log_file, column_names, seed, STANDIN_VERSION)
+            self.write_trees_header(trees_file)
+            print('# %s\n# Random number seed: %i' % (STANDIN_VERSION, seed), file=out)
+
+            for state in range(0, chain_length + 1, log_every):
+                # Branch rates (and hence the pruning) only change between trees
+                if self.rrw_stdev is not None and state % self.tree_log_every == 0:
+                    rates = self.sample_rates(pruning.n_nodes, random_state)
+                    pruning = BrownianPruning(self.tree, rates=rates)
+
+                diffusion_rate = pruning.sample_diffusion_rate(random_state)
+                locations = pruning.sample_locations(
+                    diffusion_rate, random_state, root_prior_mean=self.root_prior_mean,
+                    root_prior_sample_size=self.root_prior_sample_size)
+
+                likelihood = pruning.log_likelihood(diffusion_rate)
+                prior = np.log(diffusion_rate)
+                posterior = likelihood + prior
+
+                steps = locations[1:] - locations[pruning.parents[1:]]
+                distances = np.hypot(steps[:, 0], steps[:, 1])
+                diffusion_stat = np.sum(distances) / total_time
+
+                values = {
+                    'state': state, 'posterior': posterior, 'prior': prior,
+                    'likelihood': likelihood, 'treeModel.rootHeight': root_height,
+                    'clock.rate': 1.0, 'meanRate': 1.0,
+                    'location.precision11': 1. / diffusion_rate, 'location.precision12': 0.,
+                    'location.precision21': 0., 'location.precision22': 1. / diffusion_rate,
+                    'location.correlation': 0.,
+                    'location.varCovar11': diffusion_rate, 'location.varCovar12': 0.,
+                    'location.varCovar21': 0., 'location.varCovar22': diffusion_rate,
+                    'location.stdev': self.rrw_stdev,
+                    'location.diffusionRate': diffusion_stat,
+                    'location.traitLikelihood': likelihood,
+                }
+                log_file.write('\t'.join(str(values[c]) for c in column_names) + '\n')
+
+                if state % self.tree_log_every == 0:
+                    trees_file.write('tree STATE_%i [&lnP=%r,posterior=%r] = [&R] '
+                                     % (state, float(posterior), float(posterior)))
+                    self.write_sample_newick(trees_file, pruning, locations, rates)
+                    trees_file.write(';\n')
+                    log_file.flush()
+                    trees_file.flush()
+
+                if state % (10 * self.tree_log_every) == 0:
+                    print('%i\t%.4f' % (state, posterior), file=out)
+
+            trees_file.write('End;\n')
+
+        with open(os.path.join(output_dir, ops_fname), 'w') as ops_file:
+            ops_file.write('Operator analysis\n(exact posterior samples, no operators)\n')
+
+        return state
+
+
+def main(args=None, analysis_class=BeastStandin, version=STANDIN_VERSION):
+    """Command line interface, compatible with the calls of the `beast`
+    executable in `src.beast_runner`:
+
+        python -m src.beast_standin [-seed SEED] [-samples N] nowhere.xml
+    """
+    parser = argparse.ArgumentParser(description='Local replacement for BEAST.')
+    parser.add_argument('xml_path', nargs='?', default=None)
+    parser.add_argument('-overwrite', action='store_true')
+    parser.add_argument('-seed', type=int, default=None)
+    parser.add_argument('-threads', type=int, default=1)
+    parser.add_argument('-beagle_instances', type=int, default=1)
+    parser.add_argument('-beagle_off', action='store_true')
+    parser.add_argument('-version', action='store_true')
+    parser.add_argument('-samples', type=int, default=None,
+                        help='Number of trees (default: chainLength / logEvery + 1).')
+    args = parser.parse_args(args)
+
+    if args.version:
+        print(version)
+        return
+    if args.xml_path is None:
+        parser.error('No XML file given.')
+
+    start = time.time()
+    analysis = analysis_class(args.xml_path)
+    state = analysis.run(output_dir=os.path.dirname(os.path.abspath(args.xml_path)),
+                        seed=args.seed, n_samples=args.samples)
+    print('%i states sampled in %.2f seconds' % (state, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+import logging
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+
+LOGGER = logging.getLogger('experiment')
+
+# Coefficients of the generating functions are extracted on a circle of radius
+# r < 1, such that the aliased mass (from counts >= n_fft) is damped by r^n_fft
+ALIASING_TOLERANCE = 1e-12
+FFT_OVERSAMPLING = 4
+N_CANDIDATES = 25
+CANDIDATE_RANGE = 4.
+
+
+def offspring_probabilities(birth_rate, death_rate, clock_rate=1., independent=False):
+    """The distribution of the number of lineages (0, 1 or 2) a lineage turns
+    into in one step of the simulation. In `State.step` a lineage first dies
+    with probability death_rate * clock_rate and otherwise splits with
+    probability birth_rate / clock_rate. With ´independent´ births and deaths
+    are drawn independently of each other (a lineage can split and die in the
+    same step).
+
+    Args:
+        birth_rate (float or np.array): The birth rate(s).
+        death_rate (float or np.array): The death rate(s).
+        clock_rate (float): The clock rate of the simulation.
+        independent (bool): Whether births and deaths are independent.
+
+    Returns:
+        np.array: The probabilities of 0, 1 and 2 lineages.
+            shape: (..., 3)
+    """
+    p_birth = np.asarray(birth_rate, dtype=float) / clock_rate
+    p_death = np.asarray(death_rate, dtype=float) * clock_rate
+    if independent:
+        p_0 = p_death * (1 - p_birth)
+        p_2 = p_birth * (1 - p_death)
+    else:
+        p_0 = p_death
+        p_2 = (1 - p_death) * p_birth
+    return np.stack([p_0, 1 - p_0 - p_2, p_2], axis=-1)
+
+
+def iterate_pgf(s, offspring, n_steps, offspring_last=None):
+    """Evaluate the probability generating function (pgf) of the number of
+    lineages descending from one lineage after ´n_steps´ steps, i.e. the
+    ´n_steps´-fold composition of the pgf of the offspring distribution.
+
+    Args:
+        s (np.array): The (complex) arguments of the pgf.
+            shape: (..., n_points)
+        offspring (np.array): The offspring distribution per step.
+            shape: (..., 3)
+        n_steps (int): The number of steps.
+        offspring_last (np.array): Optional different offspring distribution
+            in the last step (e.g. without splits).
+
+    Returns:
+        np.array: The pgf at ´s´.
+            shape: (..., n_points)
+    """
+    if offspring_last is None:
+        offspring_last = offspring
+    p_0, p_1, p_2 = [p[..., None] for p in np.moveaxis(offspring, -1, 0)]
+
+    p_0_last, p_1_last, p_2_last = [p[..., None] for p in np.moveaxis(offspring_last, -1, 0)]
+    s = p_0_last + s * (p_1_last + s * p_2_last)
+    for _ in range(n_steps - 1):
+        s = p_0 + s * (p_1 + s * p_2)
+    return s
+
+
+def pgf_coefficients(pgf, max_count):
+    """The probabilities P(N = 0), ..., P(N = max_count-1) of a count N, given
+    its pgf, by an inverse FFT on a damped circle.
+
+    Args:
+        pgf (callable): Maps an array of complex arguments to the pgf values.
+        max_count (int): The number of coefficients.
+
+    Returns:
+        np.array: The probabilities.
+            shape: (..., max_count)
+    """
+    n_fft = 1 << int(np.ceil(np.log2(FFT_OVERSAMPLING * max(max_count, 1))))
+    radius = ALIASING_TOLERANCE ** (1. / n_fft)
+    s = radius * np.exp(2j * np.pi * np.arange(n_fft) / n_fft)
+    coefficients = np.fft.fft(pgf(s), axis=-1).real / n_fft
+    probabilities = coefficients[..., :max_count] / radius ** np.arange(max_count)
+    return np.clip(probabilities, 0., 1.)
+
+
+class BirthDeathCalibration(object):
+
+    """The distribution of the number of extant leafs of the trees simulated
+    by `run_simulation` (for the Yule tree model of `VectorState`), computed
+    from the generating functions of the discrete-time birth-death process
+    instead of by simulation.
+
+    The simulation starts with a split of the root. The two subtrees evolve as
+    independent branching processes over ´n_steps´ steps, without splits in the
+    last step. A simulated tree is accepted if both subtrees survive and the
+    number of extant leafs lies strictly within ´leaf_range´.
+
+    Attributes:
+        n_steps (int): The number of simulation steps.
+        leaf_range (tuple[float]): The (exclusive) range of accepted tree sizes.
+        clock_rate (float): The clock rate of the simulation.
+    """
+
+    def __init__(self, n_steps, leaf_range, clock_rate=1.):
+        self.n_steps = n_steps
+        self.leaf_range = leaf_range
+        self.clock_rate = clock_rate
+
+    @property
+    def max_count(self):
+        return int(np.floor(self.leaf_range[1])) + 1
+
+    def subtree_pgf(self, s, birth_rate, death_rate):
+        """The pgf of the number of extant leafs in one subtree of the root."""
+        offspring = offspring_probabilities(birth_rate, death_rate, self.clock_rate)
+        offspring_last = offspring_probabilities(0. * np.asarray(birth_rate), death_rate,
+                                                 self.clock_rate)
+        return iterate_pgf(s, offspring, self.n_steps, offspring_last=offspring_last)
+
+    def extinction_probability(self, birth_rate, death_rate):
+        """The probability that one subtree of the root dies out."""
+        return self.subtree_pgf(np.zeros(1), birth_rate, death_rate)[..., 0]
+
+    def leaf_count_distribution(self, birth_rate, death_rate):
+        """The distribution of the number of extant leafs of the whole tree,
+        jointly with the survival of both root subtrees.
+
+        Returns:
+            np.array: P(N = n, both subtrees survive) for n < `max_count`.
+                shape: (..., max_count)
+        """
+        p_extinct = self.extinction_probability(birth_rate, death_rate)[..., None]
+
+        def pgf(s):
+            return (self.subtree_pgf(s, birth_rate, death_rate) - p_extinct) ** 2
+
+        return pgf_coefficients(pgf, self.max_count)
+
+    def acceptance_probability(self, birth_rate, death_rate):
+        """The probability that a simulated tree is accepted (both subtrees
+        survive and the tree size is within `leaf_range`)."""
+        p_size = self.leaf_count_distribution(birth_rate, death_rate)
+        sizes = np.arange(self.max_count)
+        accepted = (self.leaf_range[0] < sizes) & (sizes < self.leaf_range[1])
+        return np.sum(p_size[..., accepted], axis=-1)
+
+    def calibrate(self, turnover=0.2, birth_rate_guess=None):
+        """Find the birth rate (with death_rate = turnover * birth_rate) which
+        maximises the acceptance probability. The acceptance is evaluated for
+        a grid of candidates around ´birth_rate_guess´ at once and then
+        refined by a bounded scalar search.
+
+        Args:
+            turnover (float): The ratio of death rate and birth rate.
+            birth_rate_guess (float): Initial guess (default: the birth rate
+                for which the expected tree size is the middle of the range).
+
+        Returns:
+            float: The birth rate.
+            float: The death rate.
+            float: The acceptance probability.
+        """
+        if birth_rate_guess is None:
+            n_expected = np.mean(self.leaf_range)
+            birth_rate_guess = np.log(n_expected / 2.) / self.n_steps / (1 - turnover)
+        max_birth_rate = min(self.clock_rate, 1. / (turnover * self.clock_rate)
+                             if turnover > 0 else np.inf)
+
+        log_candidates = np.linspace(np.log(birth_rate_guess / CANDIDATE_RANGE),
+                                     np.log(birth_rate_guess * CANDIDATE_RANGE),
+                                     N_CANDIDATES)
+        log_candidates = log_candidates[log_candidates < np.log(max_birth_rate)]
+        candidates = np.exp(log_candidates)
+        acceptance = self.acceptance_probability(candidates, turnover * candidates)
+
+        i_best = int(np.argmax(acceptance))
+        lower = log_candidates[max(i_best - 1, 0)]
+        upper = log_candidates[min(i_best + 1, len(log_candidates) - 1)]
+
+        def negative_acceptance(log_birth_rate):
+            birth_rate = np.exp(log_birth_rate)
+            return -self.acceptance_probability(birth_rate, turnover * birth_rate)
+
+        result = minimize_scalar(negative_acceptance, bounds=(lower, upper),
+                                 method='bounded', options={'xatol': 1e-4})
+        birth_rate = np.exp(result.x)
+        if -result.fun < acceptance[i_best]:
+            birth_rate = candidates[i_best]
+        acceptance = float(self.acceptance_probability(birth_rate, turnover * birth_rate))
+        LOGGER.debug('\tCalibrated birth rate %.6f (acceptance probability %.3f)'
+                     % (birth_rate, acceptance))
+        return birth_rate, turnover * birth_rate, acceptance
+
+
+def lineage_count_moments(offspring, n_steps):
+    """Mean and variance of the number of lineages descending from one lineage
+    after ´n_steps´ steps of a branching process with the given offspring
+    distribution (closed form of the Galton-Watson moments).
+
+    Args:
+        offspring (np.array): The offspring distribution per step.
+            shape: (3,)
+        n_steps (int): The number of steps.
+
+    Returns:
+        float: The mean number of lineages.
+        float: The variance of the number of lineages.
+    """
+    mean_step = offspring[1] + 2 * offspring[2]
+    var_step = offspring[1] + 4 * offspring[2] - mean_step ** 2
+    mean = mean_step ** n_steps
+    if np.isclose(mean_step, 1.):
+        var = n_steps * var_step
+    else:
+        var = var_step * mean_step ** (n_steps - 1) * (mean - 1) / (mean_step - 1)
+    return mean, var
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import numpy as np
+from scipy.stats import f as f_distribution
+from shapely.geometry import Polygon
+
+from src.hpd import HPDRegion
+
+# Minimal variance of a pruning message (avoids divisions by zero for zero
+# length branches between leafs)
+MIN_VARIANCE = 1e-12
+
+# Number of vertices of the polygons approximating elliptical HPD regions
+HPD_POLYGON_VERTICES = 64
+
+
+class BrownianPruning(object):
+
+    """Felsenstein pruning (post-order pass) of 2D isotropic Brownian motion
+    with unit rate on a fixed tree, conditioned on the leaf locations.
+
+    Nodes are indexed in depth-first pre-order. For every node the pruning
+    yields the mean and variance of its location given only the leafs in its
+    subtree (flat prior), which is all that is needed for the root posterior,
+    the ML diffusion rate (independent contrasts) and exact joint posterior
+    samples of all node locations. Relaxed random walks are handled by scaling
+    the branch lengths with per-branch rate multipliers, a directional trend
+    by a constant drift per unit time. Leafs without location are treated as
+    missing data.
+
+    Attributes:
+        nodes (list[Tree]): All nodes of the tree in pre-order.
+        parents (np.array): Index of the parent of each node (-1 for the root).
+            shape: (n_nodes,)
+        lengths (np.array): Branch length of each node (scaled by the rates).
+            shape: (n_nodes,)
+        shifts (np.array): Expected displacement along each branch (drift).
+            shape: (n_nodes, 2)
+        observed (np.array): Mask of the leafs with known location.
+            shape: (n_nodes,)
+        partial_means (np.array): Mean of each node given its subtree.
+            shape: (n_nodes, 2)
+        partial_vars (np.array): Variance (per dimension, in units of the
+            diffusion rate) of each node given its subtree (inf if there is no
+            observed leaf in the subtree).
+            shape: (n_nodes,)
+        contrasts_scatter (np.array): Sum of the outer products of the
+            standardized contrasts.
+            shape: (2, 2)
+        contrasts_log_var (float): Sum of the log variances of the contrasts.
+        n_contrasts (int): Number of (2D) contrasts.
+    """
+
+    def __init__(self, tree, rates=None, drift=None):
+        """
+        Args:
+            tree (Tree): The tree with the leaf locations.
+            rates (np.array): Rate multipliers of the branches (in pre-order).
+                shape: (n_nodes,)
+            drift (np.array): Expected displacement per unit time, for all
+                branches or per branch (in pre-order).
+                shape: (2,) or (n_nodes, 2)
+        """
+        self.nodes = tree.get_descendants()
+        n = len(self.nodes)
+        self.node_idx = node_idx = {id(node): i for i, node in enumerate(self.nodes)}
+
+        self.parents = np.full(n, -1, dtype=int)
+        self.lengths = np.array([node.length for node in self.nodes], dtype=float)
+        self.children = [[] for _ in range(n)]
+        for i, node in enumerate(self.nodes[1:], start=1):
+            p = node_idx[id(node.parent)]
+            self.parents[i] = p
+            self.children[p].append(i)
+
+        # The drift acts on the time axis, the rates only on the variance
+        self.shifts = np.zeros((n, 2))
+        if drift is not None:
+            self.shifts = self.lengths[:, None] * np.asarray(drift, dtype=float)
+        if rates is not None:
+            self.lengths = self.lengths * rates
+
+        self.observed = np.zeros(n, dtype=bool)
+        self.partial_means = np.zeros((n, 2))
+        self.partial_vars = np.full(n, np.inf)
+        self.contrasts_scatter = np.zeros((2, 2))
+        self.contrasts_log_var = 0.
+        self.n_contrasts = 0
+
+        # Reverse pre-order visits all children before their parent
+        for i in range(n - 1, -1, -1):
+            if not self.children[i]:
+                location = self.nodes[i].location
+                if location is not None:
+                    self.observed[i] = True
+                    self.partial_means[i] = location
+                    self.partial_vars[i] = 0.
+                continue
+
+            # Merge the messages of the children one by one (handles polytomies)
+            mean, var = None, None
+            for c in self.children[i]:
+                if np.isinf(self.partial_vars[c]):
+                    continue
+                c_mean, c_var = self.child_message(c)
+                if mean is None:
+                    mean, var = c_mean, c_var
+                    continue
+
+                contrast = mean - c_mean
+                self.contrasts_scatter += np.outer(contrast, contrast) / (var + c_var)
+                self.contrasts_log_var += np.log(var + c_var)
+                self.n_contrasts += 1
+
+                mean = (mean * c_var + c_mean * var) / (var + c_var)
+                var = var * c_var / (var + c_var)
+
+            if mean is not None:
+                self.partial_means[i] = mean
+                self.partial_vars[i] = var
+
+    @property
+    def n_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def contrasts_sum_sq(self):
+        """Sum of the squared standardized contrasts."""
+        return np.trace(self.contrasts_scatter)
+
+    def child_message(self, i):
+        """Mean and variance of the parent of node ´i´, given the subtree of
+        node ´i´."""
+        var = max(self.partial_vars[i] + self.lengths[i], MIN_VARIANCE)
+        return self.partial_means[i] - self.shifts[i], var
+
+    def diffusion_rate_ml(self):
+        """REML estimate of the diffusion rate (variance per unit time and
+        dimension) from the independent contrasts."""
+        if self.n_contrasts == 0:
+            return np.nan
+        return self.contrasts_sum_sq / (2. * self.n_contrasts)
+
+    def root_posterior(self, diffusion_rate=None, root_prior_mean=(0., 0.),
+                       root_prior_sample_size=0.):
+        """Gaussian posterior of the root location, given the leaf locations.
+
+        Args:
+            diffusion_rate (float or np.array): Variance per unit time and
+                dimension, or the diffusion covariance matrix (default: the ML
+                estimate).
+            root_prior_mean (np.array): Mean of the (conjugate) root prior.
+            root_prior_sample_size (float): Precision of the root prior relative
+                to the diffusion (0 for a flat prior, as in BEAST's
+                `conjugateRootPrior`).
+
+        Returns:
+            np.array: Posterior mean of the root location.
+                shape: (2,)
+            np.array: Posterior covariance of the root location.
+                shape: (2, 2)
+        """
+        if diffusion_rate is None:
+            diffusion_rate = self.diffusion_rate_ml()
+
+        precision = 1. / self.partial_vars[0] + root_prior_sample_size
+        mean = (self.partial_means[0] / self.partial_vars[0] +
+                root_prior_sample_size * np.asarray(root_prior_mean)) / precision
+        return mean, as_covariance(diffusion_rate) / precision
+
+    def node_posteriors(self, root_prior_mean=(0., 0.), root_prior_sample_size=0.):
+        """Marginal posterior of every node location given all leafs, by a
+        pre-order pass combining the pruning message of each node with the
+        message from the rest of the tree (postorder + preorder, O(n)).
+
+        Returns:
+            np.array: The posterior means.
+                shape: (n_nodes, 2)
+            np.array: The posterior variances (per dimension, in units of the
+                diffusion rate, 0 for observed leafs).
+                shape: (n_nodes,)
+        """
+        means = np.empty((self.n_nodes, 2))
+        variances = np.zeros(self.n_nodes)
+
+        # Posterior precision and precision-weighted mean of each node
+        precision = np.zeros(self.n_nodes)
+        weighted_mean = np.zeros((self.n_nodes, 2))
+        precision[0] = 1. / self.partial_vars[0] + root_prior_sample_size
+        weighted_mean[0] = (self.partial_means[0] / self.partial_vars[0] +
+                            root_prior_sample_size * np.asarray(root_prior_mean))
+
+        for i in range(self.n_nodes):
+            if self.observed[i]:
+                means[i] = self.partial_means[i]
+                continue
+
+            if i > 0:
+                # Message from the rest of the tree, through the parent: the
+                # posterior of the parent without the message of node i
+                p = self.parents[i]
+                outside_precision = precision[p]
+                outside_weighted_mean = weighted_mean[p]
+                if not np.isinf(self.partial_vars[i]):
+                    c_mean, c_var = self.child_message(i)
+                    outside_precision = outside_precision - 1. / c_var
+                    outside_weighted_mean = outside_weighted_mean - c_mean / c_var
+
+                precision[i] = 1. / self.partial_vars[i]
+                weighted_mean[i] = self.partial_means[i] * precision[i]
+                if outside_precision > MIN_VARIANCE * precision[p]:
+                    outside_mean = outside_weighted_mean / outside_precision + self.shifts[i]
+                    outside_var = 1. / outside_precision + self.lengths[i]
+                    precision[i] += 1. / outside_var
+                    weighted_mean[i] = weighted_mean[i] + outside_mean / outside_var
+
+            means[i] = weighted_mean[i] / precision[i]
+            variances[i] = 1. / precision[i]
+
+        return means, variances
+
+    def sample_diffusion_rate(self, random_state):
+        """Sample the diffusion rate from its posterior (under the prior
+        1 / rate), an inverse gamma distribution."""
+        shape = self.n_contrasts
+        scale = self.contrasts_sum_sq / 2.
+        return scale / random_state.gamma(shape)
+
+    def sample_locations(self, diffusion_rate, random_state, root_prior_mean=(0., 0.),
+                         root_prior_sample_size=0.):
+        """Draw the locations of all nodes jointly from their posterior (root
+        first, then every node given its parent, in pre-order).
+
+        Args:
+            diffusion_rate (float or np.array): Variance per unit time and
+                dimension, or the diffusion covariance matrix.
+            random_state (np.random.RandomState): The random number generator.
+
+        Returns:
+            np.array: The sampled locations (observed leafs keep their location).
+                shape: (n_nodes, 2)
+        """
+        locations = np.empty((self.n_nodes, 2))
+        root_mean, root_cov = self.root_posterior(
+            diffusion_rate, root_prior_mean=root_prior_mean,
+            root_prior_sample_size=root_prior_sample_size)
+        locations[0] = root_mean + np.linalg.cholesky(root_cov).dot(random_state.normal(size=2))
+
+        # Correlated standard noise, scaled by the node variances below
+        cholesky = np.linalg.cholesky(as_covariance(diffusion_rate))
+        noise = random_state.normal(size=(self.n_nodes, 2)).dot(cholesky.T)
+        for i in range(1, self.n_nodes):
+            if self.observed[i]:
+                locations[i] = self.partial_means[i]
+                continue
+
+            p = self.parents[i]
+            l = max(self.lengths[i], MIN_VARIANCE)
+            precision = 1. / self.partial_vars[i] + 1. / l
+            mean = (self.partial_means[i] / self.partial_vars[i] +
+                    (locations[p] + self.shifts[i]) / l) / precision
+            locations[i] = mean + noise[i] / np.sqrt(precision)
+
+        return locations
+
+    def log_likelihood(self, diffusion_rate):
+        """Log likelihood of the leaf locations under Brownian motion with the
+        given diffusion rate (or covariance matrix), with the internal nodes
+        integrated out (and a flat root prior), computed from the independent
+        contrasts."""
+        cov = as_covariance(diffusion_rate)
+        _, log_det = np.linalg.slogdet(cov)
+        return (-self.n_contrasts * (np.log(2. * np.pi) + log_det / 2.)
+                - self.contrasts_log_var
+                - np.sum(np.linalg.inv(cov) * self.contrasts_scatter) / 2.)
+
+
+def as_covariance(diffusion_rate):
+    """The diffusion covariance matrix for a diffusion rate (isotropic) or a
+    covariance matrix."""
+    if np.ndim(diffusion_rate) == 2:
+        return np.asarray(diffusion_rate, dtype=float)
+    return np.eye(2) * diffusion_rate
+
+
+def hpd_radius_sq(p_hpd, dof=None):
+    """Squared Mahalanobis radius of the HPD region of a bivariate normal (or,
+    given the degrees of freedom, Student-t) distribution.
+
+    Args:
+        p_hpd (int): The HPD level in percent.
+        dof (float): Degrees of freedom of the t-distribution (None for the
+            normal distribution).
+
+    Returns:
+        float: The squared radius in units of the scale matrix.
+    """
+    p = p_hpd / 100.
+    if dof is None:
+        return -2. * np.log(1. - p)
+    return 2. * f_distribution.ppf(p, 2, dof)
+
+
+class BrownianReconstruction(object):
+
+    """Closed-form posterior of the node locations under (2D isotropic)
+    Brownian motion on a fixed tree, given the leaf locations.
+
+    If no diffusion rate is given, it is integrated out under the prior
+    1 / rate (as a Gibbs precision operator in BEAST would), so the node
+    posteriors are bivariate Student-t distributions with 2 * n_contrasts
+    degrees of freedom. Otherwise they are normal distributions.
+
+    Args:
+        tree (Tree): The tree with the leaf locations.
+        diffusion_rate (float): Fixed diffusion rate (default: integrated out).
+        rates (np.array): Rate multipliers of the branches (in pre-order).
+            shape: (n_nodes,)
+        drift (np.array): Expected displacement per unit time.
+            shape: (2,)
+
+    Attributes:
+        pruning (BrownianPruning): The pruning pass over the tree.
+        means (np.array): Posterior means of all nodes (in pre-order).
+            shape: (n_nodes, 2)
+        variances (np.array): Posterior variances of all nodes (per
+            dimension, in units of the diffusion rate).
+            shape: (n_nodes,)
+        scale (float): Diffusion rate scaling the variances to the scale
+            matrices of the posteriors.
+        dof (float or None): Degrees of freedom of the posteriors (None if the
+            diffusion rate is fixed).
+    """
+
+    def __init__(self, tree, diffusion_rate=None, rates=None, drift=None,
+                 root_prior_mean=(0., 0.), root_prior_sample_size=0.):
+        self.tree = tree
+        self.pruning = BrownianPruning(tree, rates=rates, drift=drift)
+        self.means, self.variances = self.pruning.node_posteriors(
+            root_prior_mean=root_prior_mean, root_prior_sample_size=root_prior_sample_size)
+
+        if diffusion_rate is None:
+            # Inverse gamma posterior of the rate: shape n_contrasts, scale
+            # contrasts_sum_sq / 2
+            self.dof = 2. * self.pruning.n_contrasts
+            self.scale = self.pruning.contrasts_sum_sq / self.dof
+        else:
+            self.dof = None
+            self.scale = diffusion_rate
+
+    def index(self, node=None):
+        """Index of ´node´ (default: the root) in the pre-order of the tree."""
+        if node is None:
+            return 0
+        return self.pruning.node_idx[id(node)]
+
+    def mean(self, node=None):
+        """Posterior mean of the location of ´node´ (default: the root)."""
+        return self.means[self.index(node)]
+
+    def scale_matrix(self, node=None):
+        return np.eye(2) * self.scale * self.variances[self.index(node)]
+
+    def covariance(self, node=None):
+        """Posterior covariance of the location of ´node´ (default: the root)."""
+        return np.eye(2) * self.location_variances()[self.index(node)]
+
+    def location_variances(self):
+        """Posterior variance (per dimension) of the locations of all nodes
+        (in pre-order)."""
+        if self.dof is None:
+            return self.scale * self.variances
+        if self.dof <= 2:
+            return np.full(len(self.variances), np.inf)
+        return self.scale * self.variances * self.dof / (self.dof - 2.)
+
+    def in_hpd(self, points, p_hpd, node=None):
+        """Check whether the points lie in the elliptical ´p_hpd´% HPD region
+        of ´node´ (default: the root).
+
+        Args:
+            points (np.array): The points to be tested.
+                shape: (..., 2)
+
+        Returns:
+            np.array: Boolean mask of the points inside the HPD region.
+                shape: (...)
+        """
+        offset = np.asarray(points, dtype=float) - self.mean(node)
+        scale_inv = np.linalg.inv(self.scale_matrix(node))
+        mahalanobis_sq = np.einsum('...i,ij,...j->...', offset, scale_inv, offset)
+        return mahalanobis_sq <= hpd_radius_sq(p_hpd, self.dof)
+
+    def hpd_polygon(self, p_hpd, node=None, n_vertices=HPD_POLYGON_VERTICES):
+        """Polygon approximating the elliptical HPD region of ´node´."""
+        angles = np.linspace(0., 2. * np.pi, n_vertices, endpoint=False)
+        circle = np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+        radius = np.sqrt(hpd_radius_sq(p_hpd, self.dof))
+        transform = np.linalg.cholesky(self.scale_matrix(node))
+        return Polygon(self.mean(node) + radius * circle.dot(transform.T))
+
+    def hpd_region(self, p_hpd, node=None, n_vertices=HPD_POLYGON_VERTICES):
+        """The HPD region of ´node´ as an `HPDRegion` (e.g. for coverage maps
+        or distances to the boundary)."""
+        return HPDRegion([self.hpd_polygon(p_hpd, node=node, n_vertices=n_vertices)],
+                         p_hpd=p_hpd)
+
+
+def get_branch_rates(tree, rate_key='location.rate'):
+    """Read the rate multipliers of all branches (in pre-order) from the node
+    attributes, e.g. of a BEAST MCC tree (missing rates default to 1)."""
+    return np.array([float(node.attributes.get(rate_key, 1.))
+                     for node in tree.iter_descendants()])
+
+
+def reconstruct_ancestral_locations(tree, mode='ml', rates=None, rate_key=None,
+                                    drift=None, diffusion_rate=None, overwrite=False):
+    """Gaussian ancestral location reconstruction for all nodes of ´tree´ in
+    O(n) (a post-order and a pre-order pass, see `BrownianPruning`), taking the
+    branch lengths into account (unlike `naive_location_reconstruction`).
+
+    Args:
+        tree (Tree): The tree with the leaf locations.
+        mode (str): 'ml' for the maximum likelihood locations with variances
+            at the (REML) estimate of the diffusion rate, or 'marginal' for the
+            marginal posteriors with the rate integrated out. The estimated
+            locations are the same in both modes.
+        rates (np.array): Rate multipliers of the branches (in pre-order).
+            shape: (n_nodes,)
+        rate_key (str): Read the rates from this node attribute instead (e.g.
+            'location.rate' in BEAST MCC trees).
+        drift (np.array): Expected displacement per unit time.
+            shape: (2,)
+        diffusion_rate (float): Fixed diffusion rate (default: estimated or
+            integrated out, depending on ´mode´).
+        overwrite (bool): Replace existing locations of internal nodes (by
+            default only missing locations are filled in, incl. leafs without
+            location).
+
+    Returns:
+        np.array: The reconstructed locations of all nodes (in pre-order).
+            shape: (n_nodes, 2)
+        np.array: Their variances (per dimension).
+            shape: (n_nodes,)
+    """
+    if rate_key is not None:
+        rates = get_branch_rates(tree, rate_key=rate_key)
+
+    if mode == 'ml':
+        if diffusion_rate is None:
+            diffusion_rate = BrownianPruning(tree, rates=rates, drift=drift).diffusion_rate_ml()
+    elif mode != 'marginal':
+        raise ValueError('Unknown reconstruction mode `%s`' % mode)
+
+    reconstruction = BrownianReconstruction(tree, diffusion_rate=diffusion_rate,
+                                            rates=rates, drift=drift)
+    means = reconstruction.means
+    variances = reconstruction.location_variances()
+
+    pruning = reconstruction.pruning
+    for node, mean, observed in zip(pruning.nodes, means, pruning.observed):
+        if not observed and (overwrite or node.location is None):
+            node.location = mean
+
+    return means, variances
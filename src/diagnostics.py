@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+import os
+import logging
+
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
+
+LOGGER = logging.getLogger('experiment')
+
+LOG_CACHE_SUFFIX = '.npy'
+STATE_COLUMN = 'state'
+GEWEKE_FIRST = 0.1
+GEWEKE_LAST = 0.5
+DIAGNOSTIC_METRICS = ['min_ess', 'max_rhat', 'max_geweke']
+
+
+def autocorrelation(x):
+    """Compute the autocorrelation function of a chain (or of each column of
+    a set of chains) for all lags via FFT (O(n log n)).
+
+    Args:
+        x (np.array): The samples of the chain.
+            shape: (n_samples,) or (n_samples, n_columns)
+
+    Returns:
+        np.array: The autocorrelation at lags 0, ..., n_samples-1 (NaN for
+            constant columns).
+            shape: (n_samples,) or (n_samples, n_columns)
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    x = x - np.mean(x, axis=0)
+
+    # Zero-pad to a power of two (>= 2n) to avoid circular correlation
+    n_fft = 1 << int(np.ceil(np.log2(2 * n)))
+    f = np.fft.rfft(x, n=n_fft, axis=0)
+    acov = np.fft.irfft(f * np.conjugate(f), n=n_fft, axis=0)[:n]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(acov[0] > 0, acov / acov[0], np.nan)
+
+
+def integrated_autocorrelation_time(x):
+    """Integrated autocorrelation time of a chain (or of each column), using
+    Geyer's initial positive sequence estimator (sums of consecutive pairs of
+    autocorrelations are accumulated until the first non-positive pair)."""
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if n < 4:
+        return np.full(x.shape[1:], np.nan)[()]
+    rho = autocorrelation(x)
+
+    n_pairs = (n - 1) // 2
+    pair_sums = rho[1:2 * n_pairs:2] + rho[2:2 * n_pairs + 1:2]
+    initial_positive = np.cumsum(pair_sums <= 0., axis=0) == 0
+
+    # rho[0] + 2 * (rho[1] + rho[2] + ...)
+    tau = 1. + 2. * np.sum(np.where(initial_positive, pair_sums, 0.), axis=0)
+    tau = np.where(np.isnan(rho[0]), np.nan, tau)
+    return np.maximum(tau, 1. / n)[()]
+
+
+def effective_sample_size(x):
+    """Effective sample size (ESS) of a chain (or of each column), n / tau
+    (NaN for chains that are constant or shorter than 4 samples)."""
+    tau = integrated_autocorrelation_time(x)
+    return len(x) / tau
+
+
+def geweke_z(x, first=GEWEKE_FIRST, last=GEWEKE_LAST):
+    """Geweke's convergence diagnostic: the z-score of the difference between
+    the means of the first and the last part of a chain (or of each column).
+    The variances of the means are estimated from the autocorrelation (i.e.
+    var / ESS) instead of a spectral density fit.
+
+    Args:
+        x (np.array): The samples of the chain.
+            shape: (n_samples,) or (n_samples, n_columns)
+        first (float): Fraction of the chain in the first window.
+        last (float): Fraction of the chain in the last window.
+
+    Returns:
+        np.array: The z-score of each column.
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    x_first = x[:int(first * n)]
+    x_last = x[n - int(last * n):]
+    if len(x_first) < 4 or len(x_last) < 4:
+        return np.full(x.shape[1:], np.nan)[()]
+
+    var_first = np.var(x_first, axis=0, ddof=1) / effective_sample_size(x_first)
+    var_last = np.var(x_last, axis=0, ddof=1) / effective_sample_size(x_last)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (np.mean(x_first, axis=0) - np.mean(x_last, axis=0)) / np.sqrt(var_first + var_last)
+    return z[()]
+
+
+def split_rhat(chains):
+    """Split-R-hat (Gelman et al., 2013) of one or more chains: each chain is
+    split into two halves and the potential scale reduction factor is computed
+    over all halves. Chains of different lengths are truncated to the shortest.
+
+    Args:
+        chains (np.array or list[np.array]): A single chain or a list of chains.
+            shape: (n_samples,) or (n_samples, n_columns) per chain
+
+    Returns:
+        np.array: The split-R-hat of each column (NaN for constant columns).
+    """
+    if isinstance(chains, np.ndarray):
+        chains = [chains]
+    n_half = min(len(chain) for chain in chains) // 2
+    if n_half < 2:
+        return np.full(np.shape(chains[0])[1:], np.nan)[()]
+
+    halves = []
+    for chain in chains:
+        chain = np.asarray(chain, dtype=float)
+        halves += [chain[:n_half], chain[len(chain) - n_half:]]
+    halves = np.array(halves)
+
+    within = np.mean(np.var(halves, axis=1, ddof=1), axis=0)
+    between = n_half * np.var(np.mean(halves, axis=1), axis=0, ddof=1)
+    var_plus = (n_half - 1) / n_half * within + between / n_half
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(var_plus / within)[()]
+
+
+class ChainLog(object):
+
+    """The samples of a BEAST `.log` file as one array.
+
+    Attributes:
+        columns (list[str]): The column names (the first one is 'state').
+        values (np.array): The logged values (possibly memory-mapped).
+            shape: (n_samples, n_columns)
+    """
+
+    def __init__(self, columns, values):
+        self.columns = list(columns)
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, key):
+        return self.values[:, self.columns.index(key)]
+
+    @property
+    def states(self):
+        return self[STATE_COLUMN]
+
+    @property
+    def parameters(self):
+        """The names of all logged parameters (all columns except 'state')."""
+        return [c for c in self.columns if c != STATE_COLUMN]
+
+    def get_samples(self, burnin=0, columns=None):
+        """The samples of the given columns (default: all parameters) after
+        burn-in.
+
+        Returns:
+            np.array: The samples.
+                shape: (n_samples, n_columns)
+        """
+        if columns is None:
+            columns = self.parameters
+        col_idx = [self.columns.index(c) for c in columns]
+        return np.asarray(self.values[self.states >= burnin][:, col_idx])
+
+
+def read_log(log_path):
+    """Parse a BEAST `.log` file (tab separated, with '#' comment lines and a
+    header line). An unterminated last line (written by a chain that was
+    stopped early) is ignored.
+
+    Returns:
+        ChainLog: The logged samples.
+    """
+    with open(log_path, 'r') as log_file:
+        for line in log_file:
+            if line.strip() and not line.startswith('#'):
+                columns = line.strip().split('\t')
+                break
+        else:
+            return ChainLog([STATE_COLUMN], np.zeros((0, 1)))
+
+        data, _, _ = log_file.read().rpartition('\n')
+
+    values = np.loadtxt(data.splitlines(), delimiter='\t', comments='#', ndmin=2)
+
+    return ChainLog(columns, values.reshape((-1, len(columns))))
+
+
+def load_log(log_path, use_cache=True):
+    """Load a BEAST `.log` file as a ChainLog. The parsed samples are cached in
+    a `.npy` file next to the log (a structured array with one field per
+    column), which is memory-mapped on later calls as long as the log did not
+    change.
+
+    Args:
+        log_path (str): Path of the BEAST `.log` file.
+        use_cache (bool): Whether to read and write the `.npy` cache.
+
+    Returns:
+        ChainLog: The logged samples.
+    """
+    cache_path = log_path + LOG_CACHE_SUFFIX
+    if use_cache and os.path.exists(cache_path) and \
+            os.path.getmtime(cache_path) >= os.path.getmtime(log_path):
+        records = np.load(cache_path, mmap_mode='r')
+        return ChainLog(records.dtype.names, structured_to_unstructured(records))
+
+    log = read_log(log_path)
+    if use_cache:
+        dtype = np.dtype([(c, np.float64) for c in log.columns])
+        records = np.empty(len(log), dtype=dtype)
+        for i, c in enumerate(log.columns):
+            records[c] = log.values[:, i]
+        try:
+            np.save(cache_path, records)
+        except OSError:
+            LOGGER.debug('\tCould not write the log cache %s' % cache_path)
+
+    return log
+
+
+def chain_diagnostics(log_paths, burnin=0, columns=None):
+    """Compute the convergence diagnostics of all parameters in one or more
+    BEAST `.log` files (independent chains of the same analysis), vectorized
+    over the columns.
+
+    Args:
+        log_paths (str or list[str]): The `.log` file(s).
+        burnin (int): Number of MCMC states discarded as burn-in.
+        columns (list[str]): The parameters (default: all logged parameters).
+
+    Returns:
+        dict: The names of the parameters ('columns') and per parameter the ESS
+            (summed over chains, 'ess'), the maximal absolute Geweke z-score
+            over chains ('geweke') and the split-R-hat over all chains ('rhat').
+    """
+    if isinstance(log_paths, str):
+        log_paths = [log_paths]
+    logs = [load_log(path) for path in log_paths]
+    if columns is None:
+        columns = logs[0].parameters
+    chains = [log.get_samples(burnin, columns) for log in logs]
+
+    return {
+        'columns': columns,
+        'ess': np.sum([effective_sample_size(chain) for chain in chains], axis=0),
+        'geweke': np.max(np.abs([geweke_z(chain) for chain in chains]), axis=0),
+        'rhat': split_rhat(chains),
+    }
+
+
+def diagnostics_summary(log_paths, burnin=0, columns=None):
+    """Summarize the convergence diagnostics of a BEAST analysis (see
+    `chain_diagnostics`) in the worst value over all (non-constant) parameters.
+
+    Returns:
+        dict: The minimal ESS ('min_ess'), the maximal split-R-hat ('max_rhat')
+            and the maximal absolute Geweke z-score ('max_geweke').
+    """
+    diagnostics = chain_diagnostics(log_paths, burnin=burnin, columns=columns)
+
+    def worst(values, reduce):
+        values = np.asarray(values, dtype=float)
+        values = values[np.isfinite(values)]
+        return reduce(values) if len(values) > 0 else np.nan
+
+    return {
+        'min_ess': worst(diagnostics['ess'], np.min),
+        'max_rhat': worst(diagnostics['rhat'], np.max),
+        'max_geweke': worst(diagnostics['geweke'], np.max),
+    }
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import numpy as np
+
+
+EUCLIDEAN = 'euclidean'
+GREAT_CIRCLE = 'great_circle'
+METRICS = [EUCLIDEAN, GREAT_CIRCLE]
+
+EARTH_RADIUS = 6371.  # km
+DEFAULT_BLOCK_SIZE = 2 ** 20  # Number of pairs per block
+
+
+def euclidean_distance(a, b):
+    """Element-wise euclidean distance between two arrays of 2D points."""
+    return np.hypot(a[..., 0] - b[..., 0], a[..., 1] - b[..., 1])
+
+
+def great_circle_distance(a, b, radius=EARTH_RADIUS):
+    """Element-wise great-circle distance (haversine formula) between two
+    arrays of points, given as (latitude, longitude) in degrees (the convention
+    of BEAST's `greatCircleDistance` option).
+
+    Args:
+        a (np.array): First set of points.
+            shape: (..., 2)
+        b (np.array): Second set of points.
+            shape: (..., 2)
+        radius (float): Radius of the sphere (default: earth radius in km).
+
+    Returns:
+        np.array: The distances.
+            shape: (...)
+    """
+    lat_a, lon_a = np.radians(a[..., 0]), np.radians(a[..., 1])
+    lat_b, lon_b = np.radians(b[..., 0]), np.radians(b[..., 1])
+    h = np.sin((lat_b - lat_a) / 2.) ** 2 + \
+        np.cos(lat_a) * np.cos(lat_b) * np.sin((lon_b - lon_a) / 2.) ** 2
+    return 2. * radius * np.arcsin(np.sqrt(np.clip(h, 0., 1.)))
+
+
+def get_metric(metric):
+    if metric == EUCLIDEAN:
+        return euclidean_distance
+    elif metric == GREAT_CIRCLE:
+        return great_circle_distance
+    else:
+        raise ValueError('Unknown metric `%s`' % metric)
+
+
+def n_pairs(n):
+    """The number of unordered pairs of ´n´ points (length of a condensed
+    distance vector)."""
+    return n * (n - 1) // 2
+
+
+def iter_pair_blocks(n, block_size=DEFAULT_BLOCK_SIZE):
+    """Iterate over all pairs (i, j) with i < j of ´n´ points in blocks of
+    roughly ´block_size´ pairs. The pairs are generated in the order of a
+    condensed distance vector (as in `scipy.spatial.distance.pdist`), i.e. the
+    concatenation of all blocks is the full upper triangle in row-major order.
+
+    Yields:
+        np.array: The first indices (i) of the pairs in the block.
+        np.array: The second indices (j) of the pairs in the block.
+    """
+    i_start = 0
+    while i_start < n - 1:
+        # Choose the number of rows such that the block has ~block_size pairs
+        n_rows = max(1, block_size // (n - 1 - i_start))
+        i_stop = min(n - 1, i_start + n_rows)
+
+        rows = np.arange(i_start, i_stop)
+        counts = n - 1 - rows
+        row_offsets = np.cumsum(counts) - counts
+
+        i = np.repeat(rows, counts)
+        j = i + 1 + np.arange(np.sum(counts)) - np.repeat(row_offsets, counts)
+        yield i, j
+
+        i_start = i_stop
+
+
+def iter_pairwise_distances(locations, metric=EUCLIDEAN, dtype=np.float64,
+                            block_size=DEFAULT_BLOCK_SIZE):
+    """Iterate over the pairwise distances between ´locations´ in blocks of
+    roughly ´block_size´ pairs, without materializing any n x n array.
+
+    Args:
+        locations (np.array): The point locations.
+            shape: (n, 2)
+        metric (str): 'euclidean' or 'great_circle'.
+        dtype (np.dtype): Floating point type used for the computation
+            (e.g. np.float32 to half the memory footprint).
+        block_size (int): Approximate number of pairs per block.
+
+    Yields:
+        np.array: First indices (i) of the pairs in the block.
+        np.array: Second indices (j) of the pairs in the block.
+        np.array: The distances between locations[i] and locations[j].
+    """
+    locations = np.asarray(locations, dtype=dtype)
+    distance = get_metric(metric)
+
+    for i, j in iter_pair_blocks(len(locations), block_size=block_size):
+        yield i, j, distance(locations[i], locations[j]).astype(dtype, copy=False)
+
+
+def pairwise_distances(locations, metric=EUCLIDEAN, dtype=np.float64,
+                       block_size=DEFAULT_BLOCK_SIZE):
+    """Compute the condensed vector of pairwise distances between ´locations´
+    (same layout as `scipy.spatial.distance.pdist`). The distances are computed
+    block-wise, so that temporaries are bounded by ´block_size´.
+
+    Returns:
+        np.array: The condensed distance vector.
+            shape: (n * (n-1) / 2,)
+    """
+    dists = np.empty(n_pairs(len(locations)), dtype=dtype)
+    offset = 0
+    for _, _, d in iter_pairwise_distances(locations, metric=metric, dtype=dtype,
+                                           block_size=block_size):
+        dists[offset:offset + len(d)] = d
+        offset += len(d)
+    return dists
+
+
+def pairwise_min_distances(locations, metric=EUCLIDEAN, dtype=np.float64,
+                           block_size=DEFAULT_BLOCK_SIZE):
+    """Compute the distance of every location to its nearest neighbour (inf if
+    there is no other location) in a streaming fashion. Each block of rows
+    [start, stop) is compared with all columns from ´start´ onwards (the upper
+    triangle), and reduced by a row-wise and a column-wise minimum.
+
+    Returns:
+        np.array: Nearest neighbour distance for each location.
+            shape: (n,)
+    """
+    locations = np.asarray(locations, dtype=dtype)
+    distance = get_metric(metric)
+    n = len(locations)
+    min_dists = np.full(n, np.inf, dtype=dtype)
+
+    start = 0
+    while start < n - 1:
+        stop = min(n - 1, start + max(1, block_size // (n - start)))
+        d = distance(locations[start:stop, None], locations[None, start:])
+        d = d.astype(dtype, copy=False)
+
+        # Exclude the diagonal and the lower triangle of the block
+        d[np.tril_indices(stop - start, m=n - start)] = np.inf
+
+        np.minimum(min_dists[start:stop], np.min(d, axis=1), out=min_dists[start:stop])
+        np.minimum(min_dists[start:], np.min(d, axis=0), out=min_dists[start:])
+        start = stop
+
+    return min_dists
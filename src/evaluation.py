@@ -1,128 +1,693 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import os
 import logging
 
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 
 from scipy.stats import pearsonr
 
-from src.beast_interface import run_treeannotator, load_trees
-from src.tree import tree_imbalance, node_imbalance
-from src.util import dist, delaunay_join_count
+from src.beast_interface import (run_treeannotator, iter_root_locations,
+                                 scan_root_locations)
+from src.brownian import BrownianReconstruction
+from src.diagnostics import diagnostics_summary, DIAGNOSTIC_METRICS
+from src.lca import LCAIndex
+from src.hpd import HPDRegion
+from src.summarize import (summarize_posterior, compare_summary_trees, kde2d,
+                           bandwidth_nrd, hpd_levels, contour_polygons,
+                           DEFAULT_GRID_SIZE)
+from src.distances import iter_pairwise_distances, EUCLIDEAN, DEFAULT_BLOCK_SIZE
+from src.tree import node_imbalance
+from src.util import delaunay_clade_join_counts
 
 LOGGER = logging.getLogger('experiment')
 
+# Which summary produced the HPD hits: treeannotator, `summarize_posterior`,
+# or the KDE on the grid shared by all settings of a `BurninSweep`
+HPD_SUMMARISER = 'hpd_summariser'
+TREEANNOTATOR = 'treeannotator'
+NATIVE = 'native'
+NATIVE_SHARED_GRID = 'native_shared_grid'
+
 
 def eval_hpd_hit(root, p_hpd, burnin, working_dir):
     tree_mcc = run_treeannotator(p_hpd, burnin, working_dir=working_dir)
     return tree_mcc.root_in_hpd(root, p_hpd)
 
 
+def get_root_samples(trees):
+    """Collect the root locations of the posterior trees in one array (arrays
+    of root locations are passed through).
+
+    Returns:
+        np.array: The root location samples.
+            shape: (n_samples, 2)
+    """
+    if isinstance(trees, np.ndarray):
+        return trees
+    return np.array([t.location for t in trees]).reshape((-1, 2))
+
+
+class RootErrorAccumulator(object):
+
+    """Streaming moments of the posterior root samples and their errors w.r.t.
+    the true root. Samples are consumed one at a time or in blocks (Welford
+    updates, blocks are combined with the pairwise merge of Chan et al.), so all
+    evaluation metrics follow from a single pass over the posterior without
+    keeping the samples in memory. Accumulators of independent chains can be
+    combined with `merge`.
+
+    Attributes:
+        true_root (np.array): The true root location.
+            shape: (2,)
+        n (int): Number of consumed samples.
+        mean (np.array): Mean of the root samples.
+            shape: (2,)
+        comoment (np.array): Sum of the outer products of the deviations from
+            the mean.
+            shape: (2, 2)
+        sq_error_sum (float): Sum of the squared distances to the true root.
+    """
+
+    def __init__(self, true_root):
+        self.true_root = np.asarray(true_root, dtype=float)
+        self.n = 0
+        self.mean = np.zeros(2)
+        self.comoment = np.zeros((2, 2))
+        self.sq_error_sum = 0.
+
+    def update(self, location):
+        """Add a single root sample."""
+        location = np.asarray(location, dtype=float)
+        self.n += 1
+        delta = location - self.mean
+        self.mean = self.mean + delta / self.n
+        self.comoment += np.outer(delta, location - self.mean)
+        self.sq_error_sum += np.sum((location - self.true_root) ** 2)
+
+    def update_block(self, locations):
+        """Add a block of root samples.
+
+        Args:
+            locations (np.array): The root samples.
+                shape: (n_samples, 2)
+        """
+        locations = np.asarray(locations, dtype=float).reshape((-1, 2))
+        if len(locations) == 0:
+            return
+        block = RootErrorAccumulator(self.true_root)
+        block.n = len(locations)
+        block.mean = np.mean(locations, axis=0)
+        deviations = locations - block.mean
+        block.comoment = deviations.T.dot(deviations)
+        block.sq_error_sum = np.sum((locations - self.true_root) ** 2)
+        self.merge(block)
+
+    def update_trees(self, trees, block_size=1000):
+        """Add the root locations of an iterable of trees (or of root
+        locations), collecting them in blocks of ´block_size´ samples."""
+        block = []
+        for t in trees:
+            block.append(getattr(t, 'location', t))
+            if len(block) >= block_size:
+                self.update_block(block)
+                block = []
+        self.update_block(block)
+
+    def merge(self, other):
+        """Add the samples summarized in another accumulator (e.g. of a
+        parallel chain) to this one."""
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.n / n)
+        self.comoment += other.comoment + np.outer(delta, delta) * (self.n * other.n / n)
+        self.sq_error_sum += other.sq_error_sum
+        self.n = n
+        return self
+
+    @property
+    def covariance(self):
+        """The (biased) covariance matrix of the root samples."""
+        return self.comoment / self.n
+
+    @property
+    def mean_offset(self):
+        return self.mean - self.true_root
+
+    @property
+    def bias(self):
+        return np.linalg.norm(self.mean_offset)
+
+    @property
+    def stdev(self):
+        return np.sqrt(np.trace(self.covariance))
+
+    @property
+    def rmse(self):
+        return np.sqrt(self.sq_error_sum / self.n)
+
+    def metrics(self):
+        """The evaluation metrics of `evaluate` (except for the HPD hits)."""
+        offset = self.mean_offset
+        return {
+            'rmse': self.rmse,
+            'bias_x': offset[0],
+            'bias_y': offset[1],
+            'bias_norm': self.bias,
+            'stdev': self.stdev,
+        }
+
+
+def accumulate_root_errors(root, trees):
+    accumulator = RootErrorAccumulator(root)
+    if isinstance(trees, np.ndarray):
+        accumulator.update_block(trees)
+    else:
+        accumulator.update_trees(trees)
+    return accumulator
+
+
 def eval_mean_offset(root, trees):
-    root_samples = [t.location for t in trees]
-    mean_estimate = np.mean(root_samples, axis=0)
-    return mean_estimate - root
+    return accumulate_root_errors(root, trees).mean_offset
 
 
 def eval_bias(root, trees):
-    root_samples = [t.location for t in trees]
-    mean_estimate = np.mean(root_samples, axis=0)
-    return dist(root, mean_estimate)
+    return accumulate_root_errors(root, trees).bias
 
 
 def eval_stdev(root, trees):
-    root_samples = [t.location for t in trees]
-    std = np.std(root_samples, axis=0)
-    return np.linalg.norm(std)
+    return accumulate_root_errors(root, trees).stdev
 
 
 def eval_rmse(root, trees):
-    errors = [dist(root, t.location)**2. for t in trees]
-    return np.mean(errors)**0.5
+    return accumulate_root_errors(root, trees).rmse
+
+
+TREE_STATISTICS = ['n_fossils', 'imbalance', 'deep_imbalance', 'size',
+                   'space_div_dependence', 'clade_connectivity', 'clade_overlap']
+CLADE_STATISTICS = ['space_div_dependence', 'clade_connectivity', 'clade_overlap']
+
+
+class TreeStatistics(object):
+
+    """Summary statistics of a tree (see `TREE_STATISTICS`), computed from one
+    pre-order sweep (the `LCAIndex` construction and the node depths) and one
+    post-order sweep (leaf counts, heights and children sizes) over the tree,
+    plus one Delaunay triangulation of the clade leafs. The results are
+    identical to those of the separate recursive functions (`tree_imbalance`,
+    `Tree.n_fossils`, `diffusion_rate`, ...).
+
+    Attributes:
+        tree (Tree): The tree.
+        lca_index (LCAIndex): The LCA index (nodes in pre-order).
+        lengths (np.array): The branch length of each node.
+        depths (np.array): The depth of each node (as `Tree.depth`).
+        heights (np.array): The height of each node (as `Tree.height`).
+        n_leafs (np.array): The number of leafs below each node.
+        n_children (np.array): The number of children of each node.
+        max_child_leafs (np.array): The number of leafs in the bigger child
+            clade of each node.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.lca_index = LCAIndex(tree)
+        nodes = self.lca_index.nodes
+        parents = self.lca_index.parents.tolist()
+        n = len(nodes)
+        lengths = [node.length for node in nodes]
+
+        # Pre-order sweep: depths (including the root branch, as `Tree.depth`)
+        depths = [tree.length] * n
+        for i in range(1, n):
+            depths[i] = depths[parents[i]] + lengths[i]
+
+        # Post-order sweep (reverse pre-order visits children before parents)
+        n_leafs = [0] * n
+        for i in self.lca_index.leafs:
+            n_leafs[i] = 1
+        heights = [0.] * n
+        n_children = [0] * n
+        max_child_leafs = [0] * n
+        for i in range(n - 1, 0, -1):
+            p = parents[i]
+            n_leafs[p] += n_leafs[i]
+            heights[p] = max(heights[p], heights[i] + lengths[i])
+            n_children[p] += 1
+            max_child_leafs[p] = max(max_child_leafs[p], n_leafs[i])
+
+        assert max(n_children) <= 2
+        self.lengths = np.array(lengths, dtype=float)
+        self.depths = np.array(depths, dtype=float)
+        self.heights = np.array(heights, dtype=float)
+        self.n_leafs = np.array(n_leafs, dtype=int)
+        self.n_children = np.array(n_children, dtype=int)
+        self.max_child_leafs = np.array(max_child_leafs, dtype=int)
+
+    @property
+    def height(self):
+        return self.heights[0]
+
+    def n_fossils(self):
+        leaf_depths = self.depths[self.lca_index.leafs]
+        return int(np.count_nonzero(leaf_depths < self.height))
+
+    def node_imbalances(self):
+        """Vectorized `node_imbalance` of all nodes (in pre-order).
+
+        Returns:
+            np.array: The imbalance of each node.
+                shape: (n_nodes,)
+            np.array: The weight of each node.
+                shape: (n_nodes,)
+        """
+        size = self.n_leafs
+        m = np.ceil(size / 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            imbalances = (self.max_child_leafs - m) / (size - m - 1)
+        imbalances[(self.n_children < 2) | (size < 4)] = np.nan
+
+        even = (size % 2 == 0)
+        weights = np.ones(len(size))
+        weights[even] = 1 - 1 / size[even]
+        weights[even & (imbalances == 0)] *= 2
+        return imbalances, weights
+
+    def imbalance(self, max_depth=None):
+        """Vectorized `tree_imbalance` of the whole tree."""
+        imbalances, weights = self.node_imbalances()
+        if max_depth is not None:
+            selected = self.depths < max_depth
+            imbalances = imbalances[selected]
+            weights = weights[selected]
+        assert len(imbalances) > 0
+
+        not_na = np.isfinite(imbalances)
+        return np.nansum(weights*imbalances) / np.sum(weights[not_na])
+
+    def clades_at_height(self, height):
+        """Node indices of the clades as in `Tree.get_clades_at_height`. Since
+        heights increase towards the root, a node is visited by the recursion
+        iff its parent reaches up to ´height´."""
+        parents = self.lca_index.parents
+        visited = np.ones(len(parents), dtype=bool)
+        visited[1:] = self.heights[parents[1:]] >= height
+        is_clade = visited & (self.heights < height) & \
+                   (self.heights + self.lengths >= height)
+        return np.flatnonzero(is_clade)
+
+    def clade_statistics(self, clade_height):
+        """The clade based statistics for the clades (with more than 2 leafs)
+        at ´clade_height´."""
+        lca_index = self.lca_index
+        clades = self.clades_at_height(clade_height)
+        clades = clades[self.n_leafs[clades] > 2]
+
+        leaf_locations = np.array([lca_index.nodes[i].location for i in lca_index.leafs])
+        clade_locations = [leaf_locations[lca_index.clade_leafs(i)] for i in clades]
+
+        log_div_rate = np.log(self.n_leafs[clades]) / clade_height
+        migr_rate = [diffusion_rate(lca_index.nodes[i], lca_index=lca_index,
+                                    locations=locations)
+                     for i, locations in zip(clades, clade_locations)]
+
+        stats = {}
+        if len(migr_rate) >= 2 and len(log_div_rate) >= 2:
+            stats['space_div_dependence'] = pearsonr(migr_rate, log_div_rate)[0]
+        else:
+            stats['space_div_dependence'] = np.nan
+
+        if len(clades) == 0:
+            clade_connectivity = np.nan
+        else:
+            clade_connectivity = np.mean(delaunay_clade_join_counts(clade_locations))
+        stats['clade_connectivity'] = clade_connectivity
+        stats['clade_overlap'] = 1 - 2*clade_connectivity
+        return stats
+
+    def compute(self, statistics=None):
+        """Compute the selected statistics.
+
+        Args:
+            statistics (list[str]): The names of the statistics (default: all
+                of `TREE_STATISTICS`).
+
+        Returns:
+            dict: The statistics (in the order of `TREE_STATISTICS`).
+        """
+        if statistics is None:
+            statistics = TREE_STATISTICS
+        unknown = set(statistics) - set(TREE_STATISTICS)
+        if unknown:
+            raise ValueError('Unknown tree statistics: %s' % sorted(unknown))
+
+        stats = {}
+        if 'n_fossils' in statistics:
+            # The number of fossils (non contemporary leafs) in the tree.
+            stats['n_fossils'] = self.n_fossils()
+
+        # Global inbalance stats
+        if 'imbalance' in statistics:
+            stats['imbalance'] = self.imbalance()
+        if 'deep_imbalance' in statistics:
+            stats['deep_imbalance'] = self.imbalance(max_depth=0.5 * self.height)
+
+        # Raw size stats
+        if 'size' in statistics:
+            stats['size'] = int(self.n_leafs[0])
+
+        if any(s in statistics for s in CLADE_STATISTICS):
+            clade_stats = self.clade_statistics(clade_height=self.height / 2.)
+            stats.update({k: v for k, v in clade_stats.items() if k in statistics})
+
+        return {k: stats[k] for k in TREE_STATISTICS if k in stats}
+
+
+def tree_statistics(tree, statistics=None):
+    """Summary statistics of ´tree´ (see `TreeStatistics`).
+
+    Args:
+        tree (Tree): The tree.
+        statistics (list[str]): The names of the statistics to compute
+            (default: all of `TREE_STATISTICS`).
+
+    Returns:
+        dict: The statistics.
+    """
+    return TreeStatistics(tree).compute(statistics)
+
+
+def tree_statistics_batch(trees, statistics=None):
+    """Compute `tree_statistics` for each tree in an iterable of trees.
+
+    Returns:
+        list[dict]: The statistics of each tree.
+    """
+    return [TreeStatistics(tree).compute(statistics) for tree in trees]
 
 
-def tree_statistics(tree):
-    stats = {}
-
-    # The number of fossils (non contemporary leafs) in the tree.
-    stats['n_fossils'] = tree.n_fossils()
-    # stats['observed_drift'] = observed_drift(tree)
-    # stats['observed_drift_x'], stats['observed_drift_y'] = mean_offset(tree)
-
-    # Global inbalance stats
-    stats['imbalance'] = tree_imbalance(tree)
-    stats['deep_imbalance'] = tree_imbalance(tree, max_depth=0.5 * tree.height())
+def running_mean(x, N):
+    cumsum = np.cumsum(np.insert(x, 0, 0))
+    return (cumsum[N:] - cumsum[:-N]) / float(N)
 
-    # Raw size stats
-    stats['size'] = tree.n_leafs()
 
-    DROP_FOSSILS = False
-    if DROP_FOSSILS:
-        tree.drop_fossils()
+def evaluate(working_dir, burnin, hpd_values, true_root, use_treeannotator=True,
+             validate_native=True):
+    results = {}
+    trees_path = working_dir + 'nowhere.trees'
+    root_errors = RootErrorAccumulator(true_root)
+
+    if use_treeannotator:
+        results[HPD_SUMMARISER] = TREEANNOTATOR
+        treeannotator_trees = {}
+        for hpd in hpd_values:
+            # Summarize tree using tree-annotator
+            tree = run_treeannotator(hpd, burnin, working_dir=working_dir)
+            treeannotator_trees[hpd] = tree
+
+            # Compute HPD coverage
+            hit = tree.root_in_hpd(true_root, hpd)
+            results['hpd_%i' % hpd] = hit
+            LOGGER.info('\t\tRoot in %i%% HPD: %s' % (hpd, hit))
+
+        if validate_native:
+            # Record the native summary next to the treeannotator results (see
+            # `src.summarize.compare_summary_trees`), which also provides the
+            # root samples
+            native_tree, summary = summarize_posterior(trees_path, hpd_values,
+                                                       burnin=burnin)
+            for hpd in hpd_values:
+                results['native_hpd_%i' % hpd] = native_tree.root_in_hpd(true_root, hpd)
+                comparison = compare_summary_trees(native_tree, treeannotator_trees[hpd],
+                                                   [hpd])
+                results.update({'native_' + k: v for k, v in comparison.items()})
+            root_errors.update_block(summary.root_locations)
+        else:
+            # Stream the root locations of the posterior trees (after burn-in),
+            # reading only the root annotation of each tree
+            root_errors.update_trees(location for _, location in
+                                     iter_root_locations(trees_path, burnin=burnin))
 
-    CLADE_HEIGHT = tree.height() / 2.
-    clades = tree.get_clades_at_height(CLADE_HEIGHT)
-    clades = [t for t in clades if t.n_leafs() > 2]
+    else:
+        # Summarize the posterior for all HPD levels in one pass (the MCC tree
+        # is written next to, not over, the treeannotator summary)
+        results[HPD_SUMMARISER] = NATIVE
+        tree, summary = summarize_posterior(trees_path, hpd_values, burnin=burnin,
+                                            mcc_path=working_dir + 'nowhere_native.tree')
+        for hpd in hpd_values:
+            hit = tree.root_in_hpd(true_root, hpd)
+            results['hpd_%i' % hpd] = hit
+            LOGGER.info('\t\tRoot in %i%% HPD: %s' % (hpd, hit))
+
+        root_errors.update_block(summary.root_locations)
 
-    log_div_rate = [log_diversification_rate(t, height=CLADE_HEIGHT) for t in clades]
-    migr_rate = [diffusion_rate(t) for t in clades]
+    LOGGER.info('\t\tTrue root: %s' % true_root)
+    LOGGER.info('\t\tRec. root: %s' % tree.location)
 
-    if len(migr_rate) >= 2 and len(log_div_rate) >= 2:
-        stats['space_div_dependence'] = pearsonr(migr_rate, log_div_rate)[0]
+    # All error metrics from the accumulated moments
+    results.update(root_errors.metrics())
+    LOGGER.info('\t\tRMSE: %.2f' % results['rmse'])
+    LOGGER.info('\t\tMean offset: (%.2f, %.2f)' % (results['bias_x'], results['bias_y']))
+    LOGGER.info('\t\tBias: %.2f' % results['bias_norm'])
+    LOGGER.info('\t\tStdev: %.2f' % results['stdev'])
+
+    # Convergence diagnostics of the chain (all parameters in the .log file)
+    log_path = working_dir + 'nowhere.log'
+    if os.path.exists(log_path):
+        results.update(diagnostics_summary(log_path, burnin=burnin))
     else:
-        stats['space_div_dependence'] = np.nan
-
-    stats['clade_connectivity'] = mean_clade_overlap(clades)
-    stats['clade_overlap'] = 1 - 2*mean_clade_overlap(clades)
+        results.update({k: np.nan for k in DIAGNOSTIC_METRICS})
+    LOGGER.info('\t\tMin. ESS: %.1f, max. split-R-hat: %.3f, max. |Geweke z|: %.2f' %
+                (results['min_ess'], results['max_rhat'], results['max_geweke']))
 
-    return stats
+    return results
 
 
-def running_mean(x, N):
-    cumsum = np.cumsum(np.insert(x, 0, 0))
-    return (cumsum[N:] - cumsum[:-N]) / float(N)
+def evaluate_analytic(tree, hpd_values, true_root, diffusion_rate=None):
+    """Evaluate the closed-form root reconstruction under Brownian motion on
+    the (fixed) tree `tree` instead of a BEAST posterior sample (see
+    `src.brownian.BrownianReconstruction`). The result has the same entries as
+    `evaluate`, with the posterior moments in place of sample statistics.
 
+    Args:
+        tree (Tree): The tree with the leaf locations.
+        hpd_values (list[int]): The HPD levels in percent.
+        true_root (np.array): The true root location.
+            shape: (2,)
+        diffusion_rate (float): Fixed diffusion rate (default: integrated out).
 
-def evaluate(working_dir, burnin, hpd_values, true_root):
+    Returns:
+        dict: The evaluation metrics.
+    """
     results = {}
-    for hpd in hpd_values:
-        # Summarize tree using tree-annotator
-        tree = run_treeannotator(hpd, burnin, working_dir=working_dir)
+    reconstruction = BrownianReconstruction(tree, diffusion_rate=diffusion_rate)
+    mean = reconstruction.mean()
+    cov = reconstruction.covariance()
 
-        # Compute HPD coverage
-        hit = tree.root_in_hpd(true_root, hpd)
+    for hpd in hpd_values:
+        hit = bool(reconstruction.in_hpd(true_root, hpd))
         results['hpd_%i' % hpd] = hit
         LOGGER.info('\t\tRoot in %i%% HPD: %s' % (hpd, hit))
 
-    # Load posterior trees for other metrics
-    trees = load_trees(working_dir + 'nowhere.trees')
-
     LOGGER.info('\t\tTrue root: %s' % true_root)
-    LOGGER.info('\t\tRec. root: %s' % tree.location)
-
-    # Compute and log RMSE
-    rmse = eval_rmse(true_root, trees)
-    results['rmse'] = rmse
-    LOGGER.info('\t\tRMSE: %.2f' % rmse)
+    LOGGER.info('\t\tRec. root: %s' % mean)
 
-    # Compute and log mean offset
-    offset = eval_mean_offset(true_root, trees)
+    offset = mean - true_root
+    results['rmse'] = np.sqrt(np.sum(offset ** 2) + np.trace(cov))
     results['bias_x'] = offset[0]
     results['bias_y'] = offset[1]
+    results['bias_norm'] = np.hypot(*offset)
+    results['stdev'] = np.sqrt(np.trace(cov))
+    LOGGER.info('\t\tRMSE: %.2f' % results['rmse'])
     LOGGER.info('\t\tMean offset: (%.2f, %.2f)' % tuple(offset))
+    LOGGER.info('\t\tBias: %.2f' % results['bias_norm'])
+    LOGGER.info('\t\tStdev: %.2f' % results['stdev'])
 
-    # Compute and log bias
-    bias = eval_bias(true_root, trees)
-    results['bias_norm'] = bias
-    LOGGER.info('\t\tBias: %.2f' % bias)
+    return results
 
-    # Compute and log standard deviation
-    stdev = eval_stdev(true_root, trees)
-    results['stdev'] = stdev
-    LOGGER.info('\t\tStdev: %.2f' % stdev)
 
-    return results
+class BurninSweep(object):
+
+    """Evaluate the posterior root samples of one replicate for many burn-in
+    and thinning settings, loading the samples only once. The moments of every
+    setting (a suffix of the samples with stride ´thinning´) are taken from
+    prefix sums over the samples of each residue class. The HPD regions are the
+    contour polygons of the KDE of every setting, as in `summarize_posterior`
+    (see `src.summarize.hpd_polygons`). Optionally, the KDEs are evaluated on
+    a shared grid, reusing the cached squared distances between grid points
+    and samples: faster, but the HPD regions (and hits) differ slightly from
+    those of `summarize_posterior`.
+
+    Attributes:
+        root_samples (np.array): The root location samples.
+            shape: (n_samples, 2)
+        states (np.array): The MCMC state of each sample.
+            shape: (n_samples,)
+        true_root (np.array): The true root location.
+            shape: (2,)
+        grid_size (int): Number of grid points per axis of the KDE.
+        shared_grid (bool): Whether to use one KDE grid for all settings (over
+            the range of all samples), or a grid per setting (as in
+            `summarize_posterior`).
+    """
+
+    def __init__(self, root_samples, states, true_root, grid_size=DEFAULT_GRID_SIZE,
+                 shared_grid=False):
+        self.root_samples = np.asarray(root_samples, dtype=float).reshape((-1, 2))
+        self.states = np.asarray(states)
+        self.true_root = np.asarray(true_root, dtype=float)
+        self.grid_size = grid_size
+        self.shared_grid = shared_grid
+        self._prefix_sums = {}
+
+        # Shared KDE grid (as in `kde2d`, over the range of all samples)
+        lower = np.min(self.root_samples, axis=0)
+        upper = np.max(self.root_samples, axis=0)
+        pad = 0.1 * (upper - lower)
+        self.grid_x = np.linspace(lower[0] - pad[0], upper[0] + pad[0], grid_size)
+        self.grid_y = np.linspace(lower[1] - pad[1], upper[1] + pad[1], grid_size)
+        self._sq_dists_x = (self.grid_x[:, None] - self.root_samples[None, :, 0]) ** 2
+        self._sq_dists_y = (self.grid_y[:, None] - self.root_samples[None, :, 1]) ** 2
+
+    def get_start(self, burnin):
+        """Index of the first sample after ´burnin´ (MCMC states)."""
+        return int(np.searchsorted(self.states, burnin, side='left'))
+
+    def get_prefix_sums(self, thinning, residue):
+        """Prefix sums of the offsets to the true root, their squared norms and
+        the outer products of the centred samples over the samples
+        residue, residue + thinning, ..."""
+        key = (thinning, residue)
+        if key not in self._prefix_sums:
+            samples = self.root_samples[residue::thinning]
+            offsets = samples - self.true_root
+            centred = samples - np.mean(self.root_samples, axis=0)
+            outer = centred[:, :, None] * centred[:, None, :]
+
+            def prefix_sum(x):
+                return np.concatenate([np.zeros((1,) + x.shape[1:]), np.cumsum(x, axis=0)])
+
+            self._prefix_sums[key] = (prefix_sum(offsets),
+                                      prefix_sum(np.sum(offsets ** 2, axis=-1)),
+                                      prefix_sum(centred),
+                                      prefix_sum(outer))
+        return self._prefix_sums[key]
+
+    def root_errors(self, burnin, thinning=1):
+        """The error moments of the samples selected by ´burnin´ and
+        ´thinning´ (as in `iter_tree_lines`), from the prefix sums.
+
+        Returns:
+            RootErrorAccumulator: The accumulated moments.
+        """
+        start = self.get_start(burnin)
+        residue = start % thinning
+        k = (start - residue) // thinning
+        offset_sums, sq_error_sums, centred_sums, outer_sums = \
+            self.get_prefix_sums(thinning, residue)
+
+        root_errors = RootErrorAccumulator(self.true_root)
+        root_errors.n = len(offset_sums) - 1 - k
+        if root_errors.n == 0:
+            return root_errors
+        mean_offset = (offset_sums[-1] - offset_sums[k]) / root_errors.n
+        mean_centred = (centred_sums[-1] - centred_sums[k]) / root_errors.n
+        root_errors.mean = self.true_root + mean_offset
+        root_errors.comoment = (outer_sums[-1] - outer_sums[k]) - \
+            root_errors.n * np.outer(mean_centred, mean_centred)
+        root_errors.sq_error_sum = sq_error_sums[-1] - sq_error_sums[k]
+        return root_errors
+
+    def kde(self, burnin, thinning=1):
+        """The KDE of the selected samples on the shared grid (or on the grid
+        of `kde2d` if not ´shared_grid´).
+
+        Returns:
+            np.array: The x coordinates of the grid.
+            np.array: The y coordinates of the grid.
+            np.array: The density at the grid points.
+                shape: (grid_size, grid_size)
+        """
+        selected = slice(self.get_start(burnin), None, thinning)
+        samples = self.root_samples[selected]
+        if not self.shared_grid:
+            return kde2d(samples, grid_size=self.grid_size)
+
+        h = np.array([bandwidth_nrd(samples[:, 0]), bandwidth_nrd(samples[:, 1])]) / 4.
+        h[h <= 0] = 1.
+        kx = np.exp(-0.5 * self._sq_dists_x[:, selected] / h[0] ** 2)
+        ky = np.exp(-0.5 * self._sq_dists_y[:, selected] / h[1] ** 2)
+        z = kx.dot(ky.T) / (2. * np.pi * h[0] * h[1] * len(samples))
+        return self.grid_x, self.grid_y, z
+
+    @property
+    def hpd_summariser(self):
+        return NATIVE_SHARED_GRID if self.shared_grid else NATIVE
+
+    def hpd_hits(self, burnin, thinning, hpd_values):
+        """Check whether the true root is in the HPD regions of the selected
+        samples, i.e. in the contour polygons of their KDE at the HPD levels
+        (see `hpd_polygons`)."""
+        x, y, z = self.kde(burnin, thinning)
+        return {hpd: HPDRegion(contour_polygons(x, y, z, level), hpd).contains_point(self.true_root)
+                for hpd, level in hpd_levels(z, hpd_values).items()}
+
+    def evaluate(self, burnin_fractions, thinning_factors, hpd_values):
+        """Compute the metrics of `evaluate` for all combinations of burn-in
+        fractions (of the last MCMC state) and thinning factors.
+
+        Returns:
+            pd.DataFrame: One row per setting.
+        """
+        chain_length = self.states[-1]
+        rows = []
+        for burnin_fraction in burnin_fractions:
+            burnin = int(burnin_fraction * chain_length)
+            for thinning in thinning_factors:
+                root_errors = self.root_errors(burnin, thinning)
+                row = {'burnin_fraction': burnin_fraction, 'burnin': burnin,
+                       'thinning': thinning, 'n_samples': root_errors.n,
+                       HPD_SUMMARISER: self.hpd_summariser}
+                if root_errors.n < 2:
+                    rows.append(row)
+                    continue
+                row.update(root_errors.metrics())
+                for hpd, hit in self.hpd_hits(burnin, thinning, hpd_values).items():
+                    row['hpd_%i' % hpd] = hit
+                rows.append(row)
+
+        columns = ['burnin_fraction', 'burnin', 'thinning', 'n_samples', 'rmse',
+                   'bias_x', 'bias_y', 'bias_norm', 'stdev'] + \
+                  ['hpd_%i' % hpd for hpd in hpd_values] + [HPD_SUMMARISER]
+        return pd.DataFrame(rows, columns=columns)
+
+
+def evaluate_burnin_sweep(working_dir, hpd_values, true_root, burnin_fractions,
+                          thinning_factors=(1,), shared_grid=False):
+    """Evaluate the posterior of a replicate for several burn-in fractions and
+    thinning factors from one scan of the root samples (see `BurninSweep`).
+
+    Args:
+        working_dir (str): The working directory of the BEAST run.
+        hpd_values (list[int]): The HPD levels in percent.
+        true_root (np.array): The true root location.
+            shape: (2,)
+        burnin_fractions (list[float]): The burn-in as fractions of the chain.
+        thinning_factors (list[int]): The thinning factors.
+        shared_grid (bool): Whether the KDEs share one grid (faster, but the
+            HPD hits may differ from `summarize_posterior`, see `BurninSweep`).
+
+    Returns:
+        pd.DataFrame: The metrics of each setting.
+    """
+    trees_path = working_dir + 'nowhere.trees'
+    root_samples, states = scan_root_locations(trees_path, return_states=True)
+    sweep = BurninSweep(root_samples, states, true_root, shared_grid=shared_grid)
+    return sweep.evaluate(burnin_fractions, thinning_factors, hpd_values)
 
 
 def migration_rate(tree):
@@ -144,11 +709,44 @@ def _diffusion_rate(tree, height=None):
     return np.linalg.norm(std) / height**0.5
 
 
-def diffusion_rate(tree):
-    geo_dists = tree.get_loc_dist_mat()
-    phylo_dists = tree.get_phylo_dist_mat()
-    geo_rates = geo_dists / (phylo_dists ** 0.5)
-    return np.nanmean(geo_rates)
+def diffusion_rate(tree, lca_index=None, metric=EUCLIDEAN,
+                   block_size=DEFAULT_BLOCK_SIZE, locations=None):
+    """Mean ratio of geographic distance and square-root phylogenetic distance
+    over all pairs of leafs in ´tree´. The mean is accumulated over blocks of
+    leaf pairs, so no n x n distance matrices are built.
+
+    Args:
+        tree (Tree): The (sub-)tree for which the rate is computed.
+        lca_index (LCAIndex): Optional LCA index of a tree containing ´tree´ as
+            a clade (allows to reuse the index for many clades).
+        metric (str): Geographic distance metric ('euclidean' or 'great_circle').
+        block_size (int): Approximate number of leaf pairs per block.
+        locations (np.array): Optional leaf locations of ´tree´ (in the order
+            of `Tree.iter_leafs`), to avoid collecting them again.
+
+    Returns:
+        float: The diffusion rate.
+    """
+    if lca_index is None:
+        lca_index = LCAIndex(tree)
+    leafs = lca_index.leafs[lca_index.clade_leafs(tree)]
+    if locations is None:
+        locations = tree.get_leaf_locations()
+
+    rate_sum = 0.
+    n_rates = 0
+    for i, j, geo_dists in iter_pairwise_distances(locations, metric=metric,
+                                                   block_size=block_size):
+        phylo_dists = lca_index.patristic_distance(leafs[i], leafs[j])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            geo_rates = geo_dists / (phylo_dists ** 0.5)
+        valid = ~np.isnan(geo_rates)
+        rate_sum += np.sum(geo_rates[valid])
+        n_rates += np.count_nonzero(valid)
+
+    if n_rates == 0:
+        return np.nan
+    return rate_sum / n_rates
 
 
 def log_diversification_rate(tree, height=None):
@@ -167,22 +765,8 @@ def log_div_rate(tree):
 
 
 def mean_clade_overlap(clades):
-    other_clades = set(clades)
-
-    scores = []
-    for clade in clades:
-        other_clades.remove(clade)
-
-        locations_clade = [node.location for node in clade.iter_leafs()]
-        locations_other = [node.location for other in other_clades for node in other.iter_leafs()]
-        locations = locations_clade + locations_other
-        locations = np.array(locations)
-
-        labels = [1] * len(locations_clade) + [0] * len(locations_other)
-        join_count = delaunay_join_count(locations, labels)
-        scores.append(join_count)
-
-    return np.mean(scores)
+    clade_locations = [clade.get_leaf_locations() for clade in clades]
+    return np.mean(delaunay_clade_join_counts(clade_locations))
 
 
 def mean_offset(tree):
@@ -3,18 +3,28 @@
 from __future__ import absolute_import, division, print_function, \
     unicode_literals
 import os
+import json
+import random
 import logging
 
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 from sklearn.model_selection import ParameterGrid
 
 from src.util import mkpath, experiment_preperations, touch
+from src.beast_cache import get_cache
+from src.tree_archive import TreeArchive
 
 
 LOGGER = logging.getLogger('experiment')
 
 CHECKLIST_FILE_NAME = 'checklist.txt'
 RESULTS_FILE_NAME = 'results.csv'
+CACHE_REPORT_FILE_NAME = 'cache_report.json'
+RUNS_DIR_NAME = 'runs'
+SIMULATED_TREES_FNAME = 'simulated_trees.npz'
 
 
 class Experiment(object):
@@ -36,11 +46,14 @@ class Experiment(object):
             TODO add evaluation functions as arguments?
         working_directory (str): The path to the working directory in which the
             temporary files and final results are stored.
+        n_workers (int): Number of runs executed concurrently (each in its own
+            process and output directory, see `run`).
     """
 
     def __init__(self, pipeline, fixed_params, variable_param_options,
-                 eval_metrics, n_repeat, working_directory):
+                 eval_metrics, n_repeat, working_directory, n_workers=1):
         self.pipeline = pipeline
+        self.n_workers = n_workers
         self.fixed_params = OrderedDict(fixed_params)
         self.variable_param_options = OrderedDict(variable_param_options)
         self.eval_metrics = eval_metrics
@@ -67,8 +80,21 @@ class Experiment(object):
         experiment_preperations(self.working_directory)
         checklist = self.init_or_resume(resume)
 
+        cache = get_cache()
+        if cache is not None:
+            cache.reset_stats()
+
         # Iterate over the grid
         grid = ParameterGrid(self.variable_param_options)
+        if self.n_workers > 1:
+            self.run_concurrent(grid, checklist, cache)
+        else:
+            self.run_sequential(grid, checklist)
+
+        if cache is not None:
+            self.write_cache_report(cache)
+
+    def run_sequential(self, grid, checklist):
         pipeline_args = dict(self.fixed_params, working_dir=self.working_directory)
         for var_params in grid:
             run_id = self.format_params(var_params)
@@ -87,6 +113,43 @@ class Experiment(object):
 
             self.write_run_results(var_params, run_results)
 
+    def run_concurrent(self, grid, checklist, cache):
+        """Run ´n_workers´ pipelines at a time, each in a separate process with
+        its own output directory (´working_directory´/runs/<run_id>/), so that
+        the BEAST analyses of different runs do not overwrite each other. The
+        cores are split evenly between the workers (passed to the pipeline as
+        ´max_cores´) and every run gets its own random seed (drawn from the
+        experiment seed in grid order)."""
+        max_cores = max(1, (os.cpu_count() or 1) // self.n_workers)
+        seeds = np.random.randint(2 ** 31, size=len(grid))
+
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = {}
+            for var_params, seed in zip(grid, seeds):
+                run_id = self.format_params(var_params)
+                if run_id in checklist:
+                    LOGGER.info('\tExperiment already in checklist: %s' % run_id)
+                    continue
+
+                run_dir = os.path.join(self.working_directory, RUNS_DIR_NAME, run_id, '')
+                # Not `mkpath`, which creates names with a dot (run ids with floats) as files
+                os.makedirs(run_dir, exist_ok=True)
+                pipeline_args = dict(self.fixed_params, working_dir=run_dir,
+                                     max_cores=max_cores)
+                pipeline_args.update(var_params)
+                future = executor.submit(run_pipeline, self.pipeline, pipeline_args, int(seed))
+                futures[future] = var_params
+
+            for future in as_completed(futures):
+                var_params = futures[future]
+                run_results, cache_hits, cache_misses = future.result()
+                LOGGER.info('\nFinished experiment with settings: %s' %
+                            self.format_params(var_params))
+                self.write_run_results(var_params, run_results)
+                if cache is not None:
+                    cache.hits += cache_hits
+                    cache.misses += cache_misses
+
     def init_or_resume(self, resume):
         results_path_2 = os.path.join(self.working_directory, RESULTS_FILE_NAME)
         checklist_path = os.path.join(self.working_directory, CHECKLIST_FILE_NAME)
@@ -118,5 +181,66 @@ class Experiment(object):
             run_id = self.format_params(var_params)
             checklist_file.write(run_id + '\n')
 
+    def write_cache_report(self, cache):
+        """Log and save the hits/misses of the BEAST cache in this experiment."""
+        report = cache.report()
+        LOGGER.info('BEAST cache: %i hits, %i misses (%.2f GB)' %
+                    (report['hits'], report['misses'], report['size'] / 2 ** 30))
+
+        report_path = os.path.join(self.working_directory, CACHE_REPORT_FILE_NAME)
+        with open(report_path, 'w') as report_file:
+            json.dump(report, report_file)
+
     def format_params(self, params: dict):
-        return ','.join(['%s=%s' % (k, params[k]) for k in self.variable_param_options.keys()])
\ No newline at end of file
+        return ','.join(['%s=%s' % (k, params[k]) for k in self.variable_param_options.keys()])
+
+
+def run_pipeline(pipeline, pipeline_args, seed):
+    """Run one pipeline in a worker process of `Experiment.run_concurrent`.
+
+    Returns:
+        tuple: The results of the run and the hits and misses of the BEAST
+            cache in this run (the cache statistics of the worker process are
+            not shared with the experiment).
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+
+    cache = get_cache()
+    if cache is not None:
+        cache.reset_stats()
+
+    run_results = pipeline(**pipeline_args)
+
+    if cache is None:
+        return run_results, 0, 0
+    return run_results, cache.hits, cache.misses
+
+
+def experiment_to_archive(working_directory, archive_path,
+                          archive_fname=SIMULATED_TREES_FNAME):
+    """Collect the simulated trees of all runs of an experiment into one binary
+    tree archive (see `src.tree_archive.TreeArchive`). The pipelines append
+    the tree of every replicate to the archive ´archive_fname´ in their working
+    directory: one archive (in the order of the results) for sequential runs,
+    one per run directory for concurrent runs.
+
+    Args:
+        working_directory (str): The working directory of the experiment.
+        archive_path (str): Output path (`.npz` file or directory).
+        archive_fname (str): Name of the archives written by the pipelines.
+
+    Returns:
+        TreeArchive: The written archive.
+        list[str]: The source archives (in the order of the trees).
+    """
+    archive_paths = []
+    for dir_path, dir_names, file_names in os.walk(working_directory):
+        if archive_fname in file_names + dir_names:
+            archive_paths.append(os.path.join(dir_path, archive_fname))
+    archive_paths.sort()
+
+    archive = TreeArchive.concatenate(TreeArchive.open(path, mmap=False)
+                                      for path in archive_paths)
+    archive.save(archive_path)
+    return archive, archive_paths
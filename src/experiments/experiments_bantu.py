@@ -7,9 +7,7 @@ import os
 import sys
 import json
 
-from src.experiments.experiment import Experiment
-from src.evaluation import tree_statistics
-from src.beast_interface import load_trees
+from src.posterior_statistics import posterior_tree_statistics
 from src.util import mkpath
 
 BANTU_POSTERIOR_PATH = 'data/bantu/posterior.trees'
@@ -18,32 +16,17 @@ OUTGROUP_NAMES = ['Fefe_Grassfields', 'Mungaka_Grassfields', 'Bamun_Grassfields'
                   'Kom_Grassfields', 'Oku_Grassfields', 'Aghem_Grassfields',
                   'Njen_Grassfields', 'Moghamo_Grassfields', 'Tiv_Tivoid',]
 
-bantu_trees = load_trees(BANTU_POSTERIOR_PATH, read_name_mapping=True)
-for tree in bantu_trees:
+
+def prepare_bantu_tree(tree):
+    """Load the locations of the Bantu languages and remove the outgroup and
+    all leafs without locations (applied to each posterior tree in the worker
+    processes)."""
     tree.load_locations_from_csv(LOCATIONS_PATH, swap_xy=True)
     leafs_without_locations = [node.name for node in tree.iter_leafs() if node.location is None]
     tree.remove_nodes_by_name(leafs_without_locations)
     tree.remove_nodes_by_name(OUTGROUP_NAMES)
 
 
-for tree in bantu_trees[:3]:
-    print(tree.to_newick())
-
-
-def run_experiment(i_tree, **kwargs):
-    """Run experiment on samples of the Bantu tree posterior distribution.
-
-    Args:
-        i_tree (int): Index of the tree in the Bantu posterior samples.
-
-    Returns:
-        dict: Statistics of the experiments (different error values).
-    """
-    tree = bantu_trees[i_tree]
-    results = tree_statistics(tree)
-    return results
-
-
 if __name__ == '__main__':
 
     # Set working directory
@@ -68,8 +51,7 @@ if __name__ == '__main__':
     with open(WORKING_DIR+'settings.json', 'w') as json_file:
         json.dump(default_settings, json_file)
 
-    # Run the experiment
-    variable_parameters = {'i_tree': list(range(len(bantu_trees)))}
-    experiment = Experiment(run_experiment, default_settings, variable_parameters,
-                            EVAL_METRICS, 1, WORKING_DIR)
-    experiment.run(resume=0)
+    # Compute the statistics of all posterior trees in a process pool
+    posterior_tree_statistics(BANTU_POSTERIOR_PATH, WORKING_DIR + 'results.csv',
+                              statistics=EVAL_METRICS, read_name_mapping=True,
+                              prepare_tree=prepare_bantu_tree, resume=True)
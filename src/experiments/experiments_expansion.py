@@ -8,17 +8,20 @@ import json
 import scipy
 import numpy as np
 
-from src.experiments.experiment import Experiment
-from src.evaluation import evaluate, tree_statistics
+from src.experiments.experiment import Experiment, SIMULATED_TREES_FNAME
+from src.diagnostics import DIAGNOSTIC_METRICS
+from src.tree_archive import append_to_tree_archive
+from src.evaluation import evaluate, evaluate_analytic, tree_statistics
 from src.simulation.simulation import run_simulation
 from src.simulation.expansion_simulation import init_cone_simulation
+from src.beast_cache import BeastCache, set_cache
 from src.beast_interface import run_beast
 from src.util import mkpath, parse_arg
 
 
 def run_experiment(n_steps, grid_size, cone_angle, split_size_range,
                    chain_length, burnin, hpd_values, working_dir,
-                   movement_model='rrw', **kwargs):
+                   movement_model='rrw', ess_threshold=None, max_cores=None, **kwargs):
     """Run an experiment ´n_runs´ times with the specified parameters.
 
     Args:
@@ -35,7 +38,12 @@ def run_experiment(n_steps, grid_size, cone_angle, split_size_range,
 
     Keyword Args:
         movement_model (str): The movement to be used in BEAST analysis
-            Options: ['brownian', 'rrw', 'cdrw', 'rdrw']
+            Options: ['brownian', 'rrw', 'cdrw', 'rdrw'], or 'brownian_analytic'
+            for the closed-form Brownian reconstruction (no BEAST run).
+        ess_threshold (float): Stop the BEAST chain early once the ESS of the
+            monitored parameters reaches this threshold (None: run full chain).
+        max_cores (int): Cores available for the BEAST analysis (set by
+            `Experiment` when several runs are executed concurrently).
 
     Returns:
         dict: Statistics of the experiments (different error values).
@@ -55,18 +63,32 @@ def run_experiment(n_steps, grid_size, cone_angle, split_size_range,
     run_simulation(n_steps, tree_simu, world)
     root = tree_simu.location
 
+    # Keep the simulated tree of every replicate (see `experiment_to_archive`)
+    append_to_tree_archive([tree_simu], working_dir + SIMULATED_TREES_FNAME)
+
     if movement_model == 'tree_statistics':
         results = tree_statistics(tree_simu)
+    elif movement_model == 'brownian_analytic':
+        results = evaluate_analytic(tree_simu, hpd_values, root)
+        results['stop_state'] = None
+        results['beast_cpu_time'] = np.nan
+        results['beast_peak_rss'] = np.nan
+        results.update({k: np.nan for k in DIAGNOSTIC_METRICS})
     else:
         # Create an XML file as input for the BEAST analysis
         tree_simu.write_beast_xml(xml_path, chain_length, movement_model=movement_model,
                                   drift_prior_std=1.)
 
         # Run phylogeographic reconstruction in BEAST
-        run_beast(working_dir=working_dir)
+        beast_result = run_beast(working_dir=working_dir, ess_threshold=ess_threshold,
+                                 burnin=burnin, max_cores=max_cores)
 
         results = evaluate(working_dir, burnin, hpd_values, root)
+        results['stop_state'] = beast_result.stop_state
+        results['beast_cpu_time'] = beast_result.cpu_time
+        results['beast_peak_rss'] = beast_result.peak_rss
 
+    if movement_model != 'tree_statistics':
         # Add statistics about simulated tree (to compare between simulation modes)
         results['observed_stdev'] = np.hypot(*np.std(tree_simu.get_leaf_locations(), axis=0))
         leafs_mean = np.mean(tree_simu.get_leaf_locations(), axis=0)
@@ -90,6 +112,7 @@ if __name__ == '__main__':
     MOVEMENT_MODEL = parse_arg(1, 'rrw')
     N_REPEAT = parse_arg(2, 100, int)
     TREE_SIZE = parse_arg(3, NORMAL, int)
+    N_WORKERS = parse_arg(4, 1, int)
 
     # Set working directory
     WORKING_DIR = 'experiments/constrained_expansion/{mm}_treesize={treesize}/'
@@ -131,7 +154,9 @@ if __name__ == '__main__':
     if MOVEMENT_MODEL != 'tree_statistics':
         EVAL_METRICS += ['rmse', 'bias_x', 'bias_y', 'bias_norm', 'stdev'] + \
                         ['hpd_%i' % p for p in HPD_VALUES] + \
-                        ['observed_stdev', 'observed_drift_x',  'observed_drift_y', 'observed_drift_norm']
+                        ['observed_stdev', 'observed_drift_x',  'observed_drift_y', 'observed_drift_norm'] + \
+                        ['stop_state', 'beast_cpu_time', 'beast_peak_rss'] + \
+                        DIAGNOSTIC_METRICS
 
     # Safe the default settings
     with open(WORKING_DIR+'settings.json', 'w') as json_file:
@@ -139,6 +164,10 @@ if __name__ == '__main__':
 
     # Run the experiment
     variable_parameters = {'cone_angle': np.linspace(0.25, 2, 8) * np.pi}
+    # Reuse BEAST results of identical analyses (same XML and seed)
+    set_cache(BeastCache())
+
     experiment = Experiment(run_experiment, default_settings, variable_parameters,
-                            EVAL_METRICS, N_REPEAT, WORKING_DIR)
+                            EVAL_METRICS, N_REPEAT, WORKING_DIR,
+                            n_workers=N_WORKERS)
     experiment.run(resume=1)
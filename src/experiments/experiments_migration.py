@@ -10,11 +10,15 @@ import datetime
 
 import numpy as np
 
-from src.experiments.experiment import Experiment
+from src.experiments.experiment import Experiment, SIMULATED_TREES_FNAME
 from src.simulation.simulation import run_simulation
 from src.simulation.migration_simulation import VectorState, VectorWorld
+from src.beast_cache import BeastCache, set_cache
 from src.beast_interface import (run_beast)
-from src.evaluation import (evaluate, tree_statistics)
+from src.birth_death import BirthDeathCalibration
+from src.diagnostics import DIAGNOSTIC_METRICS
+from src.tree_archive import append_to_tree_archive
+from src.evaluation import (evaluate, evaluate_analytic, tree_statistics)
 from src.util import (total_drift_2_step_drift, total_diffusion_2_step_var,
                       normalize, mkpath, parse_arg)
 
@@ -32,7 +36,8 @@ def run_experiment(n_steps, n_expected_leafs, total_drift,
                    total_diffusion, drift_density, p_settle, drift_direction,
                    chain_length, burnin, hpd_values, working_dir,
                    turnover=0.2, clock_rate=1.0, movement_model='rrw',
-                   max_fossil_age=0, min_n_fossils=10, **kwargs):
+                   max_fossil_age=0, min_n_fossils=10, ess_threshold=None,
+                   calibrate_rates=False, max_cores=None, **kwargs):
     """Run an experiment ´n_runs´ times with the specified parameters.
 
     Args:
@@ -55,13 +60,22 @@ def run_experiment(n_steps, n_expected_leafs, total_drift,
 
     Kwargs:
         movement_model (str): The movement to be used in BEAST analysis
-            ('rrw' or 'brownian').
+            ('rrw' or 'brownian'), or 'brownian_analytic' for the closed-form
+            Brownian reconstruction on the simulated tree (no BEAST run).
         working_dir (str): The working directory in which intermediate files
             will be dumped.
+        ess_threshold (float): Stop the BEAST chain early once the ESS of the
+            monitored parameters reaches this threshold (None: run full chain).
+        max_cores (int): Cores available for the BEAST analysis (set by
+            `Experiment` when several runs are executed concurrently).
         drop_fossils (bool): Remove extinct taxa from the sampled phylogeny.
         max_fossil_age (float): Remove all fossils older than this.
         min_n_fossils (int): If `max_fossil_age` is set: Ensure sampled trees
             have at least this many fossils.
+        calibrate_rates (bool): Choose the birth rate that maximises the
+            probability of accepting a simulated tree (see
+            `src.birth_death.BirthDeathCalibration`) instead of deriving it
+            from the expected number of leafs.
 
     Returns:
         dict: Statistics of the experiments (different error values).
@@ -95,6 +109,11 @@ def run_experiment(n_steps, n_expected_leafs, total_drift,
     eff_div_rate = np.log(n_expected_leafs) / n_steps
     birth_rate = eff_div_rate / (1 - turnover)
     death_rate = birth_rate * turnover
+    if calibrate_rates:
+        calibration = BirthDeathCalibration(n_steps, (min_leaves, max_leaves),
+                                            clock_rate=clock_rate)
+        birth_rate, death_rate, p_accept = calibration.calibrate(turnover, birth_rate)
+        pp(l(), p_accept)
     pp(l(), birth_rate)
     pp(l(), death_rate)
 
@@ -148,9 +167,20 @@ def run_experiment(n_steps, n_expected_leafs, total_drift,
                 print('Invalid: Not enough fossils (only %i)' % tree_simu.n_fossils())
 
     print('Valid tree with %i leaves and %i fossils' % (tree_simu.n_leafs(), tree_simu.n_fossils()))
+
+    # Keep the simulated tree of every replicate (see `experiment_to_archive`)
+    append_to_tree_archive([tree_simu], working_dir + SIMULATED_TREES_FNAME)
+
     if movement_model == 'tree_statistics':
         results = {}
 
+    elif movement_model == 'brownian_analytic':
+        results = evaluate_analytic(tree_simu, hpd_values, root)
+        results['stop_state'] = None
+        results['beast_cpu_time'] = np.nan
+        results['beast_peak_rss'] = np.nan
+        results.update({k: np.nan for k in DIAGNOSTIC_METRICS})
+
     else:
 
         p("# making xml tree starts")
@@ -160,11 +190,16 @@ def run_experiment(n_steps, n_expected_leafs, total_drift,
 
         # Run phylogeographic reconstruction in BEAST
         p("# BEAST starts")
-        run_beast(working_dir=working_dir)
+        beast_result = run_beast(working_dir=working_dir, ess_threshold=ess_threshold,
+                                 burnin=burnin, max_cores=max_cores)
 
         p("# tree evaluating starts")
         results = evaluate(working_dir, burnin, hpd_values, root)
+        results['stop_state'] = beast_result.stop_state
+        results['beast_cpu_time'] = beast_result.cpu_time
+        results['beast_peak_rss'] = beast_result.peak_rss
 
+    if movement_model != 'tree_statistics':
         p("# tree stats")
         # Add statistics about simulated tree (to compare between simulation modes)
         results['observed_stdev'] = np.hypot(*np.std(tree_simu.get_leaf_locations(), axis=0))
@@ -198,6 +233,7 @@ if __name__ == '__main__':
     MAX_FOSSIL_AGE = parse_arg(2, 0, int)
     N_REPEAT = parse_arg(3, 100, int)
     TREE_SIZE = parse_arg(4, NORMAL, int)
+    N_WORKERS = parse_arg(5, 1, int)
 
     # Set working directory
     today = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M')
@@ -240,7 +276,9 @@ if __name__ == '__main__':
     if MOVEMENT_MODEL != 'tree_statistics':
         EVAL_METRICS += ['rmse', 'bias_x', 'bias_y', 'bias_norm', 'stdev'] + \
                         ['hpd_%i' % p for p in HPD_VALUES] + \
-                        ['observed_stdev', 'observed_drift_x',  'observed_drift_y', 'observed_drift_norm']
+                        ['observed_stdev', 'observed_drift_x',  'observed_drift_y', 'observed_drift_norm'] + \
+                        ['stop_state', 'beast_cpu_time', 'beast_peak_rss'] + \
+                        DIAGNOSTIC_METRICS
 
     # Safe the default settings
     with open(WORKING_DIR+'settings.json', 'w') as json_file:
@@ -250,6 +288,10 @@ if __name__ == '__main__':
     total_drift_values = np.linspace(0., 3., 7) * default_settings['total_diffusion']
     variable_parameters = {'total_drift': total_drift_values}
 
+    # Reuse BEAST results of identical analyses (same XML and seed)
+    set_cache(BeastCache())
+
     experiment = Experiment(run_experiment, default_settings, variable_parameters,
-                            EVAL_METRICS, N_REPEAT, WORKING_DIR)
+                            EVAL_METRICS, N_REPEAT, WORKING_DIR,
+                            n_workers=N_WORKERS)
     experiment.run(resume=0)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import numpy as np
+from matplotlib.path import Path
+from shapely.geometry import Point, LineString
+from shapely.ops import unary_union, polygonize
+from shapely.prepared import prep
+
+DEFAULT_CHUNK_SIZE = 2 ** 16  # Number of (point, edge) pairs per block
+
+
+class HPDRegion(object):
+
+    """A highest posterior density (HPD) region, given as a union of polygons
+    (as in the HPD attributes written by treeannotator). The polygons are
+    parsed once, all queries are answered from cached (prepared) geometries
+    and are vectorized over arrays of points.
+
+    Attributes:
+        polygons (list[Polygon]): The polygons of the HPD region.
+        p_hpd (int): The HPD level in percent.
+        paths (list[Path]): Matplotlib paths of the polygon exteriors (used for
+            vectorized point-in-polygon tests).
+        interior_paths (list[list[Path]]): Matplotlib paths of the holes of
+            each polygon.
+        edges (np.array): Start and end point of all polygon edges.
+            shape: (n_edges, 2, 2)
+    """
+
+    def __init__(self, polygons, p_hpd=None):
+        self.polygons = list(polygons)
+        self.p_hpd = p_hpd
+        self.paths = [Path(np.array(p.exterior.coords)) for p in self.polygons]
+        self.interior_paths = [[Path(np.array(interior.coords))
+                                for interior in p.interiors]
+                               for p in self.polygons]
+
+        edges = []
+        for polygon in self.polygons:
+            rings = [polygon.exterior] + list(polygon.interiors)
+            for ring in rings:
+                coords = np.array(ring.coords)
+                edges.append(np.stack([coords[:-1], coords[1:]], axis=1))
+        if edges:
+            self.edges = np.concatenate(edges)
+        else:
+            self.edges = np.empty((0, 2, 2))
+
+        self._geometry = None
+        self._prepared = None
+        self._prepared_polygons = None
+
+    @classmethod
+    def from_tree(cls, node, p_hpd, location_key='location'):
+        """Parse the HPD region at level ´p_hpd´ from the attributes of ´node´
+        (see `Tree.get_hpd`)."""
+        return cls(node.get_hpd(p_hpd, location_key=location_key), p_hpd=p_hpd)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    @property
+    def geometry(self):
+        """The union of all polygons (shapely geometry). Invalid (e.g.
+        self-intersecting) polygons are repaired first (see `repair_polygon`),
+        since the union of invalid polygons can fail."""
+        if self._geometry is None:
+            self._geometry = unary_union([repair_polygon(p) for p in self.polygons])
+        return self._geometry
+
+    @property
+    def prepared(self):
+        """The prepared geometry of the region, for repeated single queries."""
+        if self._prepared is None:
+            self._prepared = prep(self.geometry)
+        return self._prepared
+
+    @property
+    def prepared_polygons(self):
+        """The polygons, prepared for repeated single queries (invalid polygons
+        are kept unprepared, as GEOS can only test those directly)."""
+        if self._prepared_polygons is None:
+            self._prepared_polygons = [prep(p) if p.is_valid else p
+                                       for p in self.polygons]
+        return self._prepared_polygons
+
+    @property
+    def area(self):
+        return self.geometry.area
+
+    @property
+    def bounds(self):
+        return self.geometry.bounds
+
+    def contains_point(self, point):
+        """Check whether a single point (Point or pair of coordinates) lies in
+        the region, i.e. in any of its polygons (tested one by one, so that
+        invalid polygons don't break the query)."""
+        if not isinstance(point, Point):
+            assert len(point) == 2
+            point = Point(point[0], point[1])
+        return any(p.contains(point) for p in self.prepared_polygons)
+
+    def contains(self, points):
+        """Vectorized test, which of the given points lie in the region.
+
+        Args:
+            points (np.array): The points to be tested.
+                shape: (..., 2)
+
+        Returns:
+            np.array: Boolean mask of the points inside the region.
+                shape: (...)
+        """
+        points = np.asarray(points, dtype=float)
+        flat_points = points.reshape((-1, 2))
+        inside = np.zeros(len(flat_points), dtype=bool)
+        for path, interior_paths in zip(self.paths, self.interior_paths):
+            # The holes of a polygon only cut out points of that polygon
+            in_polygon = path.contains_points(flat_points)
+            for interior_path in interior_paths:
+                in_polygon &= ~interior_path.contains_points(flat_points)
+            inside |= in_polygon
+        return inside.reshape(points.shape[:-1])
+
+    def boundary_distance(self, points, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Compute the distance of each point to the nearest boundary of the
+        region (vectorized over points and polygon edges, in blocks of roughly
+        ´chunk_size´ point-edge pairs).
+
+        Args:
+            points (np.array): The points.
+                shape: (..., 2)
+
+        Returns:
+            np.array: The distance to the closest polygon edge (inf if the
+                region is empty).
+                shape: (...)
+        """
+        points = np.asarray(points, dtype=float)
+        flat_points = points.reshape((-1, 2))
+        distances = np.full(len(flat_points), np.inf)
+        if len(self.edges) == 0:
+            return distances.reshape(points.shape[:-1])
+
+        a = self.edges[:, 0]
+        ab = self.edges[:, 1] - a
+        ab_norm2 = np.sum(ab ** 2, axis=-1)
+        ab_norm2[ab_norm2 == 0] = 1.
+
+        block_size = max(1, chunk_size // len(self.edges))
+        for start in range(0, len(flat_points), block_size):
+            p = flat_points[start:start + block_size, None, :]
+
+            # Project the points onto each edge and clip to the segment
+            t = np.sum((p - a) * ab, axis=-1) / ab_norm2
+            t = np.clip(t, 0., 1.)
+            closest = a + t[..., None] * ab
+            d = np.hypot(p[..., 0] - closest[..., 0], p[..., 1] - closest[..., 1])
+            distances[start:start + block_size] = np.min(d, axis=-1)
+
+        return distances.reshape(points.shape[:-1])
+
+    def signed_distance(self, points, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Like `boundary_distance`, but negative for points inside the
+        region."""
+        distances = self.boundary_distance(points, chunk_size=chunk_size)
+        return np.where(self.contains(points), -distances, distances)
+
+    def coverage_map(self, x, y):
+        """Rasterize the region on the grid given by the coordinates ´x´ and
+        ´y´.
+
+        Args:
+            x (np.array): The x coordinates of the grid.
+                shape: (n_x,)
+            y (np.array): The y coordinates of the grid.
+                shape: (n_y,)
+
+        Returns:
+            np.array: Boolean raster, True where the grid point lies in the region.
+                shape: (n_y, n_x)
+        """
+        grid = np.stack(np.meshgrid(x, y), axis=-1)
+        return self.contains(grid)
+
+
+def repair_polygon(polygon):
+    """Make an invalid (e.g. self-intersecting) polygon valid, keeping all its
+    lobes (`buffer(0)` alone drops the lobes of one orientation)."""
+    if polygon.is_valid:
+        return polygon
+    try:
+        from shapely.validation import make_valid
+    except ImportError:
+        # Shapely < 1.8: split the noded rings into faces and keep the faces
+        # inside the polygon (as tested on the invalid polygon itself)
+        rings = [polygon.exterior] + list(polygon.interiors)
+        faces = polygonize(unary_union([LineString(ring.coords) for ring in rings]))
+        return unary_union([face for face in faces
+                            if polygon.contains(face.representative_point())])
+    return make_valid(polygon)
+
+
+def hpd_coverage(regions, points):
+    """Test many points against many HPD regions (e.g. of every run and every
+    HPD level) at once.
+
+    Args:
+        regions (list[HPDRegion]): The HPD regions.
+        points (np.array): The points.
+            shape: (n_points, 2)
+
+    Returns:
+        np.array: Boolean coverage matrix.
+            shape: (n_regions, n_points)
+    """
+    points = np.asarray(points, dtype=float)
+    coverage = np.zeros((len(regions), len(points)), dtype=bool)
+    for i, region in enumerate(regions):
+        coverage[i] = region.contains(points)
+    return coverage
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import numpy as np
+
+
+class LCAIndex(object):
+
+    """Lowest common ancestor (LCA) index of a tree, based on an Euler tour and
+    a sparse table of range minima. After an O(n log n) construction the LCA
+    and the patristic distance of any pair of nodes are answered in O(1)
+    (vectorized over arrays of node pairs). Works for arbitrary trees, i.e.
+    including fossils (non-ultrametric) and polytomies.
+
+    Nodes are indexed in depth-first pre-order, so that an ancestor always has
+    a smaller index than its descendants and every clade is a contiguous range
+    of nodes (and of leafs).
+
+    Attributes:
+        nodes (list[Tree]): All nodes of the tree in pre-order.
+        parents (np.array): Index of the parent of each node (-1 for the root).
+        depths (np.array): Cumulative branch length from the root to each node
+            (the length of the root branch itself is not included).
+        subtree_sizes (np.array): Number of nodes in the subtree of each node.
+        leafs (np.array): Node indices of all leafs (in pre-order, i.e. the
+            order of `Tree.iter_leafs`).
+        first_visit (np.array): Position of the first visit of each node in
+            the Euler tour.
+        sparse_table (np.array): sparse_table[k, i] is the minimal node index
+            in the Euler tour window [i, i + 2^k).
+    """
+
+    def __init__(self, tree):
+        self.nodes = tree.get_descendants()
+        n = len(self.nodes)
+        node_idx = {id(node): i for i, node in enumerate(self.nodes)}
+        self._node_idx = node_idx
+
+        self.parents = np.full(n, -1, dtype=int)
+        self.depths = np.zeros(n)
+        children = [[] for _ in range(n)]
+        for i, node in enumerate(self.nodes[1:], start=1):
+            p = node_idx[id(node.parent)]
+            self.parents[i] = p
+            self.depths[i] = self.depths[p] + node.length
+            children[p].append(i)
+
+        # Subtree sizes (reverse pre-order visits children before parents)
+        self.subtree_sizes = np.ones(n, dtype=int)
+        for i in range(n - 1, 0, -1):
+            self.subtree_sizes[self.parents[i]] += self.subtree_sizes[i]
+
+        self.leafs = np.array([i for i in range(n) if not children[i]], dtype=int)
+
+        # Euler tour (iterative, to avoid recursion limits on deep trees)
+        euler = np.empty(2 * n - 1, dtype=int)
+        self.first_visit = np.empty(n, dtype=int)
+        euler[0] = 0
+        self.first_visit[0] = 0
+        pos = 1
+        stack = [0]
+        next_child = [0] * n
+        while stack:
+            v = stack[-1]
+            if next_child[v] < len(children[v]):
+                c = children[v][next_child[v]]
+                next_child[v] += 1
+                euler[pos] = c
+                self.first_visit[c] = pos
+                pos += 1
+                stack.append(c)
+            else:
+                stack.pop()
+                if stack:
+                    euler[pos] = stack[-1]
+                    pos += 1
+
+        # Sparse table of range minima over the Euler tour. Since nodes are
+        # indexed in pre-order, the minimal index in the tour between two
+        # nodes is their LCA.
+        m = len(euler)
+        n_levels = max(1, int(np.floor(np.log2(m))) + 1)
+        self.sparse_table = np.empty((n_levels, m), dtype=int)
+        self.sparse_table[0] = euler
+        for k in range(1, n_levels):
+            half = 1 << (k - 1)
+            prev = self.sparse_table[k - 1]
+            self.sparse_table[k, :m - half] = np.minimum(prev[:m - half], prev[half:])
+            self.sparse_table[k, m - half:] = prev[m - half:]
+
+        self._log2 = np.zeros(m + 1, dtype=int)
+        self._log2[2:] = np.floor(np.log2(np.arange(2, m + 1))).astype(int)
+
+    @property
+    def n_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def n_leafs(self):
+        return len(self.leafs)
+
+    def node_index(self, node):
+        """Get the pre-order index of the given node (Tree object)."""
+        return self._node_idx[id(node)]
+
+    def lca(self, u, v):
+        """Compute the lowest common ancestor of the nodes with indices ´u´ and
+        ´v´ (scalars or arrays of equal shape).
+
+        Returns:
+            int or np.array: Index of the LCA of each pair.
+        """
+        fu = self.first_visit[u]
+        fv = self.first_visit[v]
+        lo = np.minimum(fu, fv)
+        hi = np.maximum(fu, fv)
+        k = self._log2[hi - lo + 1]
+        return np.minimum(self.sparse_table[k, lo],
+                          self.sparse_table[k, hi - (1 << k) + 1])
+
+    def patristic_distance(self, u, v):
+        """Compute the patristic distance (length of the path in the tree)
+        between the nodes with indices ´u´ and ´v´ (scalars or arrays)."""
+        w = self.lca(u, v)
+        return self.depths[u] + self.depths[v] - 2 * self.depths[w]
+
+    def clade_leafs(self, clade=None):
+        """Get the positions (in `self.leafs`) of all leafs in the given clade.
+        Since clades are contiguous in pre-order, this is a slice.
+
+        Args:
+            clade (Tree or int or None): The root node of the clade (or its
+                index). None for the whole tree.
+
+        Returns:
+            slice: The positions of the clade leafs in `self.leafs`.
+        """
+        if clade is None:
+            return slice(0, self.n_leafs)
+        if not isinstance(clade, (int, np.integer)):
+            clade = self.node_index(clade)
+
+        start = np.searchsorted(self.leafs, clade)
+        stop = np.searchsorted(self.leafs, clade + self.subtree_sizes[clade])
+        return slice(int(start), int(stop))
+
+    def cophenetic_vector(self, leafs=None):
+        """Compute the pairwise patristic distances between leafs as a
+        condensed distance vector (upper triangle in row-major order, as in
+        `scipy.spatial.distance.pdist`).
+
+        Args:
+            leafs (slice or np.array or None): Positions (in `self.leafs`) of
+                the leafs to be included. Default: all leafs.
+
+        Returns:
+            np.array: The condensed distance vector.
+                shape: (n * (n-1) / 2,)
+        """
+        nodes = self.leafs if leafs is None else self.leafs[leafs]
+        i, j = np.triu_indices(len(nodes), k=1)
+        return self.patristic_distance(nodes[i], nodes[j])
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+import os
+import json
+import time
+import shutil
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from src.beast_interface import index_tree_lines, iter_tree_chunk
+from src.evaluation import TreeStatistics, TREE_STATISTICS
+from src.tree_archive import TreeArchive
+
+LOGGER = logging.getLogger('experiment')
+
+DEFAULT_CHUNK_SIZE = 50
+PARTS_DIR_SUFFIX = '.parts'
+PART_FNAME = 'part_%06i.csv'
+MANIFEST_FNAME = 'manifest.json'
+TREES_EXTENSION = '.trees'
+
+
+def _compute_chunk(source, i_trees, locators, name_map, statistics, prepare_tree):
+    """Compute the statistics of one chunk of trees (run in a worker process).
+
+    Returns:
+        pd.DataFrame: One row of statistics per tree.
+    """
+    if source.endswith(TREES_EXTENSION):
+        trees = iter_tree_chunk(source, locators, name_map)
+    else:
+        archive = TreeArchive.open(source)
+        trees = (archive.get_tree(i) for i in locators)
+
+    rows = []
+    for tree in trees:
+        if prepare_tree is not None:
+            prepare_tree(tree)
+        rows.append(TreeStatistics(tree).compute(statistics))
+
+    return pd.DataFrame(rows, index=pd.Index(i_trees, name='i_tree'))
+
+
+def _parts_manifest(source, statistics, chunk_size, burnin, thinning, max_trees,
+                    read_name_mapping, prepare_tree, n_trees):
+    """The settings of a run, stored with its part files, which determine the
+    content of the parts (a resumed run only reuses parts of equal settings)."""
+    source_stat = os.stat(source)
+    if prepare_tree is not None:
+        prepare_tree = '%s.%s' % (prepare_tree.__module__, prepare_tree.__qualname__)
+    return {
+        'source': os.path.abspath(source),
+        'source_size': source_stat.st_size,
+        'source_mtime': source_stat.st_mtime,
+        'statistics': list(statistics),
+        'chunk_size': chunk_size,
+        'burnin': burnin,
+        'thinning': thinning,
+        'max_trees': max_trees,
+        'read_name_mapping': read_name_mapping,
+        'prepare_tree': prepare_tree,
+        'n_trees': n_trees,
+    }
+
+
+def _is_valid_part(part_path, chunk):
+    """Check whether a part file exists and contains exactly the trees of
+    ´chunk´."""
+    if not os.path.exists(part_path):
+        return False
+    try:
+        i_trees = pd.read_csv(part_path, usecols=['i_tree'])['i_tree'].values
+    except (ValueError, pd.errors.ParserError, pd.errors.EmptyDataError):
+        return False
+    return np.array_equal(i_trees, chunk)
+
+
+def index_posterior(source, burnin=0, thinning=1, max_trees=None,
+                    read_name_mapping=False):
+    """Index the trees of a BEAST `.trees` file or a tree archive (see
+    `TreeArchive.save`) without parsing them. Burn-in, thinning and
+    ´max_trees´ are applied as in `iter_tree_lines` (archives without MCMC
+    states are indexed by tree number).
+
+    Returns:
+        np.array: The locator of each selected tree, i.e. its byte offset in
+            the `.trees` file or its index in the archive.
+            shape: (n_trees,)
+        np.array: The MCMC state of each selected tree.
+            shape: (n_trees,)
+        dict or None: The translate table of the `.trees` file.
+    """
+    if source.endswith(TREES_EXTENSION):
+        return index_tree_lines(source, burnin=burnin, thinning=thinning,
+                                max_trees=max_trees,
+                                read_name_mapping=read_name_mapping)
+
+    archive = TreeArchive.open(source)
+    if archive.states is None:
+        states = np.arange(len(archive))
+    else:
+        states = np.asarray(archive.states, dtype=np.int64)
+    indices = np.flatnonzero(states >= burnin)[::thinning][:max_trees]
+    return indices, states[indices], None
+
+
+def posterior_tree_statistics(source, results_path, statistics=None, workers=None,
+                              chunk_size=DEFAULT_CHUNK_SIZE, burnin=0, thinning=1,
+                              max_trees=None, read_name_mapping=False,
+                              prepare_tree=None, resume=True):
+    """Compute the tree statistics (see `TreeStatistics`) of all samples in a
+    posterior distribution of trees in a pool of worker processes and write
+    them into one table (a CSV file with one row per tree and one column per
+    statistic).
+
+    The trees are processed in chunks of ´chunk_size´ trees. Each finished
+    chunk is written to a part file next to the results, so that an
+    interrupted run can be resumed without recomputing these chunks. The
+    settings of the run are stored with the parts; parts of a run with other
+    settings (or of a changed source) are discarded.
+
+    Args:
+        source (str): Path to a BEAST `.trees` file or to a tree archive.
+        results_path (str): Path of the output CSV file.
+        statistics (list[str]): The statistics to compute (default: all of
+            `TREE_STATISTICS`).
+        workers (int): Number of worker processes (default: number of CPUs).
+        chunk_size (int): Number of trees per work item.
+        burnin (int): Number of MCMC states to be discarded as burn-in.
+        thinning (int): Only every ´thinning´th tree (after burn-in) is used.
+        max_trees (int): Maximum number of trees.
+        read_name_mapping (bool): Whether to translate the taxon ids to names.
+        prepare_tree (callable): Optional function applied to each tree before
+            computing the statistics (e.g. to load locations or drop taxa). It
+            has to be picklable, i.e. defined at module level.
+        resume (bool): Whether to reuse the finished chunks of a previous run
+            (with the same settings).
+
+    Returns:
+        pd.DataFrame: The statistics of all trees (indexed by `i_tree`).
+    """
+    if statistics is None:
+        statistics = TREE_STATISTICS
+    if workers is None:
+        workers = os.cpu_count()
+
+    locators, states, name_map = index_posterior(
+        source, burnin=burnin, thinning=thinning, max_trees=max_trees,
+        read_name_mapping=read_name_mapping)
+    n_trees = len(locators)
+    chunks = [np.arange(start, min(start + chunk_size, n_trees))
+              for start in range(0, n_trees, chunk_size)]
+
+    # Part files of the chunks (reused when resuming)
+    parts_dir = results_path + PARTS_DIR_SUFFIX
+    manifest_path = os.path.join(parts_dir, MANIFEST_FNAME)
+    manifest = _parts_manifest(source, statistics, chunk_size, burnin, thinning,
+                               max_trees, read_name_mapping, prepare_tree, n_trees)
+    if resume and os.path.exists(parts_dir):
+        try:
+            with open(manifest_path, 'r') as manifest_file:
+                previous_manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            previous_manifest = None
+        if previous_manifest != json.loads(json.dumps(manifest)):
+            LOGGER.info('\tDiscarding tree statistics of a run with other settings.')
+            resume = False
+    if not resume:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir, exist_ok=True)
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    part_paths = [os.path.join(parts_dir, PART_FNAME % i) for i in range(len(chunks))]
+    pending = [i for i, path in enumerate(part_paths)
+               if not _is_valid_part(path, chunks[i])]
+    n_done = n_trees - sum(len(chunks[i]) for i in pending)
+    if n_done > 0:
+        LOGGER.info('\tResuming tree statistics: %i/%i trees done.' % (n_done, n_trees))
+
+    def chunk_args(i_chunk):
+        chunk = chunks[i_chunk]
+        return source, chunk, locators[chunk], name_map, statistics, prepare_tree
+
+    def save_part(i_chunk, part):
+        tmp_path = part_paths[i_chunk] + '.tmp'
+        part.to_csv(tmp_path)
+        os.replace(tmp_path, part_paths[i_chunk])
+
+        nonlocal n_done
+        n_done += len(part)
+        elapsed = time.time() - start_time
+        rate = (n_done - n_done_before) / elapsed
+        eta = (n_trees - n_done) / rate if rate > 0 else np.nan
+        LOGGER.info('\tTree statistics: %i/%i trees (%.1f trees/s, ETA %.0fs)' %
+                    (n_done, n_trees, rate, eta))
+
+    start_time = time.time()
+    n_done_before = n_done
+    if workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_compute_chunk, *chunk_args(i)): i for i in pending}
+            for future in as_completed(futures):
+                save_part(futures[future], future.result())
+    else:
+        for i in pending:
+            save_part(i, _compute_chunk(*chunk_args(i)))
+
+    # Collect the parts in one table
+    results = pd.concat([pd.read_csv(path, index_col='i_tree', float_precision='round_trip') for path in part_paths])
+    results = results.reindex(columns=[s for s in TREE_STATISTICS if s in statistics])
+    results.insert(0, 'state', states)
+    results.to_csv(results_path)
+    shutil.rmtree(parts_dir, ignore_errors=True)
+
+    return results
@@ -9,10 +9,12 @@ import numpy as np
 from numpy.random import multivariate_normal as _gaussian
 import matplotlib.pyplot as plt
 from scipy.special import softmax
+from scipy.spatial.distance import squareform
 
 from src.simulation.simulation import State, World
 from src.util import newick_tree, bernoulli, norm, normalize
 from src.tree import get_edge_heights
+from src.distances import pairwise_distances, pairwise_min_distances
 
 YULE = 'yule'
 SATURATION = 'saturation'
@@ -184,13 +186,11 @@ class VectorWorld(World):
 
     def all_distances(self):
         P = self.get_locations()
-        deltas = P - P[:, None]
-        return np.hypot(*deltas.T)
+        return squareform(pairwise_distances(P))
 
     def all_min_distances(self):
-        dists = self.all_distances()
-        np.fill_diagonal(dists, np.inf)
-        return np.min(dists, axis=1)
+        P = self.get_locations()
+        return pairwise_min_distances(P)
 
 
 class BackboneState(VectorState):
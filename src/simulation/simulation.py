@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 from copy import deepcopy
+from scipy.spatial.distance import squareform
 
 from src.tree import Tree
 from src.util import newick_tree, bernoulli
+from src.distances import pairwise_distances, pairwise_min_distances
 
 
 class World(object):
@@ -44,13 +46,11 @@ class World(object):
 
     def all_distances(self):
         P = self.get_locations()
-        deltas = P - P[:, None]
-        return np.hypot(*deltas.T)
+        return squareform(pairwise_distances(P))
 
     def all_min_distances(self):
-        dists = self.all_distances()
-        np.fill_diagonal(dists, np.inf)
-        return np.min(dists, axis=1)
+        P = self.get_locations()
+        return pairwise_min_distances(P)
 
     def register_split(self, parent, child_1, child_2):
         i = self.sites.index(parent)
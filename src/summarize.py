@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+import os
+import re
+import logging
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from shapely.geometry import Polygon
+from shapely.ops import unary_union
+
+from src.beast_interface import (iter_tree_file, to_parsable_newick,
+                                 parse_root_location, load_tree_from_nexus)
+from src.tree import Tree, hpd_keys
+
+LOGGER = logging.getLogger('experiment')
+
+ATTRIBUTES_REGEX = re.compile(r'\[[^\]]*\]')
+LENGTHS_REGEX = re.compile(r':[^,();]*')
+TOPOLOGY_TOKENS_REGEX = re.compile(r'[(),]|[^(),;]+')
+
+DEFAULT_GRID_SIZE = 50
+
+
+def iter_clade_keys(newick_str, leaf_ids, translate=None):
+    """Compute the clade keys of all internal nodes of a (raw BEAST) Newick
+    string without building a Tree. A clade key is a bitset (python int) of the
+    leafs in the clade, where leaf i corresponds to bit leaf_ids[name].
+
+    Args:
+        newick_str (str): The raw Newick string (attributes are ignored).
+        leaf_ids (dict): Mapping from leaf names to bit indices. Unknown names
+            are added to the mapping.
+        translate (dict): Optional mapping of the leaf labels to names.
+
+    Yields:
+        int: The clade key of each internal node (post-order, root last).
+    """
+    topology = LENGTHS_REGEX.sub('', ATTRIBUTES_REGEX.sub('', newick_str))
+    stack = [0]
+    for token in TOPOLOGY_TOKENS_REGEX.findall(topology):
+        if token == '(':
+            stack.append(0)
+        elif token == ')':
+            clade = stack.pop()
+            stack[-1] |= clade
+            yield clade
+        elif token == ',':
+            continue
+        else:
+            name = token.strip()
+            if not name:
+                continue
+            if translate is not None:
+                name = translate.get(name, name)
+            i_leaf = leaf_ids.setdefault(name, len(leaf_ids))
+            stack[-1] |= 1 << i_leaf
+
+
+class PosteriorSummary(object):
+
+    """Summary of a posterior tree sample, collected in one pass over a BEAST
+    `.trees` file: the clade frequencies (keyed by leaf bitsets), the clade
+    keys of every sample and the root location of every sample.
+
+    Attributes:
+        tree_path (str): Path to the BEAST `.trees` file.
+        leaf_ids (dict): Mapping from leaf names to bit indices of clade keys.
+        clade_counts (dict): Number of samples containing each clade.
+        sample_clades (list[list[int]]): Clade keys of each sample.
+        root_locations (np.array): Root location of each sample.
+            shape: (n_samples, 2)
+        states (np.array): MCMC state of each sample.
+            shape: (n_samples,)
+        offsets (np.array): Byte offset of each sample in the `.trees` file.
+            shape: (n_samples,)
+        name_map (dict or None): The translate table of the file.
+    """
+
+    def __init__(self, tree_path, burnin=0, thinning=1, location_key='location'):
+        self.tree_path = tree_path
+        self.location_key = location_key
+        self.leaf_ids = {}
+        self.clade_counts = {}
+        self.sample_clades = []
+        root_locations = []
+        states = []
+        offsets = []
+        self.name_map = None
+
+        for offset, state, newick_str, name_map in iter_tree_file(
+                tree_path, burnin=burnin, thinning=thinning, read_name_mapping=True):
+            self.name_map = name_map
+            clades = list(iter_clade_keys(newick_str, self.leaf_ids,
+                                          translate=name_map))
+            for clade in clades:
+                self.clade_counts[clade] = self.clade_counts.get(clade, 0) + 1
+
+            self.sample_clades.append(clades)
+            root_locations.append(parse_root_location(newick_str,
+                                                      location_key=location_key))
+            states.append(state)
+            offsets.append(offset)
+
+        self.root_locations = np.array(root_locations, dtype=float).reshape((-1, 2))
+        self.states = np.array(states, dtype=np.int64)
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+    @property
+    def n_samples(self):
+        return len(self.sample_clades)
+
+    def clade_credibility(self, clade):
+        """The posterior probability of a clade (given by its key)."""
+        return self.clade_counts.get(clade, 0) / self.n_samples
+
+    def log_clade_credibilities(self):
+        """Compute the log clade credibility (sum of the log posterior
+        probabilities of all clades) of every sample.
+
+        Returns:
+            np.array: The log clade credibilities.
+                shape: (n_samples,)
+        """
+        log_n = np.log(self.n_samples)
+        log_freq = {clade: np.log(count) - log_n
+                    for clade, count in self.clade_counts.items()}
+        return np.array([sum(log_freq[clade] for clade in clades)
+                         for clades in self.sample_clades])
+
+    def get_mcc_index(self):
+        """Index of the maximum clade credibility (MCC) sample."""
+        return int(np.argmax(self.log_clade_credibilities()))
+
+    def load_sample(self, i_sample):
+        """Parse the ´i_sample´th posterior tree (read directly at its offset)."""
+        with open(self.tree_path, 'rb') as tree_file:
+            tree_file.seek(self.offsets[i_sample])
+            line = tree_file.readline().decode().strip().lower()
+
+        _, _, newick_str = line.partition(' = ')
+        return Tree.from_newick(to_parsable_newick(newick_str),
+                                location_key=self.location_key,
+                                translate=self.name_map)
+
+    def get_clade_key(self, node):
+        """Compute the clade key of a node (Tree) of a sample."""
+        key = 0
+        for leaf in node.iter_leafs():
+            key |= 1 << self.leaf_ids[leaf.name]
+        return key
+
+    def get_mcc_tree(self, hpd_values, grid_size=DEFAULT_GRID_SIZE):
+        """Build the MCC tree, annotated with the posterior probability of each
+        clade and with a summary of the root location samples (mean, median,
+        range and HPD regions for all levels in ´hpd_values´), using the same
+        attribute keys as treeannotator (see `Tree.get_hpd`).
+
+        Node heights and the locations of internal nodes are kept as in the
+        MCC sample (treeannotator's '-heights keep').
+
+        Returns:
+            Tree: The annotated MCC tree.
+        """
+        tree = self.load_sample(self.get_mcc_index())
+        for node in tree.iter_descendants():
+            if not node.is_leaf():
+                node.attributes['posterior'] = \
+                    self.clade_credibility(self.get_clade_key(node))
+
+        annotate_location_summary(tree, self.root_locations, hpd_values,
+                                  location_key=self.location_key,
+                                  grid_size=grid_size)
+        return tree
+
+
+def bandwidth_nrd(x):
+    """Normal reference bandwidth (as `MASS::bandwidth.nrd` in R, which is
+    used by treeannotator)."""
+    q25, q75 = np.percentile(x, [25, 75])
+    h = (q75 - q25) / 1.34
+    return 4. * 1.06 * min(np.std(x, ddof=1), h) * len(x) ** (-1. / 5.)
+
+
+def kde2d(samples, grid_size=DEFAULT_GRID_SIZE, margin=0.1):
+    """Gaussian kernel density estimate of 2D samples on a regular grid (as
+    `MASS::kde2d` in R), with normal reference bandwidths.
+
+    Args:
+        samples (np.array): The samples.
+            shape: (n_samples, 2)
+        grid_size (int): Number of grid points per axis.
+        margin (float): Margin added to the range of the samples (relative).
+
+    Returns:
+        np.array: The x coordinates of the grid.
+            shape: (grid_size,)
+        np.array: The y coordinates of the grid.
+            shape: (grid_size,)
+        np.array: The density at the grid points.
+            shape: (grid_size, grid_size)
+    """
+    lower = np.min(samples, axis=0)
+    upper = np.max(samples, axis=0)
+    pad = margin * (upper - lower)
+    x = np.linspace(lower[0] - pad[0], upper[0] + pad[0], grid_size)
+    y = np.linspace(lower[1] - pad[1], upper[1] + pad[1], grid_size)
+
+    h = np.array([bandwidth_nrd(samples[:, 0]), bandwidth_nrd(samples[:, 1])]) / 4.
+    h[h <= 0] = 1.
+
+    # The product kernel factorizes, so the density is a matrix product
+    kx = np.exp(-0.5 * ((x[:, None] - samples[None, :, 0]) / h[0]) ** 2)
+    ky = np.exp(-0.5 * ((y[:, None] - samples[None, :, 1]) / h[1]) ** 2)
+    z = kx.dot(ky.T) / (2. * np.pi * h[0] * h[1] * len(samples))
+    return x, y, z
+
+
+def hpd_levels(z, hpd_values):
+    """Density levels of the HPD regions: the smallest density such that the
+    grid cells above it contain ´hpd´ percent of the total mass."""
+    z_sorted = np.sort(z.ravel())[::-1]
+    mass = np.cumsum(z_sorted) / np.sum(z_sorted)
+    levels = {}
+    for hpd in hpd_values:
+        i = min(np.searchsorted(mass, hpd / 100.), len(z_sorted) - 1)
+        levels[hpd] = z_sorted[i]
+    return levels
+
+
+def contour_polygons(x, y, z, level):
+    """The closed contour lines of the density ´z´ (on the grid given by ´x´
+    and ´y´) at ´level´, as polygons. The grid is padded with zero density, so
+    that contours reaching the grid boundary are closed as well. As in
+    treeannotator, every contour line is one polygon (enclosed contour lines
+    are not subtracted as holes).
+
+    Returns:
+        list[Polygon]: The contour polygons.
+    """
+    dx = x[1] - x[0] if len(x) > 1 else 1.
+    dy = y[1] - y[0] if len(y) > 1 else 1.
+    x = np.concatenate([[x[0] - dx], x, [x[-1] + dx]])
+    y = np.concatenate([[y[0] - dy], y, [y[-1] + dy]])
+    z = np.pad(z, 1, mode='constant')
+
+    # matplotlib expects the density indexed by (y, x)
+    contours = Figure().add_subplot(111).contour(x, y, z.T, levels=[level])
+    return [Polygon(path) for path in contours.allsegs[0] if len(path) >= 4]
+
+
+def hpd_polygons(samples, hpd_values, grid_size=DEFAULT_GRID_SIZE):
+    """Compute the HPD regions of 2D samples for several HPD levels at once,
+    from a single kernel density estimate. Each region is given by the
+    contour lines of the density at the level of the HPD (see
+    `contour_polygons`).
+
+    Args:
+        samples (np.array): The samples.
+            shape: (n_samples, 2)
+        hpd_values (list[int]): The HPD levels in percent (e.g. [80, 95]).
+        grid_size (int): Number of grid points per axis of the KDE.
+
+    Returns:
+        dict: The list of polygons (shapely) for each HPD level.
+    """
+    x, y, z = kde2d(samples, grid_size=grid_size)
+    return {hpd: contour_polygons(x, y, z, level)
+            for hpd, level in hpd_levels(z, hpd_values).items()}
+
+
+def format_float_list(values):
+    """Format a list of numbers in the BEAST attribute format ("{1.0,2.5}")."""
+    return '{%s}' % ','.join('%.8f' % v for v in values)
+
+
+def annotate_location_summary(node, samples, hpd_values, location_key='location',
+                              grid_size=DEFAULT_GRID_SIZE):
+    """Write the summary of the location ´samples´ of ´node´ (mean, median,
+    range and HPD polygons) into its attributes, using the keys of
+    treeannotator."""
+    node.attributes.pop(location_key, None)
+    for i_axis in (0, 1):
+        key = '%s%i' % (location_key, i_axis + 1)
+        node.attributes[key] = np.mean(samples[:, i_axis])
+        node.attributes[key + '_median'] = np.median(samples[:, i_axis])
+        node.attributes[key + '_range'] = format_float_list(
+            [np.min(samples[:, i_axis]), np.max(samples[:, i_axis])])
+    location = np.mean(samples, axis=0)
+    if node.location is None:
+        node.location = location
+    else:
+        # Update in place to keep the packed location array consistent
+        node.location[:] = location
+
+    for hpd, polygons in hpd_polygons(samples, hpd_values, grid_size=grid_size).items():
+        for i_polygon, polygon in enumerate(polygons, start=1):
+            hpd_x, hpd_y = np.array(polygon.exterior.coords).T
+            key_x, key_y = hpd_keys(location_key, hpd, i_polygon)
+            node.attributes[key_x] = format_float_list(hpd_x)
+            node.attributes[key_y] = format_float_list(hpd_y)
+        modality_key = '%s_%s%%HPD_modality' % (location_key, hpd)
+        node.attributes[modality_key] = len(polygons)
+
+
+def summarize_posterior(tree_path, hpd_values, burnin=0, thinning=1,
+                        mcc_path=None, location_key='location',
+                        grid_size=DEFAULT_GRID_SIZE):
+    """Summarize a BEAST posterior sample in one pass: pick the MCC tree and
+    compute the root HPD regions for all levels in ´hpd_values´ (replacing one
+    treeannotator run per HPD level).
+
+    Args:
+        tree_path (str): Path to the BEAST `.trees` file.
+        hpd_values (list[int]): The HPD levels in percent.
+        burnin (int): Number of MCMC states to be discarded as burn-in.
+        thinning (int): Only every ´thinning´th tree (after burn-in) is used.
+        mcc_path (str): If given, the MCC tree is written to this NEXUS file.
+
+    Returns:
+        Tree: The annotated MCC tree.
+        PosteriorSummary: The summary of the posterior (incl. root samples).
+    """
+    summary = PosteriorSummary(tree_path, burnin=burnin, thinning=thinning,
+                               location_key=location_key)
+    tree = summary.get_mcc_tree(hpd_values, grid_size=grid_size)
+    if mcc_path is not None:
+        tree.to_nexus(mcc_path)
+    return tree, summary
+
+
+def polygons_iou(polygons_a, polygons_b):
+    """Intersection over union of two HPD regions (lists of polygons)."""
+    region_a = unary_union(polygons_a)
+    region_b = unary_union(polygons_b)
+    union_area = region_a.union(region_b).area
+    if union_area == 0:
+        return np.nan
+    return region_a.intersection(region_b).area / union_area
+
+
+def compare_summary_trees(tree, reference_tree, hpd_values, location_key='location'):
+    """Compare the root summary of a native MCC tree with the one of a
+    treeannotator MCC tree (for validation).
+
+    Returns:
+        dict: Distance between the summarized root locations and the overlap
+            (intersection over union) and number of polygons of the HPD
+            regions for each level present in both trees.
+    """
+    comparison = {
+        'root_distance': np.linalg.norm(tree.location - reference_tree.location)
+    }
+    for hpd in hpd_values:
+        polygons = tree.get_hpd(hpd, location_key=location_key)
+        reference_polygons = reference_tree.get_hpd(hpd, location_key=location_key)
+        if not polygons or not reference_polygons:
+            continue
+        comparison['hpd_%i_iou' % hpd] = polygons_iou(polygons, reference_polygons)
+        comparison['hpd_%i_modality' % hpd] = len(polygons)
+        comparison['hpd_%i_reference_modality' % hpd] = len(reference_polygons)
+    return comparison
+
+
+def validate_against_treeannotator(working_dir, hpd_values, burnin,
+                                   trees_fname='nowhere.trees',
+                                   mcc_fname='nowhere.tree'):
+    """Validate the native summary of a stored run against the MCC tree written
+    by treeannotator (´mcc_fname´ in ´working_dir´).
+
+    Returns:
+        dict: See `compare_summary_trees`.
+    """
+    tree, _ = summarize_posterior(working_dir + trees_fname, hpd_values,
+                                  burnin=burnin)
+    reference_tree = load_tree_from_nexus(working_dir + mcc_fname)
+    comparison = compare_summary_trees(tree, reference_tree, hpd_values)
+    for key, value in comparison.items():
+        LOGGER.info('\t\t%s: %s' % (key, value))
+    return comparison
+
+
+def validate_experiment(working_directory, hpd_values, burnin, results_path=None,
+                        trees_fname='nowhere.trees', mcc_fname='nowhere.tree'):
+    """Run `validate_against_treeannotator` for every stored run in the working
+    directory of an experiment (and its sub-directories) with both a
+    posterior sample and a treeannotator MCC tree.
+
+    Returns:
+        pd.DataFrame: The comparison of each run (indexed by its directory),
+            also written to ´results_path´ (CSV) if given.
+    """
+    rows = {}
+    for dir_path, _, file_names in os.walk(working_directory):
+        if trees_fname in file_names and mcc_fname in file_names:
+            LOGGER.info('\tValidating the native summary of %s' % dir_path)
+            rows[dir_path] = validate_against_treeannotator(
+                os.path.join(dir_path, ''), hpd_values, burnin,
+                trees_fname=trees_fname, mcc_fname=mcc_fname)
+
+    results = pd.DataFrame.from_dict(rows, orient='index')
+    results.index.name = 'run'
+    if results_path is not None:
+        results.to_csv(results_path)
+    return results
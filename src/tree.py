@@ -2,15 +2,23 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, \
     unicode_literals
+import io
 import logging
 from copy import copy
+from functools import lru_cache
 
 import numpy as np
 
 from src.util import (remove_whitespace, find, read_locations_file,
                       read_alignment_file, StringTemplate, str_concat_array, norm)
 from src.beast_xml_templates import *
-from shapely.geometry import Point, Polygon
+from src.lca import LCAIndex
+from src.hpd import HPDRegion
+from src.distances import pairwise_distances, EUCLIDEAN
+from src.tree_writer import (write_newick, write_nexus, write_beast_taxa,
+                             write_beast_alignment)
+from scipy.spatial.distance import squareform
+from shapely.geometry import Polygon
 
 
 class Tree(object):
@@ -42,6 +50,7 @@ class Tree(object):
             child.parent = self
 
         self.color = None
+        self._hpd_regions = {}
 
     def get_subtree(self, subtree_path: list):
         """Compute the subtree defined the indices in subtree path.
@@ -63,10 +72,10 @@ class Tree(object):
 
     @property
     def location(self):
-        if self._location is not None:
-            return self._location
-        else:
-            return self.get_location_from_attributes()
+        if self._location is None:
+            # Parse the location from the attributes only once
+            self._location = self.get_location_from_attributes()
+        return self._location
 
     @location.setter
     def location(self, location):
@@ -279,6 +288,7 @@ class Tree(object):
 
         tree, _ = parse_tree(newick, location_key=location_key, swap_xy=swap_xy,
                              with_attributes=with_attributes, name_mapping=translate)
+        tree.pack_locations()
         if p_hpd is not None:
             tree.p_hpd = p_hpd
 
@@ -294,74 +304,68 @@ class Tree(object):
         Returns:
             np.array or None: The extracted location of the node.
         """
+        return location_from_attributes(self.attributes, location_key=location_key)
 
-        if location_key in self.attributes:
-            location_str = self.attributes[location_key]
-            location_str = location_str.replace('{', '(') \
-                                       .replace('}', ')')
-            x, y = eval(location_str)
+    def pack_locations(self):
+        """Store the locations of all nodes in one tree-wide array (attribute
+        `location_array` of this node, in depth-first order) and let every
+        node's location be a view into this array. Nodes without a location
+        get a row of NaNs, but keep `location == None`.
 
-        else:
-            location_key += '%i'
-            location_median_key = location_key + '_median'
-
-            if (location_key % 1) in self.attributes:
-                x = self[location_key % 1]
-                y = self[location_key % 2]
-            elif (location_median_key % 1) in self.attributes:
-                x = self[location_median_key % 1]
-                y = self[location_median_key % 2]
-            else:
-                return None
-        return np.array([x, y])
+        Returns:
+            np.array: The tree-wide location array.
+                shape: (tree_size, 2)
+        """
+        nodes = self.get_descendants()
+        self.location_array = np.full((len(nodes), 2), np.nan)
+        for i, node in enumerate(nodes):
+            loc = node.location
+            if loc is not None:
+                self.location_array[i] = loc
+                node._location = self.location_array[i]
+
+        return self.location_array
 
     def get_hpd(self, p_hpd, location_key='location'):
         """Extract the HPD from the attributes dict."""
-        attr_keys = list(self.attributes.keys())
-        hpd_key_template = '{location_key}{i_axis}_{p_hpd}%HPD_{i_polygon}'
-        hpd_key_template = hpd_key_template.format(location_key=location_key,
-                                                   p_hpd=p_hpd,
-                                                   i_axis='{i_axis}',
-                                                   i_polygon='{i_polygon}')
-
-        i = 1
-        hpd_key_x = hpd_key_template.format(i_axis=1, i_polygon=i)
-        hpd_key_y = hpd_key_template.format(i_axis=2, i_polygon=i)
         polygons = []
-        while hpd_key_x in attr_keys:
-            hpd_x_str = self.attributes[hpd_key_x][1:-1]
-            hpd_y_str = self.attributes[hpd_key_y][1:-1]
-            hpd_x = map(float, hpd_x_str.split(','))
-            hpd_y = map(float, hpd_y_str.split(','))
+        i = 1
+        hpd_key_x, hpd_key_y = hpd_keys(location_key, p_hpd, i)
+        while hpd_key_x in self.attributes:
+            hpd_x = parse_float_list(self.attributes[hpd_key_x])
+            hpd_y = parse_float_list(self.attributes[hpd_key_y])
 
             poly = Polygon(zip(hpd_x, hpd_y))
             polygons.append(poly)
 
             i += 1
-            hpd_key_x = hpd_key_template.format(i_axis=1, i_polygon=i)
-            hpd_key_y = hpd_key_template.format(i_axis=2, i_polygon=i)
+            hpd_key_x, hpd_key_y = hpd_keys(location_key, p_hpd, i)
 
         if len(polygons) == 0:
-            print(attr_keys)
+            print(list(self.attributes.keys()))
             logging.warning('No HPD polygon found!')
 
         return polygons
 
+    def get_hpd_region(self, p_hpd, location_key='location'):
+        """Get the HPD region at level ´p_hpd´ from the attributes dict. The
+        polygons are parsed only once and the region is cached (the cache is
+        not invalidated when the HPD attributes are changed).
+
+        Returns:
+            HPDRegion: The HPD region.
+        """
+        key = (p_hpd, location_key)
+        if key not in self._hpd_regions:
+            self._hpd_regions[key] = HPDRegion.from_tree(self, p_hpd,
+                                                         location_key=location_key)
+        return self._hpd_regions[key]
+
     def root_in_hpd(self, root, p_hpd, location_key='location'):
         """Check whether the given root location is covered by the HPD in the
         node attributes."""
-
-        # Ensure that root is a Point object
-        if not isinstance(root, Point):
-            assert len(root) == 2
-            root = Point(root[0], root[1])
-
-        # Check whether any of the HPD polygons () cover
-        for polygon in self.get_hpd(p_hpd, location_key=location_key):
-            if polygon.contains(root):
-                return True
-
-        return False
+        hpd_region = self.get_hpd_region(p_hpd, location_key=location_key)
+        return hpd_region.contains_point(root)
 
     def iter_edges(self):
         """Iterate over all edges in the tree."""
@@ -436,59 +440,19 @@ class Tree(object):
 
     def to_newick(self, write_attributes=True, translate=None):
         """Compute a Newick string representation of the tree."""
-        if translate is None:
-            translate = lambda x: x
-        if isinstance(translate, dict):
-            translate_dict = translate
-            translate = lambda x: translate_dict.get(x, x)
-
-        if self.children:
-            child_newicks = []
-            for c in self.children:
-                c_newick = c.to_newick(write_attributes=write_attributes,
-                                             translate=translate)
-                child_newicks.append(c_newick)
-            core = '(' + ','.join(child_newicks) + ')'
-            core += translate(self.name)
-        else:
-            core = translate(self.name)
-
-        attr_str = ''
-        if self.attributes and write_attributes:
-            attr_str = ','.join('%s=%s' % kv for kv in self.attributes.items())
-            attr_str = '[&%s]' % attr_str
+        newick = io.StringIO()
+        write_newick(self, newick, write_attributes=write_attributes,
+                     translate=translate)
+        return newick.getvalue()
 
-        return '{core}{attrs}:{len}'.format(core=core, attrs=attr_str, len=self.length)
+    def write_newick(self, out, write_attributes=True, translate=None):
+        """Stream the Newick representation of the tree to the file handle
+        ´out´ (see `src.tree_writer.write_newick`)."""
+        write_newick(self, out, write_attributes=write_attributes,
+                     translate=translate)
 
     def to_nexus(self, fname, write_attributes=True):
-        taxa = []
-        for n in self.iter_descendants():
-            if n.name == '':
-                assert not n.is_leaf()
-            else:
-                taxa.append(n.name)
-
-        translate = dict(map(reversed, enumerate(taxa)))
-        print(translate)
-        taxa_lines = ['\t\t%s %s' % (i, name) for i, name in enumerate(taxa)]
-        tree_line = '\ttree TREE = %s;' % self.to_newick(translate=translate,
-                                                         write_attributes=write_attributes)
-
-        lines = [
-            '#NEXUS', '',
-            # 'begin taxa;',
-            # '\tdimension ntax=%i;' % len(taxa),
-            # '\ttaxlabels',
-            # *taxa_lines,
-            # ';', 'end;', '',
-            'begin trees;',
-            '\ttranslate',
-            ',\n'.join(taxa_lines) + ';',
-            tree_line,
-            'end;']
-
-        with open(fname, 'w') as nexus:
-            nexus.write('\n'.join(lines))
+        write_nexus([self], fname, write_attributes=write_attributes)
 
     def copy_other_node(self, other):
         # TODO Iterate over attrs?
@@ -498,6 +462,7 @@ class Tree(object):
         self.attributes = other.attributes
         self.alignment = other.alignment
         self._location = other._location
+        self._hpd_regions = {}
 
         self.children = []
         for c in other.children:
@@ -547,14 +512,6 @@ class Tree(object):
         with open(template_path, 'r') as xml_template_file:
             xml_template = StringTemplate(xml_template_file.read())
 
-        # Write newick tree
-        newick_str = self.to_newick(write_attributes=False)
-        xml_template.tree = newick_str
-
-        # Set locations and features
-        xml_template.locations = self._format_tree_locations()
-        xml_template.features = self._format_tree_alignments()
-
         # Fix root / don't fix root by setting set steep / flat prior
         if root is None:
             root = [0., 0.]
@@ -578,9 +535,13 @@ class Tree(object):
         if movement_model in ('rdrw', 'cdrw'):
             xml_template.drift_prior_std = drift_prior_std
 
+        # The newick tree, locations and features are streamed to the file
         with open(output_path, 'w') as beast_xml_file:
-            beast_xml_file.write(
-                xml_template.fill()
+            xml_template.write(
+                beast_xml_file,
+                tree=lambda out: write_newick(self, out, write_attributes=False),
+                locations=lambda out: write_beast_taxa(self, out),
+                features=lambda out: write_beast_alignment(self, out)
             )
 
     def load_locations_from_csv(self, csv_path, swap_xy=False):
@@ -691,26 +652,26 @@ class Tree(object):
         return list(self.iter_clades_at_height(height))
 
     def get_phylo_dist_mat(self):
-        if self.is_leaf():
-            return np.zeros((1, 1))
-
-        left, right = self.children
-        n = self.n_leafs()
-        n_left = left.n_leafs()
+        """Compute the matrix of pairwise patristic distances between all leafs
+        (in the order of `Tree.iter_leafs`).
 
-        X_left = left.get_phylo_dist_mat()
-        X_right = right.get_phylo_dist_mat()
-
-        X = np.ones((n, n)) * (2 * self.height())
-        X[:n_left, :n_left] = X_left
-        X[n_left:, n_left:] = X_right
+        Returns:
+            np.array: The phylogenetic distance matrix.
+                shape: (n_leafs, n_leafs)
+        """
+        lca_index = LCAIndex(self)
+        return squareform(lca_index.cophenetic_vector())
 
-        return X
+    def get_loc_dist_mat(self, metric=EUCLIDEAN, dtype=np.float64):
+        """Compute the matrix of pairwise geographic distances between all
+        leafs (in the order of `Tree.iter_leafs`).
 
-    def get_loc_dist_mat(self):
+        Returns:
+            np.array: The geographic distance matrix.
+                shape: (n_leafs, n_leafs)
+        """
         locs = self.get_leaf_locations()
-        diffs = locs[:, np.newaxis, :] - locs[np.newaxis, :, :]
-        return np.linalg.norm(diffs, axis=-1)
+        return squareform(pairwise_distances(locs, metric=metric, dtype=dtype))
 
     def __getitem__(self, key):
         return self.attributes[key]
@@ -833,7 +794,7 @@ def parse_tree(s, location_key='location', swap_xy=False, with_attributes=True,
     tree = Tree(length, name=name, children=children, attributes=attributes)
 
     tree._location = tree.get_location_from_attributes(location_key)
-    if swap_xy:
+    if swap_xy and tree._location is not None:
         tree._location = tree._location[::-1]
 
     return tree, s
@@ -862,6 +823,27 @@ def parse_attributes(s):
     return attrs, s
 
 
+def parse_root_location(newick_str, location_key='location'):
+    """Extract the location of the root from a raw BEAST Newick string. The
+    root annotation is the last bracket before the final ';', so the rest of
+    the tree is never parsed.
+
+    Returns:
+        np.array: The root location (NaN if the root is not annotated).
+            shape: (2,)
+    """
+    end = newick_str.rfind(']')
+    start = newick_str.rfind('[&', 0, end)
+    if start < 0 or start < newick_str.rfind(')'):
+        return np.full(2, np.nan)
+
+    attrs, _ = parse_attributes(newick_str[start:end + 1])
+    location = location_from_attributes(attrs, location_key=location_key)
+    if location is None:
+        return np.full(2, np.nan)
+    return location
+
+
 def parse_length(s):
     if s.startswith(';'):
         return 0., s
@@ -896,6 +878,66 @@ def parse_value(s):
         return s
 
 
+def parse_float_list(s):
+    """Parse a list of numbers in the BEAST attribute format (e.g. "{1.0,2.5}")
+    into a np.array."""
+    return np.array(s.strip('{}()[]').split(','), dtype=float)
+
+
+def parse_location(s):
+    """Parse a location attribute (e.g. "{1.0,2.5}") into a np.array of shape
+    (2,). Numeric tuples/lists are accepted as well."""
+    if isinstance(s, str):
+        location = parse_float_list(s)
+    else:
+        location = np.array(s, dtype=float)
+
+    if location.shape != (2,):
+        raise ValueError('Invalid location: %s' % s)
+    return location
+
+
+def location_from_attributes(attributes, location_key='location'):
+    """Extract a location from an attributes dict (see
+    `Tree.get_location_from_attributes`).
+
+    Returns:
+        np.array or None: The location (shape: (2,)) or None if not present.
+    """
+    key, key_x, key_y, median_key_x, median_key_y = location_keys(location_key)
+
+    if key in attributes:
+        return parse_location(attributes[key])
+    elif key_x in attributes:
+        x = attributes[key_x]
+        y = attributes[key_y]
+    elif median_key_x in attributes:
+        x = attributes[median_key_x]
+        y = attributes[median_key_y]
+    else:
+        return None
+    return np.array([x, y], dtype=float)
+
+
+@lru_cache(maxsize=None)
+def location_keys(location_key):
+    """The attribute keys under which a location can be stored: the key itself
+    (for a tuple), keys for x and y and keys for x and y medians."""
+    return (location_key,
+            location_key + '1', location_key + '2',
+            location_key + '1_median', location_key + '2_median')
+
+
+@lru_cache(maxsize=None)
+def hpd_keys(location_key, p_hpd, i_polygon):
+    """The attribute keys of the x and y coordinates of the ´i_polygon´th HPD
+    polygon at level ´p_hpd´."""
+    hpd_key_template = '{location_key}{i_axis}_{p_hpd}%HPD_{i_polygon}'
+    return tuple(hpd_key_template.format(location_key=location_key, i_axis=i_axis,
+                                         p_hpd=p_hpd, i_polygon=i_polygon)
+                 for i_axis in (1, 2))
+
+
 """ TESTING """
 
 
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+import os
+
+import numpy as np
+
+from src.tree import Tree
+
+
+NPZ_EXTENSION = '.npz'
+
+
+class TreeArchive(object):
+
+    """A compact binary archive for collections of trees. All nodes of all
+    trees are stored in flat arrays (in depth-first pre-order per tree) with a
+    per-tree offset index, so that tree i can be accessed in O(1) without
+    parsing any text.
+
+    An archive is stored either as an (uncompressed) `.npz` file or as a
+    directory of `.npy` files, which are memory-mapped when opened (suitable
+    for very large archives).
+
+    Attributes:
+        node_offsets (np.array): Tree i consists of the nodes
+            node_offsets[i]:node_offsets[i+1].
+            shape: (n_trees + 1,)
+        parents (np.array): Index of the parent of each node, relative to the
+            first node of the tree (-1 for the root).
+            shape: (n_nodes,)
+        lengths (np.array): Branch length of each node.
+            shape: (n_nodes,)
+        locations (np.array): Location of each node (NaN if missing).
+            shape: (n_nodes, 2)
+        name_ids (np.array): Index of the name of each node in `names`.
+            shape: (n_nodes,)
+        names (np.array): The shared string table of node names and text
+            attribute values ('' first).
+        attribute_keys (list[str]): Names of the stored numeric attributes.
+        attributes (np.array): Values of the numeric attributes (NaN if missing).
+            shape: (n_nodes, n_attributes)
+        text_attribute_keys (list[str]): Names of the stored non-numeric
+            attributes.
+        text_attributes (np.array): Index of the value of each non-numeric
+            attribute in `names` (-1 if missing).
+            shape: (n_nodes, n_text_attributes)
+        states (np.array or None): Optional MCMC state of each tree.
+            shape: (n_trees,)
+    """
+
+    ARRAY_NAMES = ['node_offsets', 'parents', 'lengths', 'locations', 'name_ids',
+                   'names', 'attribute_keys', 'attributes', 'text_attribute_keys',
+                   'text_attributes', 'states']
+
+    def __init__(self, node_offsets, parents, lengths, locations, name_ids, names,
+                 attribute_keys, attributes, text_attribute_keys=(),
+                 text_attributes=None, states=None):
+        self.node_offsets = node_offsets
+        self.parents = parents
+        self.lengths = lengths
+        self.locations = locations
+        self.name_ids = name_ids
+        self.names = names
+        self.attribute_keys = [str(k) for k in attribute_keys]
+        self.attributes = attributes
+        self.text_attribute_keys = [str(k) for k in text_attribute_keys]
+        if text_attributes is None:
+            text_attributes = np.full((len(parents), 0), -1, dtype=np.int32)
+        self.text_attributes = text_attributes
+        self.states = states
+
+    def __len__(self):
+        return len(self.node_offsets) - 1
+
+    def __getitem__(self, i):
+        return self.get_tree(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_tree(i)
+
+    @property
+    def n_nodes(self):
+        return len(self.parents)
+
+    def get_arrays(self, i):
+        """Get the raw arrays (parents, lengths, locations) of tree ´i´ as
+        views into the archive (no Tree objects are created)."""
+        start, stop = self.node_offsets[i], self.node_offsets[i + 1]
+        return (self.parents[start:stop], self.lengths[start:stop],
+                self.locations[start:stop])
+
+    def get_tree(self, i):
+        """Reconstruct tree ´i´ from the archive.
+
+        Returns:
+            Tree: The reconstructed tree (with a packed location array, see
+                `Tree.pack_locations`).
+        """
+        start, stop = self.node_offsets[i], self.node_offsets[i + 1]
+        parents = self.parents[start:stop]
+        lengths = self.lengths[start:stop]
+        location_array = np.array(self.locations[start:stop])
+        names = self.names[self.name_ids[start:stop]]
+        attributes = self.attributes[start:stop]
+        text_attributes = self.text_attributes[start:stop]
+
+        nodes = []
+        for j in range(stop - start):
+            attrs = {k: float(attributes[j, a]) for a, k in enumerate(self.attribute_keys)
+                     if not np.isnan(attributes[j, a])}
+            attrs.update({k: str(self.names[text_attributes[j, a]])
+                          for a, k in enumerate(self.text_attribute_keys)
+                          if text_attributes[j, a] >= 0})
+            location = None
+            if not np.isnan(location_array[j, 0]):
+                location = location_array[j]
+
+            node = Tree(float(lengths[j]), name=str(names[j]), attributes=attrs,
+                        location=location)
+            nodes.append(node)
+            if parents[j] >= 0:
+                nodes[parents[j]].add_child(node)
+
+        root = nodes[0]
+        root.location_array = location_array
+        return root
+
+    @classmethod
+    def from_trees(cls, trees, attribute_keys=None, states=None):
+        """Build an archive from an iterable of trees.
+
+        Args:
+            trees (Iterable[Tree]): The trees to be archived.
+            attribute_keys (list[str]): Numeric node attributes to be stored.
+                Default: all attributes of the nodes (numeric ones as numbers,
+                all others as text), such that the archived trees are equal
+                to the original ones.
+            states (list[int]): Optional MCMC state for each tree.
+
+        Returns:
+            TreeArchive: The archive (in memory).
+        """
+        store_all = attribute_keys is None
+        attribute_keys = [] if store_all else list(attribute_keys)
+        name_table = {'': 0}
+        node_offsets = [0]
+        parents = []
+        lengths = []
+        locations = []
+        name_ids = []
+        attributes = []
+        node_attributes = []
+
+        for tree in trees:
+            nodes = tree.get_descendants()
+            node_idx = {id(node): i for i, node in enumerate(nodes)}
+            for node in nodes:
+                if node.parent is None or id(node.parent) not in node_idx:
+                    parents.append(-1)
+                else:
+                    parents.append(node_idx[id(node.parent)])
+                lengths.append(node.length)
+
+                loc = node.location
+                locations.append((np.nan, np.nan) if loc is None else loc)
+
+                name_ids.append(name_table.setdefault(node.name, len(name_table)))
+                if store_all:
+                    node_attributes.append(node.attributes)
+                else:
+                    attributes.append([_to_float(node.attributes.get(k, np.nan))
+                                       for k in attribute_keys])
+
+            node_offsets.append(len(parents))
+
+        n_nodes = len(parents)
+        text_attribute_keys = []
+        text_attributes = []
+        if store_all:
+            attribute_keys, text_attribute_keys = _split_attribute_keys(node_attributes)
+            attributes = [[_to_float(attrs.get(k, np.nan)) for k in attribute_keys]
+                          for attrs in node_attributes]
+            text_attributes = [[name_table.setdefault(str(attrs[k]), len(name_table))
+                                if k in attrs else -1 for k in text_attribute_keys]
+                               for attrs in node_attributes]
+
+        names = sorted(name_table, key=name_table.get)
+        if states is not None:
+            states = np.asarray(states, dtype=np.int64)
+
+        return cls(node_offsets=np.array(node_offsets, dtype=np.int64),
+                   parents=np.array(parents, dtype=np.int32),
+                   lengths=np.array(lengths, dtype=np.float64),
+                   locations=np.array(locations, dtype=np.float64).reshape((n_nodes, 2)),
+                   name_ids=np.array(name_ids, dtype=np.int32),
+                   names=np.array(names, dtype=str),
+                   attribute_keys=attribute_keys,
+                   attributes=np.array(attributes, dtype=np.float64).reshape(
+                       (n_nodes, len(attribute_keys))),
+                   text_attribute_keys=text_attribute_keys,
+                   text_attributes=np.array(text_attributes, dtype=np.int32).reshape(
+                       (n_nodes, len(text_attribute_keys))),
+                   states=states)
+
+    @classmethod
+    def concatenate(cls, archives):
+        """Concatenate several archives into one, merging their string tables
+        and their attribute keys (attributes missing in an archive are missing
+        for its nodes)."""
+        archives = list(archives)
+        attribute_keys = _merge_keys(a.attribute_keys for a in archives)
+        text_attribute_keys = _merge_keys(a.text_attribute_keys for a in archives)
+        conflicts = set(attribute_keys) & set(text_attribute_keys)
+        if conflicts:
+            raise ValueError('Attributes stored as numbers and as text: %s'
+                             % sorted(conflicts))
+
+        name_table = {'': 0}
+        node_offsets = [np.zeros(1, dtype=np.int64)]
+        name_ids = []
+        attributes = []
+        text_attributes = []
+        n_nodes = 0
+        for archive in archives:
+            id_map = np.array([name_table.setdefault(str(name), len(name_table))
+                               for name in archive.names], dtype=np.int32)
+            name_ids.append(id_map[archive.name_ids])
+            node_offsets.append(archive.node_offsets[1:] + n_nodes)
+            n_nodes += archive.n_nodes
+
+            archive_attributes = np.full((archive.n_nodes, len(attribute_keys)), np.nan)
+            for a, k in enumerate(archive.attribute_keys):
+                archive_attributes[:, attribute_keys.index(k)] = archive.attributes[:, a]
+            attributes.append(archive_attributes)
+
+            archive_text = np.full((archive.n_nodes, len(text_attribute_keys)), -1,
+                                   dtype=np.int32)
+            for a, k in enumerate(archive.text_attribute_keys):
+                value_ids = archive.text_attributes[:, a]
+                archive_text[:, text_attribute_keys.index(k)] = \
+                    np.where(value_ids >= 0, id_map[value_ids], -1)
+            text_attributes.append(archive_text)
+
+        names = sorted(name_table, key=name_table.get)
+        if all(archive.states is not None for archive in archives):
+            states = np.concatenate([archive.states for archive in archives])
+        else:
+            states = None
+
+        return cls(node_offsets=np.concatenate(node_offsets),
+                   parents=np.concatenate([a.parents for a in archives]),
+                   lengths=np.concatenate([a.lengths for a in archives]),
+                   locations=np.concatenate([a.locations for a in archives]),
+                   name_ids=np.concatenate(name_ids),
+                   names=np.array(names, dtype=str),
+                   attribute_keys=attribute_keys,
+                   attributes=np.concatenate(attributes),
+                   text_attribute_keys=text_attribute_keys,
+                   text_attributes=np.concatenate(text_attributes),
+                   states=states)
+
+    def _get_arrays_dict(self):
+        arrays = {name: getattr(self, name) for name in self.ARRAY_NAMES}
+        arrays['attribute_keys'] = np.array(self.attribute_keys, dtype=str)
+        arrays['text_attribute_keys'] = np.array(self.text_attribute_keys, dtype=str)
+        if self.states is None:
+            del arrays['states']
+        return arrays
+
+    def save(self, path):
+        """Save the archive as a `.npz` file (if ´path´ ends with '.npz') or
+        as a directory of memory-mappable `.npy` files."""
+        arrays = self._get_arrays_dict()
+        if path.endswith(NPZ_EXTENSION):
+            np.savez(path, **arrays)
+        else:
+            os.makedirs(path, exist_ok=True)
+            for name, array in arrays.items():
+                np.save(os.path.join(path, name + '.npy'), array)
+
+    @classmethod
+    def open(cls, path, mmap=True):
+        """Open an archive written by `TreeArchive.save`. Archives stored as a
+        directory are memory-mapped (unless ´mmap´ is False)."""
+        if path.endswith(NPZ_EXTENSION):
+            with np.load(path) as npz_file:
+                arrays = {name: npz_file[name] for name in npz_file.files}
+        else:
+            mmap_mode = 'r' if mmap else None
+            arrays = {}
+            for name in cls.ARRAY_NAMES:
+                array_path = os.path.join(path, name + '.npy')
+                if os.path.exists(array_path):
+                    arrays[name] = np.load(array_path, mmap_mode=mmap_mode)
+
+        arrays['attribute_keys'] = list(arrays['attribute_keys'])
+        if 'text_attribute_keys' in arrays:
+            arrays['text_attribute_keys'] = list(arrays['text_attribute_keys'])
+        return cls(**arrays)
+
+
+def _merge_keys(key_lists):
+    """Union of several key lists (in the order of first appearance)."""
+    keys = []
+    for key_list in key_lists:
+        keys += [k for k in key_list if k not in keys]
+    return keys
+
+
+def _split_attribute_keys(node_attributes):
+    """Split the keys of the given attribute dicts into numeric keys (all
+    values are numbers) and text keys (in the order of first appearance)."""
+    keys = {}
+    for attrs in node_attributes:
+        for k, v in attrs.items():
+            is_number = isinstance(v, (int, float, np.number)) and not isinstance(v, bool)
+            keys[k] = keys.get(k, True) and is_number
+    return ([k for k, numeric in keys.items() if numeric],
+            [k for k, numeric in keys.items() if not numeric])
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def write_tree_archive(trees, path, attribute_keys=None, states=None):
+    """Write the given trees (e.g. simulated trees) into an archive at ´path´
+    (see `TreeArchive.save`)."""
+    archive = TreeArchive.from_trees(trees, attribute_keys=attribute_keys,
+                                     states=states)
+    archive.save(path)
+    return archive
+
+
+def append_to_tree_archive(trees, path, attribute_keys=None, states=None):
+    """Append the given trees to the archive at ´path´ (created if it does not
+    exist yet, see `TreeArchive.concatenate`)."""
+    archive = TreeArchive.from_trees(trees, attribute_keys=attribute_keys,
+                                     states=states)
+    if os.path.exists(path):
+        archive = TreeArchive.concatenate([TreeArchive.open(path, mmap=False), archive])
+    archive.save(path)
+    return archive
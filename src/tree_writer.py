@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+from itertools import chain
+
+from src.beast_xml_templates import LOCATION_TEMPLATE, FEATURES_TEMPLATE
+from src.util import str_concat_array
+
+
+def _get_translate(translate):
+    if translate is None:
+        return lambda x: x
+    if isinstance(translate, dict):
+        translate_dict = translate
+        return lambda x: translate_dict.get(x, x)
+    return translate
+
+
+def _format_label(node, write_attributes, translate):
+    """Format the part of a Newick string following the node's children: name,
+    attributes and branch length."""
+    attr_str = ''
+    if node.attributes and write_attributes:
+        attr_str = ','.join('%s=%s' % kv for kv in node.attributes.items())
+        attr_str = '[&%s]' % attr_str
+
+    return '{name}{attrs}:{len}'.format(name=translate(node.name), attrs=attr_str,
+                                        len=node.length)
+
+
+def write_newick(tree, out, write_attributes=True, translate=None):
+    """Write the Newick representation of ´tree´ (without the terminating ';')
+    to the file handle ´out´. The tree is traversed iteratively in one pass, so
+    no intermediate strings for subtrees are built and deep trees don't hit the
+    recursion limit.
+
+    Args:
+        tree (Tree): The tree to be written.
+        out (file): A writable text file handle.
+        write_attributes (bool): Whether to include the node attributes.
+        translate (dict or callable): Optional mapping of node names.
+    """
+    translate = _get_translate(translate)
+
+    # Stack of (node, is_closing) pairs. A closing entry writes the ')' and
+    # the label of an internal node after all its children have been written.
+    stack = [(tree, False)]
+    while stack:
+        node, is_closing = stack.pop()
+
+        if node is None:
+            out.write(',')
+        elif is_closing:
+            out.write(')')
+            out.write(_format_label(node, write_attributes, translate))
+        elif node.children:
+            out.write('(')
+            stack.append((node, True))
+            for i_child in range(len(node.children) - 1, -1, -1):
+                stack.append((node.children[i_child], False))
+                if i_child > 0:
+                    stack.append((None, False))
+        else:
+            out.write(_format_label(node, write_attributes, translate))
+
+
+def get_nexus_taxa(tree):
+    """Collect the names of all named nodes in ´tree´ (depth-first order), as
+    used in the translate block of a NEXUS file."""
+    taxa = []
+    for n in tree.iter_descendants():
+        if n.name == '':
+            assert not n.is_leaf()
+        else:
+            taxa.append(n.name)
+    return taxa
+
+
+class NexusTreeWriter(object):
+
+    """Writer for NEXUS tree files with a translate block, which streams one
+    tree after another to a file handle (e.g. to archive many simulated or
+    posterior trees in one file). Use as a context manager or call `close()`
+    to finish the trees block.
+
+    Attributes:
+        out (file): The writable text file handle.
+        translate (dict): Mapping from taxon names to the ids used in the trees.
+        write_attributes (bool): Whether to include the node attributes.
+    """
+
+    def __init__(self, out, taxa, write_attributes=True):
+        self.out = out
+        self.write_attributes = write_attributes
+        self.translate = {name: str(i) for i, name in enumerate(taxa)}
+
+        out.write('#NEXUS\n\nbegin trees;\n\ttranslate\n')
+        out.write(',\n'.join('\t\t%i %s' % (i, name) for i, name in enumerate(taxa)))
+        out.write(';')
+
+    def write_tree(self, tree, name='TREE'):
+        self.out.write('\n\ttree %s = ' % name)
+        write_newick(tree, self.out, write_attributes=self.write_attributes,
+                     translate=self.translate)
+        self.out.write(';')
+
+    def close(self):
+        self.out.write('\nend;')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_nexus(trees, path, write_attributes=True, taxa=None, tree_names=None):
+    """Write one or many trees into one NEXUS file (with translate block).
+
+    Args:
+        trees (Iterable[Tree]): The trees to be written (may be a generator).
+        path (str): Output path.
+        write_attributes (bool): Whether to include the node attributes.
+        taxa (list[str]): Names in the translate block. Default: the named
+            nodes of the first tree.
+        tree_names (Iterable[str]): Names of the trees in the NEXUS file.
+            Default: 'TREE' for a single tree, 'TREE_<i>' otherwise.
+    """
+    trees = iter(trees)
+    first_tree = next(trees)
+    if tree_names is not None:
+        tree_names = iter(tree_names)
+    if taxa is None:
+        taxa = get_nexus_taxa(first_tree)
+
+    with open(path, 'w') as nexus_file:
+        with NexusTreeWriter(nexus_file, taxa, write_attributes=write_attributes) as writer:
+            for i, tree in enumerate(chain([first_tree], trees)):
+                if tree_names is not None:
+                    name = next(tree_names)
+                elif i == 0:
+                    name = 'TREE'
+                else:
+                    name = 'TREE_%i' % i
+                writer.write_tree(tree, name=name)
+
+
+def write_beast_taxa(tree, out):
+    """Write the BEAST XML <taxa> entries (name, age and location) of all
+    leafs of ´tree´ in one iterative pass."""
+    stack = [(tree, tree.length)]
+    while stack:
+        node, depth = stack.pop()
+        if node.is_leaf():
+            x, y = node.location
+            out.write(LOCATION_TEMPLATE.format(id=node.name, x=x, y=y, age=depth))
+        for c in reversed(node.children):
+            stack.append((c, depth + c.length))
+
+
+def write_beast_alignment(tree, out):
+    """Write the BEAST XML <alignment> entries of all leafs of ´tree´."""
+    for leaf in tree.iter_leafs():
+        alignment_str = str_concat_array(leaf.alignment)
+        out.write(FEATURES_TEMPLATE.format(id=leaf.name, features=alignment_str))
@@ -5,6 +5,7 @@ from __future__ import absolute_import, division, print_function, \
 import os
 import sys
 import csv
+import string
 import logging
 import random
 import random as _random
@@ -12,11 +13,14 @@ import pickle
 import shutil
 import datetime
 
-import pysal
 from pysal.lib.weights import Voronoi
 
 from pathlib import Path
 import numpy as np
+from scipy.spatial import Delaunay
+
+from src.birth_death import (offspring_probabilities, iterate_pgf, pgf_coefficients,
+                             lineage_count_moments)
 
 
 def dump(data, path):
@@ -204,6 +208,28 @@ class StringTemplate(object):
         # print()
         return self.template_string.format(**self.format_dict)
 
+    def write(self, out, **stream_fields):
+        """Write the filled template to the file handle ´out´ piece by piece.
+        Fields in ´stream_fields´ are not formatted from a value, but written
+        by calling the provided function with ´out´ (e.g. to stream large
+        sections directly to the file instead of building them in memory).
+
+        Args:
+            out (file): A writable text file handle.
+            **stream_fields (callable): Functions writing the respective field.
+        """
+        formatter = string.Formatter()
+        for literal, field, format_spec, conversion in formatter.parse(self.template_string):
+            out.write(literal)
+            if field is None:
+                continue
+
+            if field in stream_fields:
+                stream_fields[field](out)
+            else:
+                value = formatter.convert_field(self.format_dict[field], conversion)
+                out.write(formatter.format_field(value, format_spec))
+
     def __str__(self):
         return self.fill()
 
@@ -292,26 +318,35 @@ def experiment_preperations(work_dir, seed=None):
 
 
 def birth_death_expectation(birth_rate, death_rate, n_steps, vrange=None):
-
-    N_SAMPLES = 1000
-    samples = np.ones(N_SAMPLES, dtype=int)
-    for _ in range(n_steps):
-        new_samples = np.copy(samples)
-        new_samples += np.random.binomial(samples, birth_rate)
-        new_samples -= np.random.binomial(samples, death_rate)
-        samples = new_samples
-
-    print('P total extinction: %.2f' % np.mean(samples == 0))
-    print('P too small: %.2f' % np.mean(samples < vrange[0]))
-    print('P too big: %.2f' % np.mean(samples > vrange[1]))
-
-    if vrange is not None:
-        samples = np.array([s for s in samples if vrange[0] <= s <= vrange[1]])
-
-    print('P out of range: %.2f' % (1 - len(samples) / N_SAMPLES))
-    print('Expected leafs: %.2f' % np.mean(samples))
-    print('Standard dev. leafs: %.2f' % np.std(samples))
-    return np.mean(samples)
+    """Print the extinction and size probabilities of a birth-death process
+    starting from one lineage (with independent births and deaths in every
+    step) and return the expected number of lineages (within ´vrange´). The
+    probabilities are computed from the generating function of the process
+    (see `src.birth_death`)."""
+    offspring = offspring_probabilities(birth_rate, death_rate, independent=True)
+    print('P total extinction: %.2f' % iterate_pgf(np.zeros(1), offspring, n_steps)[0])
+
+    if vrange is None:
+        mean, var = lineage_count_moments(offspring, n_steps)
+        print('Expected leafs: %.2f' % mean)
+        print('Standard dev. leafs: %.2f' % var**0.5)
+        return mean
+
+    max_count = int(np.floor(vrange[1])) + 1
+    p_size = pgf_coefficients(lambda s: iterate_pgf(s, offspring, n_steps), max_count)
+    sizes = np.arange(max_count)
+    in_range = (sizes >= vrange[0])
+    p_too_small = np.sum(p_size[~in_range])
+    p_in_range = np.sum(p_size[in_range])
+    print('P too small: %.2f' % p_too_small)
+    print('P too big: %.2f' % (1 - p_too_small - p_in_range))
+    print('P out of range: %.2f' % (1 - p_in_range))
+
+    mean = np.sum(sizes[in_range] * p_size[in_range]) / p_in_range
+    var = np.sum((sizes[in_range] - mean)**2 * p_size[in_range]) / p_in_range
+    print('Expected leafs: %.2f' % mean)
+    print('Standard dev. leafs: %.2f' % var**0.5)
+    return mean
 
 
 def parse_arg(i, default, dtype=str):
@@ -330,10 +365,76 @@ def parse_arg(i, default, dtype=str):
 
 
 def delaunay_join_count(locations, labels):
+    """Normalised black-black join count of the binary ´labels´ on the Voronoi
+    graph of ´locations´. The joins are counted directly from the (binary)
+    weights, as in `esda.Join_Counts`, but without its permutation test."""
     graph = Voronoi(locations)
-    jc = pysal.explore.esda.Join_Counts(labels, graph)
+    labels = np.asarray(labels, dtype=float)
+    bb = labels.dot(graph.sparse.dot(labels)) / 2.
     n_b = np.count_nonzero(labels)
-    return jc.bb / (6*n_b - 12)
+    return bb / (6*n_b - 12)
+
+
+def delaunay_clade_join_counts(clade_locations):
+    """Normalised join count (as in `delaunay_join_count`) of each clade
+    against the leafs of the clades following it, from one Delaunay
+    triangulation. The triangulation is built incrementally from the last
+    clade to the first, so after adding the leafs of clade i it triangulates
+    exactly the leafs of clades i, i+1, ..., and the joins of clade i are
+    counted on its edges. For points in general position, the Voronoi (queen)
+    graph of `delaunay_join_count` is the Delaunay graph, so the results are
+    the same.
+
+    Args:
+        clade_locations (list[np.array]): The leaf locations of each clade.
+
+    Returns:
+        np.array: The join count of each clade.
+            shape: (n_clades,)
+    """
+    scores = np.zeros(len(clade_locations))
+    triangulation = None
+    locations = np.zeros((0, 2))
+    for i in reversed(range(len(clade_locations))):
+        locations_clade = np.asarray(clade_locations[i], dtype=float)
+        if triangulation is not None:
+            triangulation.add_points(locations_clade)
+            edges = delaunay_edges(triangulation)
+            n_points = triangulation.npoints
+        else:
+            # Qhull needs 4 points to start an incremental triangulation, so
+            # smaller sets are triangulated on their own
+            locations = np.concatenate([locations, locations_clade])
+            if len(locations) >= 4:
+                triangulation = Delaunay(locations, incremental=True)
+                edges = delaunay_edges(triangulation)
+            else:
+                edges = delaunay_edges(Delaunay(locations))
+            n_points = len(locations)
+
+        # The leafs of clade i are the last points added to the triangulation
+        n_b = len(locations_clade)
+        black = np.arange(n_points) >= n_points - n_b
+        bb = np.count_nonzero(black[edges[:, 0]] & black[edges[:, 1]])
+        scores[i] = bb / (6*n_b - 12)
+
+    if triangulation is not None:
+        triangulation.close()
+    return scores
+
+
+def delaunay_edges(triangulation):
+    """The edges of a Delaunay triangulation (each undirected edge once).
+
+    Returns:
+        np.array: The indices of the two end points of each edge.
+            shape: (n_edges, 2)
+    """
+    indptr, indices = triangulation.vertex_neighbor_vertices
+    sources = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    edges = np.column_stack([sources, indices])
+    return edges[edges[:, 0] < edges[:, 1]]
+
 
 def sample_random_subtree(tree, n_leaves):
     leaves = tree.get_leafs()
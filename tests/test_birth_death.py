@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import numpy as np
+import pytest
+
+from src.birth_death import (BirthDeathCalibration, offspring_probabilities,
+                             lineage_count_moments)
+
+N_STEPS = 30
+LEAF_RANGE = (4., 40.)
+N_REPS = 200000
+MAX_SE = 5.
+
+
+def simulate_lineage_counts(offspring, n_steps, n_reps, random_state,
+                            offspring_last=None):
+    """Monte Carlo of the branching process: in every step each lineage turns
+    into 0, 1 or 2 lineages according to the offspring distribution."""
+    if offspring_last is None:
+        offspring_last = offspring
+    counts = np.ones(n_reps, dtype=int)
+    for step in range(n_steps):
+        p_0, _, p_2 = offspring_last if step == n_steps - 1 else offspring
+        survivors = counts - random_state.binomial(counts, p_0)
+        counts = survivors + random_state.binomial(survivors, p_2 / (1. - p_0))
+    return counts
+
+
+def simulate_tree_sizes(birth_rate, death_rate, random_state):
+    """The number of extant leafs of simulated trees (the root starts with two
+    subtrees, no splits in the last step) and whether both subtrees survive."""
+    offspring = offspring_probabilities(birth_rate, death_rate)
+    offspring_last = offspring_probabilities(0., death_rate)
+    subtrees = [simulate_lineage_counts(offspring, N_STEPS, N_REPS, random_state,
+                                        offspring_last=offspring_last)
+                for _ in range(2)]
+    survived = (subtrees[0] > 0) & (subtrees[1] > 0)
+    return subtrees[0] + subtrees[1], survived, subtrees[0]
+
+
+def assert_close_to_frequency(p, hits):
+    """´p´ lies within a few standard errors of the observed frequency."""
+    frequency = np.mean(hits, axis=-1)
+    se = np.sqrt(np.maximum(p * (1 - p), 1. / N_REPS) / N_REPS)
+    np.testing.assert_array_less(np.abs(frequency - p), MAX_SE * se)
+
+
+@pytest.mark.parametrize('birth_rate, death_rate', [(0.1, 0.02), (0.12, 0.06)])
+def test_calibration_matches_simulation(birth_rate, death_rate):
+    random_state = np.random.RandomState(0)
+    sizes, survived, subtree_sizes = simulate_tree_sizes(birth_rate, death_rate, random_state)
+    calibration = BirthDeathCalibration(N_STEPS, LEAF_RANGE)
+
+    p_extinct = calibration.extinction_probability(birth_rate, death_rate)
+    assert_close_to_frequency(p_extinct, subtree_sizes == 0)
+
+    p_size = calibration.leaf_count_distribution(birth_rate, death_rate)
+    assert p_size.shape == (calibration.max_count,)
+    counts = np.arange(calibration.max_count)[:, None]
+    assert_close_to_frequency(p_size, survived & (sizes == counts))
+
+    accepted = survived & (LEAF_RANGE[0] < sizes) & (sizes < LEAF_RANGE[1])
+    p_accept = calibration.acceptance_probability(birth_rate, death_rate)
+    assert_close_to_frequency(p_accept, accepted)
+
+
+def test_acceptance_is_vectorised():
+    calibration = BirthDeathCalibration(N_STEPS, LEAF_RANGE)
+    birth_rates = np.array([0.05, 0.1, 0.2])
+    p_accept = calibration.acceptance_probability(birth_rates, 0.2 * birth_rates)
+    expected = [calibration.acceptance_probability(b, 0.2 * b) for b in birth_rates]
+    np.testing.assert_allclose(p_accept, expected)
+
+
+def test_calibrate_maximises_acceptance():
+    calibration = BirthDeathCalibration(N_STEPS, LEAF_RANGE)
+    birth_rate, death_rate, p_accept = calibration.calibrate(turnover=0.2)
+    assert np.isclose(death_rate, 0.2 * birth_rate)
+
+    birth_rates = birth_rate * np.linspace(0.5, 1.5, 41)
+    grid_acceptance = calibration.acceptance_probability(birth_rates, 0.2 * birth_rates)
+    assert p_accept >= np.max(grid_acceptance) - 1e-6
+
+
+@pytest.mark.parametrize('birth_rate, death_rate', [(0.1, 0.02), (0.05, 0.05)])
+def test_lineage_count_moments_match_simulation(birth_rate, death_rate):
+    offspring = offspring_probabilities(birth_rate, death_rate)
+    counts = simulate_lineage_counts(offspring, N_STEPS, N_REPS, np.random.RandomState(1))
+    mean, var = lineage_count_moments(offspring, N_STEPS)
+
+    assert abs(np.mean(counts) - mean) < MAX_SE * np.sqrt(var / N_REPS)
+    np.testing.assert_allclose(np.var(counts), var, rtol=0.05)
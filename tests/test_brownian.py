@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import numpy as np
+import pytest
+
+from src.brownian import (BrownianPruning, BrownianReconstruction,
+                          reconstruct_ancestral_locations)
+from tests.trees import random_tree
+
+
+def node_covariance(pruning, rates=None):
+    """Covariance (per dimension, unit diffusion rate) of all node locations
+    relative to the root, and the elapsed time from the root to each node."""
+    n = pruning.n_nodes
+    lengths = np.array([node.length for node in pruning.nodes])
+    variances = lengths * (1. if rates is None else rates)
+    var_depths, time_depths = np.zeros(n), np.zeros(n)
+    ancestor_sets = [{0} for _ in range(n)]
+    for i in range(1, n):
+        p = pruning.parents[i]
+        var_depths[i] = var_depths[p] + variances[i]
+        time_depths[i] = time_depths[p] + lengths[i]
+        ancestor_sets[i] = ancestor_sets[p] | {i}
+
+    # The covariance of two nodes is the variance depth of their LCA
+    cov = np.empty((n, n))
+    for i in range(n):
+        for j in range(n):
+            common = ancestor_sets[i] & ancestor_sets[j]
+            cov[i, j] = var_depths[max(common)]
+    return cov, time_depths
+
+
+def brute_force_posteriors(pruning, observed_locations, rates=None, drift=None,
+                           root_prior_mean=(0., 0.), root_prior_sample_size=0.):
+    """Posterior means and variances of all unobserved nodes by conditioning
+    the joint Gaussian of all nodes on the observed ones. With a flat root
+    prior (sample size 0) the root is estimated by generalized least squares
+    and its uncertainty is propagated (universal kriging)."""
+    cov, time_depths = node_covariance(pruning, rates)
+    drift = np.zeros(2) if drift is None else np.asarray(drift)
+    shifts = time_depths[:, None] * drift
+    obs = np.array(sorted(observed_locations))
+    unobs = np.array([i for i in range(pruning.n_nodes) if i not in observed_locations])
+    x_obs = np.array([observed_locations[i] for i in obs])
+
+    if root_prior_sample_size > 0:
+        cov = cov + 1. / root_prior_sample_size
+        mean = np.asarray(root_prior_mean) + shifts
+        weights = np.linalg.solve(cov[np.ix_(obs, obs)], cov[np.ix_(obs, unobs)])
+        means = mean[unobs] + weights.T.dot(x_obs - mean[obs])
+        variances = np.diag(cov[np.ix_(unobs, unobs)]) - np.sum(weights * cov[np.ix_(obs, unobs)], axis=0)
+        return unobs, means, variances
+
+    cov_obs_inv = np.linalg.inv(cov[np.ix_(obs, obs)])
+    ones = np.ones(len(obs))
+    root_var = 1. / ones.dot(cov_obs_inv).dot(ones)
+    root_mean = root_var * ones.dot(cov_obs_inv).dot(x_obs - shifts[obs])
+    weights = cov_obs_inv.dot(cov[np.ix_(obs, unobs)])
+    residuals = x_obs - shifts[obs] - root_mean
+    means = root_mean + shifts[unobs] + weights.T.dot(residuals)
+    variances = (np.diag(cov[np.ix_(unobs, unobs)])
+                 - np.sum(weights * cov[np.ix_(obs, unobs)], axis=0)
+                 + (1. - ones.dot(weights)) ** 2 * root_var)
+    return unobs, means, variances
+
+
+def random_setting(seed, missing_leafs=0):
+    random_state = np.random.RandomState(seed)
+    tree = random_tree(15, random_state)
+    for leaf in list(tree.iter_leafs())[:missing_leafs]:
+        leaf.location = None
+    n_nodes = len(tree.get_descendants())
+    rates = random_state.lognormal(sigma=0.5, size=n_nodes)
+    drift = random_state.normal(size=2)
+    return tree, rates, drift
+
+
+def observed_locations(pruning):
+    return {i: pruning.partial_means[i] for i in range(pruning.n_nodes) if pruning.observed[i]}
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('root_prior_sample_size', [0., 0.3])
+@pytest.mark.parametrize('with_rates', [False, True])
+@pytest.mark.parametrize('with_drift', [False, True])
+@pytest.mark.parametrize('missing_leafs', [0, 3])
+def test_node_posteriors_match_conditional_gaussian(seed, root_prior_sample_size, with_rates,
+                                                    with_drift, missing_leafs):
+    tree, rates, drift = random_setting(seed, missing_leafs)
+    rates = rates if with_rates else None
+    drift = drift if with_drift else None
+    root_prior_mean = np.array([1., -2.])
+
+    pruning = BrownianPruning(tree, rates=rates, drift=drift)
+    means, variances = pruning.node_posteriors(root_prior_mean=root_prior_mean,
+                                               root_prior_sample_size=root_prior_sample_size)
+
+    unobs, expected_means, expected_variances = brute_force_posteriors(
+        pruning, observed_locations(pruning), rates=rates, drift=drift,
+        root_prior_mean=root_prior_mean, root_prior_sample_size=root_prior_sample_size)
+    np.testing.assert_allclose(means[unobs], expected_means, rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(variances[unobs], expected_variances, rtol=1e-9, atol=1e-9)
+    assert np.all(variances[pruning.observed] == 0.)
+
+
+def test_reconstruction_fills_in_missing_locations():
+    tree, rates, drift = random_setting(0, missing_leafs=3)
+    pruning = BrownianPruning(tree, rates=rates, drift=drift)
+    unobs, expected_means, _ = brute_force_posteriors(pruning, observed_locations(pruning),
+                                                      rates=rates, drift=drift)
+
+    locations, _ = reconstruct_ancestral_locations(tree, mode='ml', rates=rates, drift=drift)
+    np.testing.assert_allclose(locations[unobs], expected_means, rtol=1e-9, atol=1e-9)
+    for i, node in enumerate(tree.iter_descendants()):
+        np.testing.assert_allclose(node.location, locations[i])
+
+
+def brute_force_log_likelihood(pruning, cov):
+    """Log likelihood of the leaf locations under Brownian motion with
+    covariance ´cov´ and a flat root prior, from the joint Gaussian of the
+    leafs with the root integrated out."""
+    leaf_cov, _ = node_covariance(pruning)
+    obs = np.nonzero(pruning.observed)[0]
+    x = pruning.partial_means[obs]
+    n = len(obs)
+
+    c_inv = np.linalg.inv(leaf_cov[np.ix_(obs, obs)])
+    ones = np.ones(n)
+    root = ones.dot(c_inv).dot(x) / ones.dot(c_inv).dot(ones)
+    residuals = x - root
+    _, log_det_c = np.linalg.slogdet(leaf_cov[np.ix_(obs, obs)])
+    _, log_det_cov = np.linalg.slogdet(cov)
+    return (-(n - 1) * np.log(2. * np.pi) - log_det_c - (n - 1) / 2. * log_det_cov
+            - np.log(ones.dot(c_inv).dot(ones))
+            - np.trace(np.linalg.inv(cov).dot(residuals.T.dot(c_inv).dot(residuals))) / 2.)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_log_likelihood_matches_joint_gaussian(seed):
+    tree, _, _ = random_setting(seed, missing_leafs=2)
+    pruning = BrownianPruning(tree)
+    assert pruning.n_contrasts == np.sum(pruning.observed) - 1
+
+    for cov in [np.eye(2) * 0.7, np.array([[2., 0.5], [0.5, 1.]])]:
+        np.testing.assert_allclose(pruning.log_likelihood(cov),
+                                   brute_force_log_likelihood(pruning, cov), rtol=1e-9)
+
+
+@pytest.mark.parametrize('diffusion_rate', [0.5, None])
+def test_root_hpd_coverage(diffusion_rate):
+    """The root HPD regions (normal for a fixed rate, Student-t with the rate
+    integrated out) have their nominal coverage for data simulated with the
+    root at the origin (exact under the flat root prior)."""
+    random_state = np.random.RandomState(1)
+    tree = random_tree(12, random_state)
+    pruning = BrownianPruning(tree)
+    leaf_cov, _ = node_covariance(pruning)
+    leafs = list(tree.iter_leafs())
+    leaf_idx = [pruning.node_idx[id(leaf)] for leaf in leafs]
+    cholesky = np.linalg.cholesky(leaf_cov[np.ix_(leaf_idx, leaf_idx)] * 0.5)
+
+    n_runs = 1000
+    hits = {80: 0, 95: 0}
+    for _ in range(n_runs):
+        locations = cholesky.dot(random_state.normal(size=(len(leafs), 2)))
+        for leaf, location in zip(leafs, locations):
+            leaf.location = location
+        reconstruction = BrownianReconstruction(tree, diffusion_rate=diffusion_rate)
+        for hpd in hits:
+            hits[hpd] += reconstruction.in_hpd(np.zeros(2), hpd)
+
+    for hpd, n_hits in hits.items():
+        p = hpd / 100.
+        assert abs(n_hits / n_runs - p) < 4. * np.sqrt(p * (1 - p) / n_runs)
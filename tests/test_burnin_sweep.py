@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import numpy as np
+import pytest
+
+from src.evaluation import BurninSweep, NATIVE, NATIVE_SHARED_GRID
+from src.summarize import annotate_location_summary
+from src.tree import Tree
+
+HPD_VALUES = [80, 95]
+BURNIN_FRACTIONS = [0., 0.1, 0.35, 0.8]
+THINNING_FACTORS = [1, 2, 3]
+
+
+def random_chain(random_state, n_samples=400, log_every=1000):
+    """Autocorrelated root samples (AR(1) around a drifting start) with their
+    MCMC states."""
+    samples = np.empty((n_samples, 2))
+    samples[0] = [5., -5.]
+    for i in range(1, n_samples):
+        samples[i] = 0.8 * samples[i - 1] + random_state.normal(scale=[1., 2.])
+    return samples, np.arange(n_samples) * log_every
+
+
+def direct_evaluation(samples, true_root):
+    """The metrics and HPD hits of `evaluate` (with the native summary) for the
+    selected samples, computed directly."""
+    offsets = samples - true_root
+    mean_offset = np.mean(offsets, axis=0)
+    row = {'rmse': np.sqrt(np.mean(np.sum(offsets ** 2, axis=1))),
+           'bias_x': mean_offset[0], 'bias_y': mean_offset[1],
+           'bias_norm': np.linalg.norm(mean_offset),
+           'stdev': np.sqrt(np.trace(np.cov(samples.T, bias=True)))}
+
+    root = Tree(0.)
+    annotate_location_summary(root, samples, HPD_VALUES)
+    for hpd in HPD_VALUES:
+        row['hpd_%i' % hpd] = root.root_in_hpd(true_root, hpd)
+    return row
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_sweep_matches_direct_evaluation(seed):
+    random_state = np.random.RandomState(seed)
+    samples, states = random_chain(random_state)
+    true_root = random_state.normal(scale=2., size=2)
+
+    sweep = BurninSweep(samples, states, true_root)
+    table = sweep.evaluate(BURNIN_FRACTIONS, THINNING_FACTORS, HPD_VALUES)
+    assert len(table) == len(BURNIN_FRACTIONS) * len(THINNING_FACTORS)
+
+    for _, row in table.iterrows():
+        selected = samples[states >= row['burnin']][::row['thinning']]
+        assert row['n_samples'] == len(selected)
+        assert row['hpd_summariser'] == NATIVE
+
+        expected = direct_evaluation(selected, true_root)
+        for key in ['rmse', 'bias_x', 'bias_y', 'bias_norm', 'stdev']:
+            np.testing.assert_allclose(row[key], expected[key], rtol=1e-9, atol=1e-12)
+        for hpd in HPD_VALUES:
+            assert row['hpd_%i' % hpd] == expected['hpd_%i' % hpd]
+
+
+def test_sweep_hits_vary_with_the_true_root():
+    samples, states = random_chain(np.random.RandomState(0))
+    hits = set()
+    for distance in np.linspace(0., 8., 9):
+        sweep = BurninSweep(samples, states, np.array([distance, 0.]))
+        hits.add(sweep.hpd_hits(0, 1, HPD_VALUES)[95])
+    assert hits == {True, False}
+
+
+def test_shared_grid_keeps_the_moments():
+    random_state = np.random.RandomState(0)
+    samples, states = random_chain(random_state)
+    true_root = np.zeros(2)
+
+    table = BurninSweep(samples, states, true_root).evaluate(
+        BURNIN_FRACTIONS, THINNING_FACTORS, HPD_VALUES)
+    shared_table = BurninSweep(samples, states, true_root, shared_grid=True).evaluate(
+        BURNIN_FRACTIONS, THINNING_FACTORS, HPD_VALUES)
+
+    assert set(shared_table['hpd_summariser']) == {NATIVE_SHARED_GRID}
+    for key in ['n_samples', 'rmse', 'bias_norm', 'stdev']:
+        np.testing.assert_allclose(shared_table[key], table[key], rtol=1e-9)
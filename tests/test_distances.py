@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import pdist, squareform
+
+from src.distances import (pairwise_distances, pairwise_min_distances, iter_pair_blocks,
+                           n_pairs, EUCLIDEAN, GREAT_CIRCLE, EARTH_RADIUS)
+
+
+def unit_vectors(lat_lon):
+    lat, lon = np.radians(lat_lon[:, 0]), np.radians(lat_lon[:, 1])
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)],
+                    axis=-1)
+
+
+def brute_force_distances(locations, metric):
+    """Condensed distance vector from scipy (euclidean) or from the chord
+    lengths between points on the unit sphere (great circle)."""
+    if metric == EUCLIDEAN:
+        return pdist(locations)
+    chords = pdist(unit_vectors(locations))
+    return 2. * EARTH_RADIUS * np.arcsin(chords / 2.)
+
+
+def random_locations(n, metric, random_state):
+    if metric == EUCLIDEAN:
+        return random_state.normal(scale=10., size=(n, 2))
+    return np.stack([random_state.uniform(-80., 80., n),
+                     random_state.uniform(-180., 180., n)], axis=-1)
+
+
+@pytest.mark.parametrize('n', [2, 3, 17, 100])
+@pytest.mark.parametrize('block_size', [1, 7, 1000])
+def test_pair_blocks_cover_the_upper_triangle_in_order(n, block_size):
+    pairs = [(i, j) for i_block, j_block in iter_pair_blocks(n, block_size=block_size)
+             for i, j in zip(i_block, j_block)]
+    assert pairs == [(i, j) for i in range(n) for j in range(i + 1, n)]
+    assert len(pairs) == n_pairs(n)
+
+
+@pytest.mark.parametrize('metric', [EUCLIDEAN, GREAT_CIRCLE])
+@pytest.mark.parametrize('block_size', [5, 64, 2 ** 20])
+def test_pairwise_distances_match_brute_force(metric, block_size):
+    random_state = np.random.RandomState(0)
+    locations = random_locations(60, metric, random_state)
+    expected = brute_force_distances(locations, metric)
+
+    dists = pairwise_distances(locations, metric=metric, block_size=block_size)
+    np.testing.assert_allclose(dists, expected, rtol=1e-9, atol=1e-9)
+
+    dists_32 = pairwise_distances(locations, metric=metric, dtype=np.float32,
+                                  block_size=block_size)
+    assert dists_32.dtype == np.float32
+    np.testing.assert_allclose(dists_32, expected, rtol=1e-4, atol=1e-2)
+
+
+@pytest.mark.parametrize('metric', [EUCLIDEAN, GREAT_CIRCLE])
+@pytest.mark.parametrize('n', [1, 2, 50, 123])
+@pytest.mark.parametrize('block_size', [3, 100, 2 ** 20])
+def test_min_distances_match_brute_force(metric, n, block_size):
+    random_state = np.random.RandomState(n)
+    locations = random_locations(n, metric, random_state)
+    if n > 10:
+        # Duplicate locations have a nearest neighbour at distance 0
+        locations[5] = locations[3]
+
+    expected = np.full(n, np.inf)
+    if n > 1:
+        d = squareform(brute_force_distances(locations, metric))
+        np.fill_diagonal(d, np.inf)
+        expected = np.min(d, axis=1)
+
+    min_dists = pairwise_min_distances(locations, metric=metric, block_size=block_size)
+    np.testing.assert_allclose(min_dists, expected, rtol=1e-9, atol=1e-9)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import squareform
+
+from src.lca import LCAIndex
+from tests.trees import random_tree, ancestors, path_length
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_lca_matches_ancestor_paths(seed):
+    random_state = np.random.RandomState(seed)
+    tree = random_tree(30, random_state)
+    lca_index = LCAIndex(tree)
+    nodes = lca_index.nodes
+
+    u = random_state.randint(len(nodes), size=200)
+    v = random_state.randint(len(nodes), size=200)
+    lcas = lca_index.lca(u, v)
+    for i, j, k in zip(u, v, lcas):
+        j_ancestors = {id(node) for node in ancestors(nodes[j])}
+        expected = next(node for node in ancestors(nodes[i]) if id(node) in j_ancestors)
+        assert nodes[k] is expected
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_patristic_distances_match_paths(seed):
+    random_state = np.random.RandomState(seed)
+    tree = random_tree(25, random_state)
+    lca_index = LCAIndex(tree)
+    leafs = list(tree.iter_leafs())
+
+    expected = [path_length(leafs[i], leafs[j])
+                for i in range(len(leafs)) for j in range(i + 1, len(leafs))]
+    np.testing.assert_allclose(lca_index.cophenetic_vector(), expected, atol=1e-12)
+    np.testing.assert_allclose(tree.get_phylo_dist_mat(), squareform(expected), atol=1e-12)
+
+
+def test_clade_leafs_are_the_leafs_of_each_clade():
+    tree = random_tree(40, np.random.RandomState(0))
+    lca_index = LCAIndex(tree)
+    all_leafs = list(tree.iter_leafs())
+
+    for clade in tree.iter_descendants():
+        clade_leafs = all_leafs[lca_index.clade_leafs(clade)]
+        assert [id(leaf) for leaf in clade_leafs] == [id(leaf) for leaf in clade.iter_leafs()]
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+from src.tree import Tree
+
+
+def random_tree(n_leafs, random_state, max_children=3, locations=True):
+    """A random tree with ´n_leafs´ leafs for the brute-force tests: random
+    topology with polytomies (up to ´max_children´ children per node) and
+    exponential branch lengths, so that it is not ultrametric (as with
+    fossils). The leafs get random locations.
+
+    Returns:
+        Tree: The root of the tree.
+    """
+    nodes = [Tree(random_state.exponential(), name='t%i' % i) for i in range(n_leafs)]
+    i_node = n_leafs
+    while len(nodes) > 1:
+        n_children = min(len(nodes), random_state.randint(2, max_children + 1))
+        picks = random_state.choice(len(nodes), size=n_children, replace=False)
+        parent = Tree(random_state.exponential(), name='n%i' % i_node)
+        for i in sorted(picks, reverse=True):
+            parent.add_child(nodes.pop(i))
+        nodes.append(parent)
+        i_node += 1
+
+    root = nodes[0]
+    root.length = 0.
+    if locations:
+        for leaf in root.iter_leafs():
+            leaf.location = random_state.normal(scale=3., size=2)
+    return root
+
+
+def ancestors(node):
+    """The path from ´node´ to the root (both included)."""
+    path = [node]
+    while path[-1].parent is not None:
+        path.append(path[-1].parent)
+    return path
+
+
+def path_length(u, v):
+    """Brute-force patristic distance: sum of the branch lengths on the path
+    between the nodes ´u´ and ´v´."""
+    u_path, v_path = ancestors(u), ancestors(v)
+    v_ids = {id(node) for node in v_path}
+    lca = next(node for node in u_path if id(node) in v_ids)
+    length = 0.
+    for path in (u_path, v_path):
+        for node in path:
+            if node is lca:
+                break
+            length += node.length
+    return length